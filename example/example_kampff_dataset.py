@@ -8,7 +8,6 @@ Them change working_dir = ... to the correct path
 
 """
 from tridesclous import *
-import pyqtgraph as pg
 
 import os
 from urllib.request import urlretrieve
@@ -119,6 +118,8 @@ def extract_waveforms_pca_cluster():
 
 
 def open_cataloguewindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import CatalogueWindow
     dataio = DataIO(dirname=dirname)
     catalogueconstructor = CatalogueConstructor(dataio=dataio)
     
@@ -162,6 +163,8 @@ def run_peeler():
 
 
 def open_PeelerWindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import PeelerWindow
     dataio = DataIO(dirname=dirname)
     initial_catalogue = dataio.load_catalogue(chan_grp=1)
 
@@ -5,7 +5,6 @@ but in a standard python script.
 """
 
 from tridesclous import *
-import pyqtgraph as pg
 
 
 from matplotlib import pyplot
@@ -147,6 +146,8 @@ def detect_similar_ratio():
 
 
 def open_cataloguewindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import CatalogueWindow
     dataio = DataIO(dirname=dirname)
     catalogueconstructor = CatalogueConstructor(dataio=dataio)
     print(catalogueconstructor)
@@ -172,6 +173,8 @@ def run_peeler():
     
     
 def open_PeelerWindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import PeelerWindow
     dataio = DataIO(dirname=dirname)
     initial_catalogue = dataio.load_catalogue(chan_grp=0)
 
@@ -5,7 +5,6 @@ but in a standard python script.
 """
 
 from tridesclous import *
-import pyqtgraph as pg
 
 
 from matplotlib import pyplot
@@ -119,6 +118,8 @@ def extract_waveforms_pca_cluster():
 
 
 def open_cataloguewindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import CatalogueWindow
     dataio = DataIO(dirname=dirname)
     catalogueconstructor = CatalogueConstructor(dataio=dataio)
     
@@ -144,6 +145,8 @@ def run_peeler():
     
     
 def open_PeelerWindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import PeelerWindow
     dataio = DataIO(dirname=dirname)
     print(dataio)
     initial_catalogue = dataio.load_catalogue(chan_grp=0)
@@ -5,7 +5,6 @@ but in a standard python script.
 """
 
 from tridesclous import *
-import pyqtgraph as pg
 
 import os
 import shutil
@@ -147,6 +146,8 @@ def detect_similar_ratio():
 
 
 def open_cataloguewindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import CatalogueWindow
     
     
     dataio = DataIO(dirname=dirname)
@@ -174,6 +175,8 @@ def run_peeler():
     
     
 def open_PeelerWindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import PeelerWindow
     dataio = DataIO(dirname=dirname)
     initial_catalogue = dataio.load_catalogue(chan_grp=0)
 
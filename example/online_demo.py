@@ -1,4 +1,5 @@
 from tridesclous import *
+from tridesclous.gui import *
 from tridesclous.online import *
 
 import  pyqtgraph as pg
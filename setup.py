@@ -16,6 +16,7 @@ install_requires = [
 extras_require={ 'gui' : ['PyQt5', 'pyqtgraph==0.10.0', 'matplotlib'],
                             'online' : 'pyacq',
                             'opencl' : ['pyopencl'],
+                            'numba' : ['numba'],
                         }
 
 long_description = ""
@@ -1,17 +1,15 @@
 from .version import version as __version__
 
-import PyQt5 # this force pyqtgraph to deal with Qt5
-
 from .datasets import download_dataset, get_dataset
 
-#dynamic import 
+#dynamic import
 from .datasource import data_source_classes
 for c in data_source_classes.values():
     globals()[c.__name__] = c
 
 from .dataio import DataIO
 from .catalogueconstructor import CatalogueConstructor
-from .peeler import Peeler
+from .peeler import Peeler, run_peeler_parallel, run_peeler_time_sharded
 from .peeler_cl import Peeler_OpenCl
 
 from .importers import import_from_spykingcircus
@@ -19,14 +17,31 @@ from .importers import import_from_spykingcircus
 #~ from .mpl_plot import *
 
 
-from .gui import *
-
-
-#~ try:
-    #~ import PyQt5 # this force pyqtgraph to deal with Qt5
-    #~ from .gui import *
-#~ except ImportError:
-    #~ import logging
-    #~ logging.warning('Interactive GUI not availble')
-    #~ pass
-
+# The GUI (PyQt5, pyqtgraph, matplotlib, seaborn) is not imported here
+# so that the core (DataIO, CatalogueConstructor, Peeler) stay importable
+# on headless machines. GUI names are resolved lazily on first access:
+#   import tridesclous as tdc
+#   win = tdc.CatalogueWindow(catalogueconstructor)  # import gui here
+_gui_names = ['QT', 'mkQApp',
+    'CatalogueController', 'CatalogueTraceViewer', 'PeakList', 'ClusterPeakList',
+    'NDScatter', 'WaveformViewer', 'CatalogueWindow', 'SpikeSimilarityView',
+    'ClusterSimilarityView', 'ClusterRatioSimilarityView', 'PairList', 'Silhouette',
+    'WaveformHistViewer', 'FeatureTimeViewer',
+    'PeelerController', 'PeelerTraceViewer', 'SpikeList', 'ClusterSpikeList', 'PeelerWindow',
+    'MainWindow', 'InitializeDatasetWindow', 'ChannelGroupWidget',
+    ]
+
+__all__ = ['download_dataset', 'get_dataset', 'data_source_classes',
+    'DataIO', 'CatalogueConstructor', 'Peeler', 'run_peeler_parallel', 'run_peeler_time_sharded',
+    'Peeler_OpenCl', 'import_from_spykingcircus',
+    ] + [c.__name__ for c in data_source_classes.values()]
+# GUI names are not in __all__ so that "from tridesclous import *" does not import PyQt5
+
+
+def __getattr__(name):
+    if name in _gui_names:
+        from . import gui
+        value = getattr(gui, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
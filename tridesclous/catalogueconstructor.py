@@ -4,27 +4,24 @@ from collections import OrderedDict
 import time
 import pickle
 import itertools
+import copy
+import concurrent.futures
 
 import numpy as np
 import scipy.signal
 import scipy.interpolate
-import seaborn as sns
-sns.set_style("white")
 
-import sklearn
 
 from . import signalpreprocessor
 from . import  peakdetector
-from . import decomposition
-from . import cluster 
+# decomposition and cluster import sklearn, they are loaded on first use
 from . import metrics
 
-from .tools import median_mad, get_pairs_over_threshold
+from .tools import median_mad, get_pairs_over_threshold, get_neighborhood, StreamingMedianMad
 
 
 from .iotools import ArrayCollection
-
-import matplotlib.pyplot as plt
+from .waveformextractor import align_waveforms_upsampled, ReservoirWaveformCapture
 
 from . import labelcodes
 
@@ -33,22 +30,68 @@ from . import labelcodes
 _persistent_metrics = ('spike_waveforms_similarity', 'cluster_similarity',
                         'cluster_ratio_similarity', 'spike_silhouette')
 
+# spike_waveforms_similarity can be stored as a sparse graph (CSR)
+_sparse_similarity_arrays = ('spike_waveforms_similarity_data', 'spike_waveforms_similarity_indices',
+                        'spike_waveforms_similarity_indptr')
+
 _reset_after_peak_arrays = ('some_peaks_index', 'some_waveforms', 'some_features',
-                        'channel_to_features', 
+                        'channel_to_features', 'all_features',
                         'some_noise_index', 'some_noise_snippet', 'some_noise_features',
-                        ) + _persistent_metrics
+                        ) + _persistent_metrics + _sparse_similarity_arrays
 
-_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'clusters') + _reset_after_peak_arrays
+_persitent_arrays = ('all_peaks', 'signals_medians','signals_mads', 'clusters', 'peak_candidates') + _reset_after_peak_arrays
 
 
 
 _dtype_peak = [('index', 'int64'), ('label', 'int64'), ('segment', 'int64'),]
+# + ('value', internal_dtype)
+_dtype_peak_candidate = [('index', 'int64'), ('segment', 'int64'), ('channel', 'int64'),]
 
 _dtype_cluster = [('cluster_label', 'int64'), ('cell_label', 'int64'), 
             ('max_on_channel', 'int64'), ('max_peak_amplitude', 'float64'),
             ('waveform_rms', 'float64'), ('nb_peak', 'int64'),]
 
 
+def _project_peaks(dataio, chan_grp, transform, peaks, params, batch_size, nb_feature, dtype):
+    # yield transform(waveforms) of peaks by batch (same order than peaks)
+    n_left, n_right = params['n_left'], params['n_right']
+    peak_width = n_right - n_left
+    align_waveform = params.get('align_waveform', False)
+    if align_waveform:
+        # same long snippets than extract_some_waveforms
+        left, width = n_left - peak_width, peak_width*3
+    else:
+        left, width = n_left, peak_width
+    seg_lengths = np.array([dataio.get_segment_length(s) for s in range(dataio.nb_segment)], dtype='int64')
+    
+    for b0 in range(0, peaks.size, batch_size):
+        batch = peaks[b0:b0+batch_size]
+        features = np.zeros((batch.size, nb_feature), dtype=dtype)
+        
+        valid = (batch['index']+left>=0) & (batch['index']+left+width<=seg_lengths[batch['segment']])
+        features[~valid] = np.nan
+        if np.any(valid):
+            wfs = dataio.get_some_waveforms(batch['segment'][valid], chan_grp, batch['index'][valid],
+                                    left, width, signal_type='processed')
+            if align_waveform:
+                wfs = align_waveforms_upsampled(wfs, n_left, params['peak_sign'], ratio=params['subsample_ratio'])
+            features[valid] = transform(wfs)
+        yield features
+
+
+def _project_peaks_job(dirname, chan_grp, projector, peaks, params, batch_size, nb_feature, dtype, filename, i0):
+    # one process: open its own DataIO and write rows i0:i0+peaks.size of the memmap
+    from .dataio import DataIO
+    dataio = DataIO(dirname=dirname)
+    all_features = np.memmap(filename, dtype=dtype, mode='r+')
+    all_features = all_features.reshape(-1, nb_feature)
+    pos = i0
+    for features in _project_peaks(dataio, chan_grp, projector.transform, peaks, params, batch_size, nb_feature, dtype):
+        all_features[pos:pos+features.shape[0]] = features
+        pos += features.shape[0]
+    all_features.flush()
+
+
 class CatalogueConstructor:
     """
     CatalogueConstructor scan a smal part of the dataset to construct the catalogue.
@@ -85,6 +128,7 @@ class CatalogueConstructor:
         for name in _persitent_arrays:
             # this set attribute to class if exsits
             self.arrays.load_if_exists(name)
+        self._load_sparse_similarity()
             
         if self.all_peaks is not None:
             self.memory_mode='memmap'
@@ -92,6 +136,10 @@ class CatalogueConstructor:
         
         
         self.projector = None
+        self._capture = None
+        self.peak_cache_floor = None
+        # labels of cluster metrics computed in this session (for partial update)
+        self._metric_labels = {}
     
     def flush_info(self):
         with open(self.info_filename, 'w', encoding='utf8') as f:
@@ -146,6 +194,8 @@ class CatalogueConstructor:
         for name in _persitent_arrays:
             # this set attribute to class if exsits
             self.arrays.load_if_exists(name)
+        self._load_sparse_similarity()
+        self._metric_labels = {}
     
     def set_preprocessor_params(self, chunksize=1024,
             memory_mode='memmap',
@@ -165,8 +215,18 @@ class CatalogueConstructor:
             #peak detector
             peakdetector_engine='numpy',
             peak_sign='-', relative_threshold=7, peak_span=0.0002,
+            peak_cache_floor=4.,
             
             ):
+        """
+        Set params for the signal preprocessor and the peak detector.
+        
+        peak_cache_floor: float or None
+            During run_signalprocessor all samples over min(peak_cache_floor, relative_threshold)
+            (in MAD) are kept in peak_candidates, so that re_detect_peak with a
+            relative_threshold>=floor is a filter on this cache (same peaks)
+            instead of a full pass on processed signals. None disable the cache.
+        """
         
         #TODO remove stuff if already computed
         
@@ -180,6 +240,15 @@ class CatalogueConstructor:
             #~ self.arrays.initialize_array(name, self.memory_mode,  dtype, (-1, ))
         self.arrays.initialize_array('all_peaks', self.memory_mode,  _dtype_peak, (-1, ))
         
+        if peak_cache_floor is not None:
+            peak_cache_floor = min(peak_cache_floor, relative_threshold)
+            self._dtype_peak_candidate = _dtype_peak_candidate + [('value', internal_dtype)]
+            self.arrays.initialize_array('peak_candidates', self.memory_mode, self._dtype_peak_candidate, (-1, ))
+        else:
+            self.arrays.delete_array('peak_candidates')
+        self.peak_cache_floor = peak_cache_floor
+        # the cache is valid only when the processing loop is finished
+        self.info.pop('peak_cache_floor', None)
         
         self.params_signalpreprocessor = dict(highpass_freq=highpass_freq, lowpass_freq=lowpass_freq, 
                         smooth_size=smooth_size, common_ref_removal=common_ref_removal,
@@ -193,9 +262,9 @@ class CatalogueConstructor:
         self.peakdetector = PeakDetector_class(self.dataio.sample_rate, self.nb_channel,
                                                         self.chunksize, internal_dtype)
         
-        #TODO make processed data as int32 ???
-        for i in range(self.dataio.nb_segment):
-            self.dataio.reset_processed_signals(seg_num=i, chan_grp=self.chan_grp, dtype=internal_dtype)
+        # processed signals are created by run_signalprocessor_loop_one_segment
+        # only when they are saved (see run_signalprocessor)
+        self.info.pop('processed_signals_saved', None)
         
         #~ self.nb_peak = 0
         
@@ -207,47 +276,110 @@ class CatalogueConstructor:
         self.flush_info()
     
     
-    def estimate_signals_noise(self, seg_num=0, duration=10.):
-        
-        length = int(duration*self.dataio.sample_rate)
-        length -= length%self.chunksize
+    def estimate_signals_noise(self, seg_num=0, duration=10., nb_block=1, method='exact'):
+        """
+        Estimate signals_medians and signals_mads on filtered (not normalized)
+        signals. They are used after to normalize signals.
         
-        assert length<self.dataio.get_segment_length(seg_num), 'duration exeed size'
+        Parameters
+        ----------
+        seg_num: int, list of int or None
+            Segment(s) used for the estimation. None means all segments.
+        duration: float
+            Total duration in s used for the estimation, shared between
+            segments and blocks.
+        nb_block: int
+            Number of blocks by segment. Blocks are evenly spaced in the segment
+            so that the estimation is not only done on the beginning.
+            The filter restart at each block.
+        method: 'exact' or 'histogram'
+            'exact' (default): the filtered signals are written in a temporary memmap
+            (removed at the end) and the median/mad are exact.
+            'histogram': streaming estimation with fixed bin histograms
+            (see tools.StreamingMedianMad) no temporary file.
+            Error is below 1% of the MAD (in practice <0.1%).
+        """
+        if seg_num is None:
+            seg_nums = list(range(self.dataio.nb_segment))
+        elif np.isscalar(seg_num):
+            seg_nums = [seg_num]
+        else:
+            seg_nums = list(seg_num)
         
-        name = 'filetered_sigs_for_noise_estimation_seg_{}'.format(seg_num)
-        shape=(length - self.params_signalpreprocessor['lostfront_chunksize'], self.nb_channel)
-        filtered_sigs = self.arrays.create_array(name, self.info['internal_dtype'], shape, 'memmap')
+        length = int(duration*self.dataio.sample_rate)
+        block_length = length // (len(seg_nums)*nb_block)
+        block_length -= block_length%self.chunksize
+        assert block_length>self.chunksize, 'duration too short for so many blocks'
+        
+        blocks = []
+        for s in seg_nums:
+            seg_length = self.dataio.get_segment_length(s)
+            assert block_length*nb_block<seg_length, 'duration exeed size'
+            starts = np.linspace(0, seg_length-block_length, nb_block).astype('int64')
+            starts -= starts%self.chunksize
+            for i_start in starts:
+                blocks.append((s, int(i_start), int(i_start)+block_length))
+        
+        lostfront_chunksize = self.params_signalpreprocessor['lostfront_chunksize']
+        if method=='exact':
+            name = 'filetered_sigs_for_noise_estimation'
+            shape = ((block_length-lostfront_chunksize)*len(blocks), self.nb_channel)
+            filtered_sigs = self.arrays.create_array(name, self.info['internal_dtype'], shape, 'memmap')
+        elif method=='histogram':
+            estimator = StreamingMedianMad(self.nb_channel)
+        else:
+            raise ValueError('method must be histogram or exact')
         
         params2 = dict(self.params_signalpreprocessor)
         params2['normalize'] = False
-        self.signalpreprocessor.change_params(**params2)
+        n = 0
+        for s, i_start, i_stop in blocks:
+            # reset the filter
+            self.signalpreprocessor.change_params(**params2)
+            iterator = self.dataio.iter_over_chunk(seg_num=s, chan_grp=self.chan_grp, chunksize=self.chunksize,
+                                    i_start=i_start, i_stop=i_stop, signal_type='initial',  return_type='raw_numpy')
+            for pos, sigs_chunk in iterator:
+                # the preprocessor need positions that start at 0
+                pos2, preprocessed_chunk = self.signalpreprocessor.process_data(pos-i_start, sigs_chunk)
+                if preprocessed_chunk is None:
+                    continue
+                if method=='exact':
+                    filtered_sigs[n:n+preprocessed_chunk.shape[0], :] = preprocessed_chunk
+                    n += preprocessed_chunk.shape[0]
+                else:
+                    estimator.new_chunk(preprocessed_chunk)
+        
+        if method=='exact':
+            signals_medians, signals_mads = median_mad(filtered_sigs[:n], axis=0)
+            del filtered_sigs
+            self.arrays.delete_array(name)
+        else:
+            signals_medians, signals_mads = estimator.get_median_mad()
         
-        iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp, chunksize=self.chunksize, i_stop=length,
-                                                    signal_type='initial',  return_type='raw_numpy')
-        for pos, sigs_chunk in iterator:
-            pos2, preprocessed_chunk = self.signalpreprocessor.process_data(pos, sigs_chunk)
-            if preprocessed_chunk is not None:
-                filtered_sigs[pos2-preprocessed_chunk.shape[0]:pos2, :] = preprocessed_chunk
-
         #create  persistant arrays
         self.arrays.create_array('signals_medians', self.info['internal_dtype'], (self.nb_channel,), 'memmap')
         self.arrays.create_array('signals_mads', self.info['internal_dtype'], (self.nb_channel,), 'memmap')
-        
-        self.signals_medians[:] = signals_medians = np.median(filtered_sigs[:pos2], axis=0)
-        self.signals_mads[:] = np.median(np.abs(filtered_sigs[:pos2]-signals_medians),axis=0)*1.4826
-        
-        #detach filetered signals even if the file remains.
-        self.arrays.detach_array(name)
-        
-
+        self.signals_medians[:] = signals_medians
+        self.signals_mads[:] = signals_mads
+    
     def signalprocessor_one_chunk(self, pos, sigs_chunk, seg_num, detect_peak=True):
 
         pos2, preprocessed_chunk = self.signalpreprocessor.process_data(pos, sigs_chunk)
         if preprocessed_chunk is  None:
             return
         
-        self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num, chan_grp=self.chan_grp,
-                        i_start=pos2-preprocessed_chunk.shape[0], i_stop=pos2, signal_type='processed')
+        if self.info.get('processed_signals_saved', True):
+            self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num, chan_grp=self.chan_grp,
+                            i_start=pos2-preprocessed_chunk.shape[0], i_stop=pos2, signal_type='processed')
+        
+        if self.peak_cache_floor is not None:
+            ind, chans, values = peakdetector.get_peak_candidates(preprocessed_chunk, self.peak_cache_floor)
+            candidates = np.zeros(ind.size, dtype=self._dtype_peak_candidate)
+            candidates['index'] = ind + pos2 - preprocessed_chunk.shape[0]
+            candidates['segment'] = seg_num
+            candidates['channel'] = chans
+            candidates['value'] = values
+            self.arrays.append_chunk('peak_candidates',  candidates)
         
         if detect_peak:
             n_peaks, chunk_peaks = self.peakdetector.process_data(pos2, preprocessed_chunk)
@@ -258,9 +390,12 @@ class CatalogueConstructor:
                 peaks['segment'][:] = seg_num
                 peaks['label'][:] = labelcodes.LABEL_UNCLASSIFIED
                 self.arrays.append_chunk('all_peaks',  peaks)
+            
+            if self._capture is not None:
+                self._capture.new_chunk(pos2, preprocessed_chunk, chunk_peaks)
     
     
-    def run_signalprocessor_loop_one_segment(self, seg_num=0, duration=60., detect_peak=True):
+    def run_signalprocessor_loop_one_segment(self, seg_num=0, duration=60., detect_peak=True, prefetch=0):
         
 
         
@@ -272,6 +407,10 @@ class CatalogueConstructor:
         self.info['processed_length'] = length
         self.flush_info()
         
+        #TODO make processed data as int32 ???
+        if self.info.get('processed_signals_saved', True):
+            self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=self.chan_grp, dtype=self.info['internal_dtype'])
+        
         #initialize engines
         
         p = dict(self.params_signalpreprocessor)
@@ -282,30 +421,140 @@ class CatalogueConstructor:
         
         self.peakdetector.change_params(**self.params_peakdetector)
         
+        if self._capture is not None:
+            # noise positions are chosen before, 2 times more because some will overlap peaks
+            peak_width = self._capture.peak_width
+            n_by_seg = self._capture_params['nb_noise_snippet']//self.dataio.nb_segment
+            possible_indexes = np.arange(peak_width, length-peak_width)
+            noise_indexes = np.random.choice(possible_indexes, size=min(n_by_seg*2, possible_indexes.size), replace=False)
+            self._capture.new_segment(seg_num, noise_indexes)
+        
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=self.chan_grp, chunksize=self.chunksize, i_stop=length,
-                                                    signal_type='initial', return_type='raw_numpy')
+                                                    signal_type='initial', return_type='raw_numpy', prefetch=prefetch)
         for pos, sigs_chunk in iterator:
             #~ print(seg_num, pos, sigs_chunk.shape)
             self.signalprocessor_one_chunk(pos, sigs_chunk, seg_num, detect_peak=detect_peak)
     
     
     def finalize_signalprocessor_loop(self):
-        self.dataio.flush_processed_signals(seg_num=0, chan_grp=self.chan_grp)
+        if self.info.get('processed_signals_saved', True):
+            self.dataio.flush_processed_signals(seg_num=0, chan_grp=self.chan_grp)
         
         #~ self.arrays.finalize_array('peak_pos')
         #~ self.arrays.finalize_array('peak_label')
         #~ self.arrays.finalize_array('peak_segment')
         
         self.arrays.finalize_array('all_peaks')
+        if self.peak_cache_floor is not None:
+            self.arrays.finalize_array('peak_candidates')
+            self.info['peak_cache_floor'] = self.peak_cache_floor
+            self.flush_info()
         self._reset_waveform_and_features()
+        if self._capture is not None:
+            self._store_captured_waveforms()
+            self._capture = None
         self.on_new_cluster()
     
-    def run_signalprocessor(self, duration=60., detect_peak=True):
-        for seg_num in range(self.dataio.nb_segment):
-            self.run_signalprocessor_loop_one_segment(seg_num=seg_num, duration=duration, detect_peak=detect_peak)
-        self.finalize_signalprocessor_loop()
+    def run_signalprocessor(self, duration=60., detect_peak=True, prefetch=0, write_behind=False,
+                    capture_waveforms=None, save_processed_signals=True):
+        """
+        Run the signal preprocessor and the peak detector on all segments.
+        
+        Parameters
+        ----------
+        duration: float
+            Max duration in s processed for each segment.
+        detect_peak: bool
+        prefetch: int
+            See DataIO.iter_over_chunk.
+        write_behind: bool
+            See DataIO.set_write_behind.
+        capture_waveforms: None or dict
+            Single pass mode: if a dict with n_left, n_right, nb_max and nb_noise_snippet
+            is given, some_waveforms (reservoir sampling of nb_max peaks) and
+            some_noise_snippet are captured directly from the preprocessed chunks,
+            so extract_some_waveforms/extract_some_noise are not needed anymore.
+        save_processed_signals: bool
+            If False processed signals are not written and their files are not
+            created (only possible with capture_waveforms). Then extract_some_waveforms, extract_some_noise
+            and re_detect_peak are not possible anymore.
+        """
+        if not save_processed_signals:
+            assert capture_waveforms is not None, 'save_processed_signals=False need capture_waveforms'
+        self.info['processed_signals_saved'] = save_processed_signals
+        self.flush_info()
+        
+        if capture_waveforms is not None:
+            assert detect_peak
+            self._capture_params = dict(n_left=-20, n_right=30, nb_max=10000, nb_noise_snippet=300)
+            self._capture_params.update(capture_waveforms)
+            self._capture = ReservoirWaveformCapture(self.nb_channel, self.chunksize,
+                        self._capture_params['n_left'], self._capture_params['n_right'],
+                        self._capture_params['nb_max'], self.info['internal_dtype'])
+        
+        if write_behind:
+            self.dataio.set_write_behind(True)
+        try:
+            for seg_num in range(self.dataio.nb_segment):
+                self.run_signalprocessor_loop_one_segment(seg_num=seg_num, duration=duration, detect_peak=detect_peak, prefetch=prefetch)
+            self.finalize_signalprocessor_loop()
+        finally:
+            if write_behind:
+                self.dataio.set_write_behind(False)
     
-    def re_detect_peak(self, peakdetector_engine='numpy', peak_sign='-', relative_threshold=7, peak_span=0.0002):
+    def _store_captured_waveforms(self):
+        p = self._capture_params
+        peak_width = p['n_right'] - p['n_left']
+        
+        some_peaks_index, some_waveforms = self._capture.get_waveforms()
+        self.arrays.add_array('some_peaks_index', some_peaks_index, self.memory_mode)
+        self.arrays.add_array('some_waveforms', some_waveforms, self.memory_mode)
+        self.info['params_waveformextractor'] = dict(n_left=p['n_left'], n_right=p['n_right'], 
+                                    nb_max=p['nb_max'], align_waveform=False, subsample_ratio=20)
+        self.flush_info()
+        
+        # keep noise snippets that do not overlap a peak
+        segments, indexes, snippets = self._capture.get_noise()
+        n_by_seg = p['nb_noise_snippet']//self.dataio.nb_segment
+        keep = np.zeros(indexes.size, dtype='bool')
+        for seg_num in np.unique(segments):
+            in_seg, = np.nonzero(segments==seg_num)
+            peak_indexes = self.all_peaks['index'][self.all_peaks['segment']==seg_num]
+            if peak_indexes.size>0:
+                pos = np.searchsorted(peak_indexes, indexes[in_seg])
+                dist_right = np.abs(peak_indexes[np.clip(pos, 0, peak_indexes.size-1)] - indexes[in_seg])
+                dist_left = np.abs(peak_indexes[np.clip(pos-1, 0, peak_indexes.size-1)] - indexes[in_seg])
+                in_seg = in_seg[np.minimum(dist_left, dist_right)>=peak_width]
+            if in_seg.size>n_by_seg:
+                in_seg = np.sort(np.random.choice(in_seg, size=n_by_seg, replace=False))
+            keep[in_seg] = True
+        
+        some_noise_index = np.zeros(np.sum(keep), dtype=_dtype_peak)
+        some_noise_index['index'] = indexes[keep]
+        some_noise_index['label'] = labelcodes.LABEL_NOISE
+        some_noise_index['segment'] = segments[keep]
+        self.arrays.add_array('some_noise_index', some_noise_index, self.memory_mode)
+        self.arrays.add_array('some_noise_snippet', snippets[keep], self.memory_mode)
+    
+    def _check_processed_signals(self):
+        assert self.info.get('processed_signals_saved', True), \
+            'Processed signals have not been saved: run_signalprocessor(save_processed_signals=False)'
+    
+    def re_detect_peak(self, peakdetector_engine='numpy', peak_sign='-', relative_threshold=7, peak_span=0.0002,
+                use_cache=True):
+        """
+        Detect again peaks with other params.
+        
+        If peak_candidates have been kept by run_signalprocessor (see peak_cache_floor)
+        and relative_threshold>=peak_cache_floor, peaks are detected from this cache
+        (any peak_sign and peak_span, same peaks than the full pass). Otherwise
+        processed signals are read again.
+        """
+        floor = self.info.get('peak_cache_floor', None)
+        from_cache = use_cache and floor is not None and self.peak_candidates is not None \
+                    and relative_threshold>=floor
+        if not from_cache:
+            self._check_processed_signals()
         
         #TODO if not peak detector in class
         self.params_peakdetector = dict(peak_sign=peak_sign, relative_threshold=relative_threshold, peak_span=peak_span)
@@ -323,6 +572,14 @@ class CatalogueConstructor:
         #TODO clip i_stop with duration ???
         
         for seg_num in range(self.dataio.nb_segment):
+            if from_cache:
+                chunk_peaks = self._detect_peak_from_cache(seg_num)
+                peaks = np.zeros(chunk_peaks.size, dtype=_dtype_peak)
+                peaks['index'] = chunk_peaks
+                peaks['segment'][:] = seg_num
+                peaks['label'][:] = labelcodes.LABEL_UNCLASSIFIED
+                self.arrays.append_chunk('all_peaks',  peaks)
+                continue
             
             self.peakdetector.change_params(**self.params_peakdetector)#this reset the fifo index
             
@@ -342,6 +599,21 @@ class CatalogueConstructor:
         self._reset_waveform_and_features()
         self.on_new_cluster()
     
+    def _detect_peak_from_cache(self, seg_num):
+        candidates = self.peak_candidates[self.peak_candidates['segment']==seg_num]
+        k = self.peakdetector.n_span
+        ind_peaks = peakdetector.detect_peaks_in_candidates(candidates['index'], candidates['channel'],
+                    candidates['value'], self.nb_channel, k, self.params_peakdetector['relative_threshold'],
+                    self.params_peakdetector['peak_sign'])
+        
+        # same borders than the chunk by chunk loop on processed signals:
+        # the first chunk is sacrified and the last k samples are never centers
+        chunksize = self.info['chunksize']
+        length = self.dataio.get_segment_length(seg_num)
+        length -= length%chunksize
+        keep = (ind_peaks>=chunksize-k) & (ind_peaks<length-k)
+        return ind_peaks[keep]
+    
     def _reset_waveform_and_features(self):
         """Must be called after peak detection
         """
@@ -361,6 +633,7 @@ class CatalogueConstructor:
         """
         
         """
+        self._check_processed_signals()
         if n_left is None or n_right is None:
             assert  'params_waveformextractor' in self.info
             n_left = self.info['params_waveformextractor']['n_left']
@@ -385,8 +658,6 @@ class CatalogueConstructor:
         # this is important to not take 2 times the sames, this leads to bad mad/median
         some_peaks_index = np.unique(some_peaks_index)
         
-        some_peak_mask = np.zeros(self.nb_peak, dtype='bool')
-        some_peak_mask[some_peaks_index] = True
         
         nb = some_peaks_index.size
         
@@ -398,61 +669,21 @@ class CatalogueConstructor:
         shape=(nb, peak_width, self.nb_channel)
         self.arrays.create_array('some_waveforms', self.info['internal_dtype'], shape, self.memory_mode)
 
-        seg_nums = np.unique(self.all_peaks['segment'])
-        n = 0
-        for seg_num in seg_nums:
-            insegment_peaks  = self.all_peaks[some_peak_mask & (self.all_peaks['segment']==seg_num)]
-            for peak in insegment_peaks:
-                i_start = peak['index']+n_left
-                i_stop = i_start+peak_width
-                if align_waveform:
-                    ratio = subsample_ratio
-                    wf = self.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.chan_grp, i_start=i_start-peak_width, i_stop=i_stop+peak_width, signal_type='processed')
-                    wf2 = scipy.signal.resample(wf, wf.shape[0]*ratio, axis=0)
-                    wf2_around_peak = wf2[(peak_width-n_left-2)*ratio:(peak_width-n_left+3)*ratio, :]
-                    #~ print(wf2_around_peak.shape)
-                    if peak_sign=='+':
-                        #~ ind_chan_max = np.argmax(np.max(wf2_around_peak, axis=0))
-                        ind_chan_max = np.argmax(wf2_around_peak[ratio, :])
-                        ind_max = np.argmax(wf2_around_peak[:, ind_chan_max])
-                    elif peak_sign=='-':
-                        #~ ind_chan_max_old = np.argmin(np.min(wf2_around_peak, axis=0))
-                        ind_chan_max = np.argmin(wf2_around_peak[ratio, :])
-                        #~ print(ind_chan_max_old, ind_chan_max)
-                        ind_max = np.argmin(wf2_around_peak[:, ind_chan_max])
-                    shift = ind_max - ratio*2
-                    #~ print('ind_chan_max', ind_chan_max, 'ind_max', ind_max, 'shift', shift)
-                    
-                    #~ i1=peak_width*ratio+ind_max
-                    #~ i1_old = (peak_width-n_left-1)*ratio + ind_max + n_left*ratio 
-                    #~ i1 = peak_width*ratio + shift
-                    i1 = peak_width*ratio + shift
-                    #~ print('i1_old', i1_old, 'i1', i1)
-                    i2 = i1+peak_width*ratio
-                    wf_short = wf2[i1:i2:ratio, :]
-                    self.some_waveforms[n, :, :] = wf_short
-                    
-                    #DEBUG
-                    #~ wf_short = self.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.chan_grp, i_start=i_start, i_stop=i_stop, signal_type='processed')
-                    #~ import matplotlib.pyplot as plt
-                    #~ fig, ax = plt.subplots()
-                    #~ ax.plot(wf2[:, ind_chan_max])
-                    #~ x = (peak_width-n_left-2)*ratio + ind_max
-                    #~ print(x, n_left, n_right, peak_width, ratio)
-                    #~ y = wf2[(peak_width-n_left-2)*ratio+ind_max, ind_chan_max]
-                    #~ y_av = wf2[(peak_width-n_left-2)*ratio+ind_max-ratio, ind_chan_max]
-                    #~ y_af = wf2[(peak_width-n_left-2)*ratio+ind_max+ratio, ind_chan_max]
-                    #~ ax.plot([x-ratio, x, x+ratio], [y_av, y, y_af], marker='o', markersize=10)
-                    #~ ax.axvline((peak_width-n_left-2)*ratio)
-                    #~ ax.axvline((peak_width-n_left+3)*ratio)
-                    #~ ax.plot(np.arange(wf_short.shape[0])*ratio+peak_width*ratio, wf_short[:, ind_chan_max], ls='--')
-                    #~ plt.show()
-                    #END DEBUG
-                    
-                else:
-                    wf = self.dataio.get_signals_chunk(seg_num=seg_num, chan_grp=self.chan_grp, i_start=i_start, i_stop=i_stop, signal_type='processed')
-                    self.some_waveforms[n, :, :] = wf
-                n +=1
+        # waveforms are ordered by segment and then by peak position (as all_peaks)
+        peaks = self.all_peaks[some_peaks_index]
+        peaks = peaks[np.argsort(peaks['segment'], kind='stable')]
+        
+        if align_waveform:
+            # long snippets are read and upsampled by batch
+            batch_size = 1024
+            for b0 in range(0, nb, batch_size):
+                b1 = min(b0+batch_size, nb)
+                long_wfs = self.dataio.get_some_waveforms(peaks['segment'][b0:b1], self.chan_grp, peaks['index'][b0:b1],
+                                n_left-peak_width, peak_width*3, signal_type='processed')
+                self.some_waveforms[b0:b1] = align_waveforms_upsampled(long_wfs, n_left, peak_sign, ratio=subsample_ratio)
+        else:
+            self.dataio.get_some_waveforms(peaks['segment'], self.chan_grp, peaks['index'],
+                                n_left, peak_width, signal_type='processed', out=self.some_waveforms)
         
         #Test smooth
         #~ box_size = 3
@@ -537,6 +768,7 @@ class CatalogueConstructor:
         Find some snipet of signal that are not overlap with peak waveforms.
         """
         #~ 'some_noise_index', 'some_noise_snippet', 
+        self._check_processed_signals()
         assert  'params_waveformextractor' in self.info
         n_left = self.info['params_waveformextractor']['n_left']
         n_right = self.info['params_waveformextractor']['n_right']
@@ -572,16 +804,8 @@ class CatalogueConstructor:
         #create snipet
         shape=(self.some_noise_index.size, peak_width, self.nb_channel)
         self.arrays.create_array('some_noise_snippet', self.info['internal_dtype'], shape, self.memory_mode)
-        #~ n = 0
-        for n, ind in enumerate(self.some_noise_index):
-        #~ for seg_num in range(self.dataio.nb_segment):
-            #~ insegment_indexes  = self.some_noise_index[(self.some_noise_index['segment']==seg_num)]
-            #~ for ind in insegment_indexes:
-            i_start = ind['index']+n_left
-            i_stop = i_start+peak_width
-            snippet = self.dataio.get_signals_chunk(seg_num=ind['segment'], chan_grp=self.chan_grp, i_start=i_start, i_stop=i_stop, signal_type='processed')
-            self.some_noise_snippet[n, :, :] = snippet
-                #~ n +=1
+        self.dataio.get_some_waveforms(self.some_noise_index['segment'], self.chan_grp, self.some_noise_index['index'],
+                                n_left, peak_width, signal_type='processed', out=self.some_noise_snippet)
 
     def extract_some_features(self, method='pca', selection = None, **params): #n_components=5, 
         """
@@ -593,6 +817,7 @@ class CatalogueConstructor:
         
         #~ wf = self.some_waveforms.reshape(self.some_waveforms.shape[0], -1)
         #~ params['n_components'] = n_components
+        from . import decomposition
         features, channel_to_features, self.projector = decomposition.project_waveforms(self.some_waveforms, method=method, selection=None,
                     catalogueconstructor=self, **params)
         
@@ -601,6 +826,9 @@ class CatalogueConstructor:
         #~ self.some_features[:] = features
         self.arrays.add_array('some_features', features.astype(self.info['internal_dtype']), self.memory_mode)
         self.arrays.add_array('channel_to_features', channel_to_features, self.memory_mode)
+        # features of all peaks must be computed again with this projector
+        self.arrays.detach_array('all_features')
+        self.all_features = None
         
         if self.some_noise_snippet is not None:
             some_noise_features = self.projector.transform(self.some_noise_snippet)
@@ -620,12 +848,157 @@ class CatalogueConstructor:
         
     
     
-    def find_clusters(self, method='kmeans', selection=None, **kargs):
-        #done in a separate module cluster.py
-        cluster.find_clusters(self, method=method, selection=selection, **kargs)
+    def extract_all_features(self, batch_size=4096, n_jobs=1):
+        """
+        Project all peaks (not only some_waveforms) with the projector fitted by
+        extract_some_features. The result is all_features (nb_peak, nb_feature)
+        in the same order than all_peaks.
         
+        Peaks are read by batch of batch_size snippets (sorted by segment and time
+        so that processed signals are read sequentially, see DataIO.get_some_waveforms)
+        and features are appended to the array, so RAM is bounded whatever nb_peak.
+        Peaks too close to the segment borders to be cut get NaN features.
+        
+        n_jobs: number of processes (memmap mode only). Each process has a contiguous
+        part of all_peaks and write directly in the all_features memmap.
+        """
+        assert self.projector is not None, 'extract_some_features must be done before'
+        self._check_processed_signals()
+        
+        nb_feature = self.some_features.shape[1]
+        dtype = self.info['internal_dtype']
+        params = dict(self.info['params_waveformextractor'])
+        params['peak_sign'] = self.info['params_peakdetector']['peak_sign']
+        
+        t1 = time.perf_counter()
+        if n_jobs == 1:
+            self.arrays.initialize_array('all_features', self.memory_mode, dtype, (-1, nb_feature))
+            for features in _project_peaks(self.dataio, self.chan_grp, self.projector.transform, self.all_peaks,
+                                        params, batch_size, nb_feature, dtype):
+                self.arrays.append_chunk('all_features', features)
+            self.arrays.finalize_array('all_features')
+        else:
+            assert self.memory_mode == 'memmap', 'n_jobs>1 need memmap'
+            self.arrays.create_array('all_features', dtype, (self.nb_peak, nb_feature), 'memmap')
+            self.arrays.flush_array('all_features')
+            filename = self.arrays._fname('all_features')
+            # the projector is pickled in each job: only keep the transform state
+            # (some projectors keep the fitted waveforms, which can be big)
+            projector = copy.copy(self.projector)
+            projector.__dict__.pop('waveforms', None)
+            # contiguous parts of all_peaks, several by process for load balancing
+            limits = np.linspace(0, self.nb_peak, n_jobs*4+1).astype('int64')
+            jobs = [(self.dataio.dirname, self.chan_grp, projector, np.array(self.all_peaks[i0:i1]), params,
+                            batch_size, nb_feature, dtype, filename, i0)
+                            for i0, i1 in zip(limits[:-1], limits[1:]) if i1>i0]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_project_peaks_job, *args) for args in jobs]
+                for future in futures:
+                    # an exception in a worker is raised here
+                    future.result()
+        t2 = time.perf_counter()
+        print('extract_all_features', t2-t1)
+    
+    def propagate_labels(self, space='features', max_distance=None, batch_size=65536):
+        """
+        Label all peaks that are not in some_peaks_index with the nearest cluster
+        (positive labels only), without running the Peeler.
+        
+        space: 'features' or 'waveforms'
+            'features': nearest centroid (mean of some_features by cluster) of
+            all_features (see extract_all_features) with a KD-tree on centroids.
+            'waveforms': nearest centroid median waveform (see compute_centroid),
+            snippets are read from processed signals and distances are computed
+            by block (|x-y|**2 = |x|**2 + |y|**2 - 2*x.y).
+        max_distance: None or float
+            Peaks with a distance to the nearest centroid over max_distance
+            (euclidean, in units of the space) stay LABEL_UNCLASSIFIED.
+        batch_size: number of peaks by block, memory is bounded by this.
+        """
+        import scipy.spatial
+        some_labels = self.all_peaks['label'][self.some_peaks_index]
+        labels = np.unique(some_labels[some_labels>=0])
+        nb_cluster = labels.size
+        assert nb_cluster>0, 'find_clusters must be done before'
+        if max_distance is None:
+            max_distance = np.inf
+        
+        to_label = np.ones(self.nb_peak, dtype='bool')
+        to_label[self.some_peaks_index] = False
+        
+        t1 = time.perf_counter()
+        if space == 'features':
+            assert self.all_features is not None, 'extract_all_features must be done before'
+            centers = np.array([np.mean(self.some_features[some_labels==k], axis=0) for k in labels])
+            tree = scipy.spatial.cKDTree(centers)
+            
+            def iter_distances():
+                for b0 in range(0, self.nb_peak, batch_size):
+                    features = np.asarray(self.all_features[b0:b0+batch_size], dtype='float64')
+                    valid = np.all(np.isfinite(features), axis=1)
+                    nearest = np.full(features.shape[0], nb_cluster, dtype='int64')
+                    dist, nearest[valid] = tree.query(features[valid], k=1, distance_upper_bound=max_distance)
+                    yield nearest
+        
+        elif space == 'waveforms':
+            self._check_processed_signals()
+            if not hasattr(self, 'centroids'):
+                self.compute_centroid()
+            templates = np.array([self.centroids[k]['median'] for k in labels], dtype='float64')
+            templates = templates.reshape(nb_cluster, -1)
+            templates_norm2 = np.sum(templates**2, axis=1)
+            
+            def distances_to_templates(wfs):
+                x = wfs.reshape(wfs.shape[0], -1).astype('float64')
+                dist2 = np.sum(x**2, axis=1)[:, None] + templates_norm2[None, :] - 2*np.dot(x, templates.T)
+                return np.sqrt(np.maximum(dist2, 0.))
+            
+            params = dict(self.info['params_waveformextractor'])
+            params['peak_sign'] = self.info['params_peakdetector']['peak_sign']
+            
+            def iter_distances():
+                for dist in _project_peaks(self.dataio, self.chan_grp, distances_to_templates, self.all_peaks,
+                                    params, batch_size, nb_cluster, 'float64'):
+                    nearest = np.argmin(np.nan_to_num(dist, nan=np.inf), axis=1)
+                    min_dist = dist[np.arange(dist.shape[0]), nearest]
+                    # NaN for peaks on borders
+                    nearest[~(min_dist<=max_distance)] = nb_cluster
+                    yield nearest
+        else:
+            raise ValueError('space must be features or waveforms')
+        
+        # nb_cluster is the index of unclassified
+        new_labels = np.concatenate([labels, [labelcodes.LABEL_UNCLASSIFIED]]).astype('int64')
+        b0 = 0
+        for nearest in iter_distances():
+            b1 = b0 + nearest.size
+            mask = to_label[b0:b1]
+            peak_labels = self.all_peaks['label'][b0:b1]
+            peak_labels[mask] = new_labels[nearest[mask]]
+            b0 = b1
+        
+        t2 = time.perf_counter()
+        print('propagate_labels', t2-t1)
         
         self.on_new_cluster()
+    
+    def find_clusters(self, method='kmeans', selection=None, space='some_features', **kargs):
+        """
+        Cluster the peaks, see cluster.find_clusters.
+        With space='all_features' all peaks are clustered from all_features
+        (methods 'minibatchkmeans' or 'sparse_dbscan').
+        """
+        #done in a separate module cluster.py
+        from . import cluster
+        if selection is not None:
+            old_labels = np.unique(self.all_peaks['label'][selection])
+        labels = cluster.find_clusters(self, method=method, selection=selection, space=space, **kargs)
+        
+        if selection is None:
+            self.on_new_cluster()
+        else:
+            # only clusters of the selection are modified
+            self.on_new_cluster(label_changed=np.union1d(old_labels, labels))
         
         
         
@@ -635,50 +1008,101 @@ class CatalogueConstructor:
             #~ self.order_clusters()
     
     
-    def on_new_cluster(self):
+    def on_new_cluster(self, label_changed=None):
+        """
+        Update the clusters array (cluster labels and nb_peak) after a labels change.
+        
+        label_changed: None or list
+            If None all cluster stats (max_on_channel, max_peak_amplitude, waveform_rms)
+            are reset. Otherwise only stats of theses labels (and of labels with
+            a new nb_peak) are reset and their centroids removed,
+            so compute_centroid(label_changed) only recompute them.
+        """
         #~ print('on_new_cluster')
         if self.all_peaks is None:
             return
-        cluster_labels = np.unique(self.all_peaks['label'])
+        
+        # count with bincount, one pass on all_peaks
+        peak_labels = self.all_peaks['label']
+        if peak_labels.size>0:
+            label_min = np.min(peak_labels)
+            counts = np.bincount(peak_labels - label_min)
+            cluster_labels, = np.nonzero(counts)
+            nb_peak = counts[cluster_labels]
+            cluster_labels = cluster_labels + label_min
+        else:
+            cluster_labels = np.array([], dtype='int64')
+            nb_peak = np.array([], dtype='int64')
+        
         clusters = np.zeros(cluster_labels.shape, dtype=_dtype_cluster)
         clusters['cluster_label'][:] = cluster_labels
         clusters['cell_label'][:] = cluster_labels
         clusters['max_on_channel'][:] = -1
         clusters['max_peak_amplitude'][:] = np.nan
         clusters['waveform_rms'][:] = np.nan
-        for i, k in enumerate(cluster_labels):
-            clusters['nb_peak'][i] = np.sum(self.all_peaks['label']==k)
+        clusters['nb_peak'][:] = nb_peak
         
-        if self.clusters is not None:
+        if self.clusters is not None and self.clusters.size>0 and clusters.size>0:
             #get previous cell_label
-            for i, c in enumerate(clusters):
-                #~ print(i, c)
-                if c['cluster_label'] in self.clusters['cluster_label']:
-                    j = np.nonzero(c['cluster_label']==self.clusters['cluster_label'])[0][0]
-                    self.clusters[j]['cell_label'] in cluster_labels
-                    clusters[i]['cell_label'] = self.clusters[j]['cell_label']
-                    #~ print('j', j)
+            prev = self.clusters
+            order = np.argsort(prev['cluster_label'])
+            ind = np.searchsorted(prev['cluster_label'], cluster_labels, sorter=order)
+            ind = order[np.clip(ind, 0, prev.size-1)]
+            exists = prev['cluster_label'][ind]==cluster_labels
+            clusters['cell_label'][exists] = prev['cell_label'][ind[exists]]
+            
+            if label_changed is not None:
+                # keep stats of untouched clusters
+                keep = exists & (prev['nb_peak'][ind]==nb_peak) & ~np.in1d(cluster_labels, label_changed)
+                for name in ('max_on_channel', 'max_peak_amplitude', 'waveform_rms'):
+                    clusters[name][keep] = prev[name][ind[keep]]
+                if hasattr(self, 'centroids'):
+                    kept = set(cluster_labels[keep].tolist())
+                    for k in list(self.centroids.keys()):
+                        if k not in kept:
+                            self.centroids.pop(k)
         
         if clusters.size>0:
             self.arrays.add_array('clusters', clusters, self.memory_mode)
     
     def compute_centroid(self, label_changed=None):
-        if label_changed is None:
+        """
+        Compute centroids (median, mad, mean, std of some_waveforms) and cluster stats.
+        
+        label_changed: None or list
+            If None all centroids are computed. Otherwise only theses labels and
+            labels without centroid yet (see on_new_cluster).
+        """
+        if label_changed is None or not hasattr(self, 'centroids'):
             # recompute all clusters
             self.centroids = {}
             label_changed = self.cluster_labels
+        else:
+            missing = [k for k in self.positive_cluster_labels if k not in self.centroids]
+            label_changed = np.union1d(np.asarray(label_changed, dtype='int64'), missing).astype('int64')
         print('compute_centroid')
         
         if self.some_waveforms is None:
             return 
         n_left = int(self.info['params_waveformextractor']['n_left'])
         t1 = time.perf_counter()
+        
+        # group waveforms by label once instead of one mask by label
+        some_labels = self.all_peaks['label'][self.some_peaks_index]
+        some_inds, = np.nonzero(np.in1d(some_labels, label_changed))
+        some_inds = some_inds[np.argsort(some_labels[some_inds], kind='mergesort')]
+        sorted_labels = some_labels[some_inds]
+        
+        cluster_labels = self.cluster_labels
+        cluster_inds = {k:i for i, k in enumerate(cluster_labels)}
+        
         for k in label_changed:
             if k <0: continue
-            if k not in self.cluster_labels:
-                self.centroids.pop(k)
+            if k not in cluster_inds:
+                self.centroids.pop(k, None)
                 continue
-            wf = self.some_waveforms[self.all_peaks['label'][self.some_peaks_index]==k]
+            i0, i1 = np.searchsorted(sorted_labels, [k, k+1])
+            wf = self.some_waveforms[some_inds[i0:i1]]
             median, mad = median_mad(wf, axis = 0)
             mean, std = np.mean(wf, axis=0), np.std(wf, axis=0)
             #~ max_on_channel = np.argmax(np.max(np.abs(mean), axis=0))
@@ -692,7 +1116,7 @@ class CatalogueConstructor:
             self.centroids[k] = {'median':median, 'mad':mad, #'max_on_channel' : max_on_channel, 
                         'mean': mean, 'std': std}
             
-            ind = np.nonzero(self.clusters['cluster_label']==k)[0][0]
+            ind = cluster_inds[k]
             self.clusters['max_on_channel'][ind] = max_on_channel
             self.clusters['max_peak_amplitude'][ind] = median[-n_left, max_on_channel]
             self.clusters['waveform_rms'][ind] = np.sqrt(np.mean(median**2))
@@ -709,6 +1133,7 @@ class CatalogueConstructor:
         
         labels_ok = self.cluster_labels[self.cluster_labels>=0]
         n = labels_ok.size
+        import seaborn as sns # lazy: plotting dependency only needed here
         color_table = sns.color_palette(palette, n)
         for i, k in enumerate(labels_ok):
             if k not in self.colors:
@@ -723,14 +1148,20 @@ class CatalogueConstructor:
         self.find_clusters(method=method, selection=mask, **kargs) # order_clusters=order_clusters,
     
     def trash_small_cluster(self, n=10):
-        for k in self.cluster_labels:
-            mask = self.all_peaks['label']==k
-            if np.sum(mask)<=n:
-                self.all_peaks['label'][mask] = -1
-        self.on_new_cluster()
+        labels, counts = np.unique(self.all_peaks['label'], return_counts=True)
+        small = labels[(counts<=n) & (labels!=labelcodes.LABEL_TRASH)]
+        if small.size>0:
+            mask = np.in1d(self.all_peaks['label'], small)
+            self.all_peaks['label'][mask] = labelcodes.LABEL_TRASH
+        self.on_new_cluster(label_changed=small.tolist()+[labelcodes.LABEL_TRASH])
 
-    def compute_spike_waveforms_similarity(self, method='cosine_similarity', size_max = 1e7):
+    def compute_spike_waveforms_similarity(self, method='cosine_similarity', size_max = 1e7, n_neighbors=100):
         """This compute the similarity spike by spike.
+        
+        If some_waveforms.size<size_max the similarity is a dense matrix.
+        Otherwise it is a sparse graph (scipy.sparse.csr_matrix) that keep only
+        the n_neighbors most similar spikes for each spike, computed by blocks
+        in bounded memory (see metrics.compute_similarity_knn).
         """
         t1 = time.perf_counter()
         spike_waveforms_similarity = None
@@ -739,19 +1170,51 @@ class CatalogueConstructor:
             wf = wf.reshape(wf.shape[0], -1)
             if wf.size<size_max:
                 spike_waveforms_similarity = metrics.compute_similarity(wf, method)
+            else:
+                spike_waveforms_similarity = metrics.compute_similarity_knn(wf, method, n_neighbors=n_neighbors)
+        
+        for name in ('spike_waveforms_similarity', ) + _sparse_similarity_arrays:
+            self.arrays.detach_array(name)
+            setattr(self, name, None)
         
         if spike_waveforms_similarity is None:
-            self.arrays.detach_array('spike_waveforms_similarity')
-            self.spike_waveforms_similarity = None
-        else:
+            pass
+        elif isinstance(spike_waveforms_similarity, np.ndarray):
             self.arrays.add_array('spike_waveforms_similarity', spike_waveforms_similarity.astype('float32'), self.memory_mode)
+        else:
+            for attr, name in zip(('data', 'indices', 'indptr'), _sparse_similarity_arrays):
+                self.arrays.add_array(name, getattr(spike_waveforms_similarity, attr), self.memory_mode)
+            self._load_sparse_similarity()
 
         t2 = time.perf_counter()
         print('compute_spike_waveforms_similarity', t2-t1)
         
         return self.spike_waveforms_similarity
+    
+    def _load_sparse_similarity(self):
+        # build the csr_matrix on top of the (memmap) arrays
+        if self.spike_waveforms_similarity is None and self.spike_waveforms_similarity_indptr is not None:
+            import scipy.sparse
+            n = self.spike_waveforms_similarity_indptr.size - 1
+            self.spike_waveforms_similarity = scipy.sparse.csr_matrix((self.spike_waveforms_similarity_data,
+                        self.spike_waveforms_similarity_indices, self.spike_waveforms_similarity_indptr), shape=(n, n))
 
-    def compute_cluster_similarity(self, method='cosine_similarity_with_max'):
+    def _cluster_metric_similarity(self, name, labels, data, label_changed):
+        # compute only rows of changed clusters if the previous similarity
+        # has been computed in this session (labels are known)
+        previous = getattr(self, name)
+        if label_changed is not None and previous is not None and name in self._metric_labels:
+            return metrics.update_similarity(previous, self._metric_labels[name], labels, data, label_changed)
+        else:
+            return metrics.cosine_similarity_with_max(data)
+    
+    def compute_cluster_similarity(self, method='cosine_similarity_with_max', label_changed=None):
+        """
+        Similarity between centroids (median) of clusters.
+        
+        If label_changed is given and cluster_similarity already computed,
+        only rows and columns of theses clusters are computed.
+        """
         if not hasattr(self, 'centroids'):
             self.compute_centroid()            
         #~ print('compute_cluster_similarity')
@@ -763,13 +1226,15 @@ class CatalogueConstructor:
         if wfs.size == 0:
             cluster_similarity = None
         else:
-            cluster_similarity = metrics.cosine_similarity_with_max(wfs)
+            cluster_similarity = self._cluster_metric_similarity('cluster_similarity', labels, wfs, label_changed)
 
         if cluster_similarity is None:
             self.arrays.detach_array('cluster_similarity')
             self.cluster_similarity = None
+            self._metric_labels.pop('cluster_similarity', None)
         else:
             self.arrays.add_array('cluster_similarity', cluster_similarity.astype('float32'), self.memory_mode)
+            self._metric_labels['cluster_similarity'] = labels.copy()
 
         t2 = time.perf_counter()
         print('compute_cluster_similarity', t2-t1)
@@ -782,7 +1247,13 @@ class CatalogueConstructor:
         pairs = get_pairs_over_threshold(self.cluster_similarity, self.positive_cluster_labels, threshold)
         return pairs
     
-    def compute_cluster_ratio_similarity(self, method='cosine_similarity_with_max'):
+    def compute_cluster_ratio_similarity(self, method='cosine_similarity_with_max', label_changed=None):
+        """
+        Similarity between centroids normalized by their peak amplitude.
+        
+        If label_changed is given and cluster_ratio_similarity already computed,
+        only rows and columns of theses clusters are computed.
+        """
         #~ print('compute_cluster_ratio_similarity')
         if not hasattr(self, 'centroids'):
             self.compute_centroid()            
@@ -808,13 +1279,16 @@ class CatalogueConstructor:
         else:
             wf_normed_flat = wf_normed.swapaxes(1, 2).reshape(wf_normed.shape[0], -1)
             #~ cluster_ratio_similarity = metrics.compute_similarity(wf_normed_flat, 'cosine_similarity')
-            cluster_ratio_similarity = metrics.cosine_similarity_with_max(wf_normed_flat)
+            cluster_ratio_similarity = self._cluster_metric_similarity('cluster_ratio_similarity',
+                                                    labels, wf_normed_flat, label_changed)
 
         if cluster_ratio_similarity is None:
             self.arrays.detach_array('cluster_ratio_similarity')
             self.cluster_ratio_similarity = None
+            self._metric_labels.pop('cluster_ratio_similarity', None)
         else:
             self.arrays.add_array('cluster_ratio_similarity', cluster_ratio_similarity.astype('float32'), self.memory_mode)
+            self._metric_labels['cluster_ratio_similarity'] = labels.copy()
         #~ return labels, ratio_similarity, wf_normed_flat
 
 
@@ -828,7 +1302,14 @@ class CatalogueConstructor:
         pairs = get_pairs_over_threshold(self.cluster_ratio_similarity, self.positive_cluster_labels, threshold)
         return pairs
     
-    def compute_spike_silhouette(self, size_max=1e7):
+    def compute_spike_silhouette(self, size_max=1e7, method='auto', n_by_cluster=100):
+        """
+        Silhouette of each waveform of some_waveforms (see metrics.compute_silhouette).
+        
+        method: 'auto', 'exact', 'subsample' or 'centroid'
+            'auto' is 'exact' when some_waveforms.size<size_max, otherwise 'subsample'
+            (mean distances estimated on at most n_by_cluster waveforms by cluster).
+        """
         t1 = time.perf_counter()
         
         spike_silhouette = None
@@ -836,8 +1317,11 @@ class CatalogueConstructor:
         if wf is not None:
             wf = wf.reshape(wf.shape[0], -1)
             labels = self.all_peaks['label'][self.some_peaks_index]
-            if wf.size<size_max:
-                spike_silhouette = metrics.compute_silhouette(wf, labels, metric='euclidean')
+            if method == 'auto':
+                method = 'exact' if wf.size<size_max else 'subsample'
+            if 1 < np.unique(labels).size < labels.size:
+                spike_silhouette = metrics.compute_silhouette(wf, labels, metric='euclidean',
+                                            method=method, n_by_cluster=n_by_cluster)
 
         if spike_silhouette is None:
             self.arrays.detach_array('spike_silhouette')
@@ -899,7 +1383,17 @@ class CatalogueConstructor:
         new_cluster = np.concatenate((neg_clusters, pos_clusters))
         self.clusters[:] = new_cluster
     
-    def make_catalogue(self):
+    def make_catalogue(self, sparse_thresh=1.5, radius_um=None):
+        """
+        Construct the catalogue used by the Peeler.
+        
+        Parameters
+        ----------
+        sparse_thresh: (default 1.5) a channel is in the sparse mask of a cluster
+            when the max abs of the median waveform is above this (in MAD units)
+        radius_um: (default None) if not None the sparse mask of a cluster is
+            instead the neighborhood of its max_on_channel given the geometry
+        """
         #TODO: offer possibility to resample some waveforms or choose the number
         
         t1 = time.perf_counter()
@@ -973,6 +1467,20 @@ class CatalogueConstructor:
             center = self.catalogue['centers0'][i,:,:]
             self.catalogue['max_on_channel'][i] = np.argmax(np.abs(center[-n_left,:]), axis=0)
         
+        #sparse channel mask for each cluster: the Peeler only compare a peak
+        # with clusters that have its max channel in their mask
+        sparse_mask = np.zeros((len(cluster_labels), nchan), dtype='bool')
+        if radius_um is not None:
+            neighborhood = get_neighborhood(self.geometry, radius_um)
+        for i, k in enumerate(cluster_labels):
+            chan = self.catalogue['max_on_channel'][i]
+            if radius_um is None:
+                sparse_mask[i, :] = np.max(np.abs(centers0[i, :, :]), axis=0) > sparse_thresh
+            else:
+                sparse_mask[i, :] = neighborhood[chan, :]
+            sparse_mask[i, chan] = True
+        self.catalogue['sparse_mask'] = sparse_mask
+        
         #colors
         if not hasattr(self, 'colors'):
             self.refresh_colors()
@@ -992,8 +1500,8 @@ class CatalogueConstructor:
         
         return self.catalogue
     
-    def save_catalogue(self):
-        self.make_catalogue()
+    def save_catalogue(self, **kargs):
+        self.make_catalogue(**kargs)
         
         #~ filename = os.path.join(self.catalogue_path, 'initial_catalogue.pickle')
         #~ with open(filename, mode='wb') as f:
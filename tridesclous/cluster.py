@@ -9,17 +9,30 @@ import sklearn.metrics
 
 import scipy.signal
 import scipy.stats
+import scipy.sparse
 
 from . import labelcodes
 from .tools import median_mad
 
 
-import matplotlib.pyplot as plt
 
-
-def find_clusters(catalogueconstructor, method='kmeans', selection=None, **kargs):
+def find_clusters(catalogueconstructor, method='kmeans', selection=None, space='some_features', **kargs):
+    """
+    space: 'some_features' or 'all_features'
+        'some_features': cluster the nb_max peaks of some_features, other peaks
+        are LABEL_UNCLASSIFIED.
+        'all_features': cluster all peaks from all_features (see
+        CatalogueConstructor.extract_all_features), only for the methods
+        that work by block on a memmap ('minibatchkmeans', 'sparse_dbscan').
+        Peaks with NaN features (too close to borders) are LABEL_UNCLASSIFIED.
+    """
     cc = catalogueconstructor
     
+    if space == 'all_features':
+        return _find_clusters_all_features(cc, method, selection, **kargs)
+    elif space != 'some_features':
+        raise ValueError('find_clusters space unknown {}'.format(space))
+    
     if selection is None:
         features = cc.some_features
         waveforms = cc.some_waveforms
@@ -44,6 +57,10 @@ def find_clusters(catalogueconstructor, method='kmeans', selection=None, **kargs
     elif method == 'dbscan':
         dbscan = sklearn.cluster.DBSCAN(**kargs)
         labels = dbscan.fit_predict(features)
+    elif method == 'minibatchkmeans':
+        labels = minibatch_kmeans(features, **kargs)
+    elif method == 'sparse_dbscan':
+        labels = sparse_dbscan(features, **kargs)
     elif method == 'dirtycut':
         n_left = cc.info['params_waveformextractor']['n_left']
         n_right = cc.info['params_waveformextractor']['n_right']
@@ -66,7 +83,121 @@ def find_clusters(catalogueconstructor, method='kmeans', selection=None, **kargs
     return labels
 
 
+def _find_clusters_all_features(cc, method, selection, **kargs):
+    assert cc.all_features is not None, 'extract_all_features must be done before'
+    assert cc.all_features.shape[0] == cc.nb_peak, 'all_features is not up to date with all_peaks'
+    
+    if method == 'minibatchkmeans':
+        cluster_func = minibatch_kmeans
+    elif method == 'sparse_dbscan':
+        cluster_func = sparse_dbscan
+    else:
+        raise ValueError('find_clusters method {} not possible with all_features'.format(method))
+    
+    if selection is None:
+        labels = cluster_func(cc.all_features, **kargs)
+        cc.all_peaks['label'][:] = labels
+    else:
+        ind, = np.nonzero(selection)
+        labels = cluster_func(cc.all_features[ind], **kargs)
+        # only real clusters are shifted, LABEL_TRASH and LABEL_UNCLASSIFIED keep their code
+        valid = labels >= 0
+        labels[valid] += max(cc.cluster_labels) + 1
+        cc.all_peaks['label'][ind] = labels
+    
+    return labels
+
 
+def _finite_rows(features, batch_size):
+    # rows of features without NaN, by block so it works on a memmap
+    valid = np.zeros(features.shape[0], dtype='bool')
+    for i0 in range(0, features.shape[0], batch_size):
+        valid[i0:i0+batch_size] = np.all(np.isfinite(features[i0:i0+batch_size]), axis=1)
+    return valid
+
+
+def minibatch_kmeans(features, n_clusters=5, batch_size=10000, n_epoch=3, random_state=0, **kargs):
+    """
+    KMeans for big features arrays (memmap): MiniBatchKMeans is fed with
+    partial_fit on contiguous blocks of batch_size rows (blocks in random order
+    at each epoch) and labels are predicted by block, so only one block is
+    in memory at a time.
+    Rows with NaN (see extract_all_features) are labeled LABEL_UNCLASSIFIED.
+    """
+    n = features.shape[0]
+    km = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                    random_state=random_state, n_init=1, **kargs)
+    # first block must have at least n_clusters rows
+    batch_size = max(batch_size, n_clusters)
+    starts = np.arange(0, n, batch_size)
+    valid = _finite_rows(features, batch_size)
+    rng = np.random.RandomState(random_state)
+    for epoch in range(n_epoch):
+        for i0 in rng.permutation(starts):
+            block = np.asarray(features[i0:i0+batch_size], dtype='float64')
+            block = block[valid[i0:i0+batch_size]]
+            if block.shape[0]<n_clusters and not hasattr(km, 'cluster_centers_'):
+                # the last block can be too small to init
+                continue
+            km.partial_fit(block)
+    
+    labels = np.full(n, labelcodes.LABEL_UNCLASSIFIED, dtype='int64')
+    for i0 in starts:
+        block = np.asarray(features[i0:i0+batch_size], dtype='float64')
+        block_valid = valid[i0:i0+batch_size]
+        if np.any(block_valid):
+            labels[i0:i0+batch_size][block_valid] = km.predict(block[block_valid])
+    return labels
+
+
+def sparse_dbscan(features, eps=0.5, min_samples=5, n_neighbors=30, batch_size=10000):
+    """
+    DBSCAN on a precomputed sparse neighbor graph instead of all neighbors
+    in radius eps (which blow up memory for big and dense features).
+    
+    A KD-tree is built on features and for each point only the n_neighbors
+    nearest neighbors within eps are kept (queried by blocks of batch_size),
+    so memory is bounded by n*n_neighbors.
+    With n_neighbors>=min_samples the core points are exactly those of DBSCAN,
+    connectivity through neighbors beyond the n_neighbors nearest can be lost,
+    so a dense cluster can be split when n_neighbors is too small.
+    Noise points are labeled -1 (LABEL_TRASH) like dbscan.
+    Rows with NaN (see extract_all_features) are labeled LABEL_UNCLASSIFIED.
+    """
+    import sklearn.neighbors
+    
+    valid = _finite_rows(features, batch_size)
+    all_valid = np.all(valid)
+    if not all_valid:
+        valid_ind, = np.nonzero(valid)
+        features = features[valid_ind]
+    
+    n = features.shape[0]
+    k = min(n_neighbors, n)
+    nn = sklearn.neighbors.NearestNeighbors(n_neighbors=k, algorithm='kd_tree')
+    nn.fit(np.asarray(features, dtype='float64'))
+    
+    # CSR built block by block: kneighbors rows are already sorted by row
+    nb_by_row, indices, data = [], [], []
+    for i0 in range(0, n, batch_size):
+        block = np.asarray(features[i0:i0+batch_size], dtype='float64')
+        dist, ind = nn.kneighbors(block, n_neighbors=k)
+        keep = dist<=eps
+        nb_by_row.append(np.sum(keep, axis=1))
+        indices.append(ind[keep].astype('int32'))
+        data.append(dist[keep])
+    indptr = np.zeros(n+1, dtype='int64')
+    indptr[1:] = np.cumsum(np.concatenate(nb_by_row))
+    graph = scipy.sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(n, n))
+    
+    dbscan = sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed')
+    labels = dbscan.fit_predict(graph).astype('int64')
+    
+    if not all_valid:
+        all_labels = np.full(valid.size, labelcodes.LABEL_UNCLASSIFIED, dtype='int64')
+        all_labels[valid_ind] = labels
+        labels = all_labels
+    return labels
 
 
 
@@ -381,6 +512,8 @@ class DirtyCut:
                 count, _ = np.histogram(feat, bins=self.bins)
                 count = count.astype(float)/np.sum(count)
                 
+                import matplotlib.pyplot as plt
+                
                 filename = 'debug_dirtycut/one_cut {}.png'.format(self.n_cut)
                 fig, axs = plt.subplots(nrows=3)
 
@@ -2,13 +2,14 @@ import os, shutil
 import json
 from collections import OrderedDict
 import numpy as np
-import pandas as pd
 from urllib.request import urlretrieve
 import pickle
+import threading
+import queue
 
 from .datasource import data_source_classes
-from .iotools import ArrayCollection
-from .tools import fix_prb_file_py2
+from .iotools import ArrayCollection, WriteBehindWriter
+from .tools import fix_prb_file_py2, bisect_sorted
 
 _signal_types = ['initial', 'processed']
 
@@ -16,6 +17,9 @@ _signal_types = ['initial', 'processed']
 
 
 
+_spike_index_names = ['spikes_labels', 'spikes_label_offsets', 'spikes_label_order']
+
+
 class DataIO:
     """
     
@@ -36,6 +40,7 @@ class DataIO:
     
     def __init__(self, dirname='test'):
         self.dirname = dirname
+        self._writer = None
         if not os.path.exists(dirname):
             os.mkdir(dirname)
         
@@ -245,7 +250,7 @@ class DataIO:
                 arrays = ArrayCollection(parent=None, dirname=self.segments_path[chan_grp][i])
                 self.arrays[chan_grp].append(arrays)
             
-                for name in ['processed_signals', 'spikes']:
+                for name in ['processed_signals', 'spikes'] + _spike_index_names:
                     self.arrays[chan_grp][i].load_if_exists(name)
     
     def get_segment_length(self, seg_num):
@@ -267,6 +272,7 @@ class DataIO:
             data = self.datasource.get_signals_chunk(seg_num=seg_num, i_start=i_start, i_stop=i_stop)
             data = data[:, channels]
         elif signal_type=='processed':
+            self._wait_pending_writes()
             data = self.arrays[chan_grp][seg_num].get('processed_signals')[i_start:i_stop, :]
         else:
             raise(ValueError, 'signal_type is not valide')
@@ -278,22 +284,174 @@ class DataIO:
         elif return_type=='pandas':
             raise(NotImplementedError)
 
-    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, **kargs):
-
+    def iter_over_chunk(self, seg_num=0, chan_grp=0,  i_stop=None, chunksize=1024, i_start=0,
+                        prefetch=0, prefetch_block=None, **kargs):
+        """
+        Iterate over a segment chunk by chunk and yield (i_stop, sigs_chunk).
+        
+        With prefetch>0 the chunks are read in a background thread up to
+        prefetch chunks ahead (bounded queue), so reading overlaps with
+        the processing of the previous chunks. The thread reads contiguous
+        blocks of prefetch_block chunks (default prefetch) from the source
+        and slices them in chunks.
+        """
         if i_stop is not None:
             length = min(self.get_segment_shape(seg_num, chan_grp=chan_grp)[0], i_stop)
         else:
             length = self.get_segment_shape(seg_num, chan_grp=chan_grp)[0]
         
         #TODO for last chunk append some zeros: maybe: ????
-        nloop = length//chunksize
+        nloop = (length-i_start)//chunksize
+        
+        if prefetch>0:
+            if prefetch_block is None:
+                prefetch_block = prefetch
+            yield from self._iter_over_chunk_prefetch(seg_num, chan_grp, i_start, nloop, chunksize,
+                                    prefetch, prefetch_block, kargs)
+            return
+        
         for i in range(nloop):
-            i_stop = (i+1)*chunksize
-            i_start = i_stop - chunksize
-            sigs_chunk = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop, **kargs)
+            i_stop = i_start + (i+1)*chunksize
+            sigs_chunk = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, i_start=i_stop-chunksize, i_stop=i_stop, **kargs)
             yield  i_stop, sigs_chunk
     
+    def _iter_over_chunk_prefetch(self, seg_num, chan_grp, i_start, nloop, chunksize, prefetch, prefetch_block, kargs):
+        chunk_queue = queue.Queue(maxsize=prefetch)
+        stop_event = threading.Event()
+        
+        def put(item):
+            # return False if the consumer has stopped
+            while not stop_event.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def reader():
+            try:
+                for i in range(0, nloop, prefetch_block):
+                    n = min(prefetch_block, nloop-i)
+                    block_start = i_start + i*chunksize
+                    block = self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp, 
+                                    i_start=block_start, i_stop=block_start+n*chunksize, **kargs)
+                    # force the read now (memmap are lazy)
+                    block = np.array(block)
+                    for j in range(n):
+                        if not put((block_start+(j+1)*chunksize, block[j*chunksize:(j+1)*chunksize])):
+                            return
+            except Exception as e:
+                put(e)
+        
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            for i in range(nloop):
+                item = chunk_queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # also when the consumer stop before the end
+            stop_event.set()
+            thread.join()
+    
+    def get_some_waveforms(self, seg_nums, chan_grp, peak_sample_indexes, n_left, width,
+                    signal_type='processed', out=None, block_size=65536, max_gap=4096):
+        """
+        Cut many snippets signals[ind+n_left:ind+n_left+width, :] in one call.
+        
+        The snippets are sorted by segment and index and the signals are read
+        with big sequential blocks (at most block_size samples, a new block is
+        started when the gap between 2 snippets is bigger than max_gap) instead of
+        one get_signals_chunk per snippet. Snippets are then gathered with
+        vectorized fancy indexing. The output keep the order of peak_sample_indexes.
+        
+        Parameters
+        ----------
+        seg_nums: int or np.array
+            Segment of each snippet (or the same for all).
+        chan_grp: int
+        peak_sample_indexes: np.array
+            Sample index of each peak.
+        n_left: int
+            Offset of the first sample relative to peak index (negative).
+        width: int
+            Number of samples of each snippet.
+        signal_type: 'processed' or 'initial'
+        out: None or array
+            Array of shape (nb, width, nb_channel) to fill (can be a memmap).
+        
+        Returns
+        -------
+        out: np.array of shape (nb, width, nb_channel)
+        """
+        peak_sample_indexes = np.asarray(peak_sample_indexes, dtype='int64')
+        seg_nums = np.broadcast_to(np.asarray(seg_nums, dtype='int64'), peak_sample_indexes.shape)
+        nb = peak_sample_indexes.size
+        
+        if out is None:
+            if signal_type=='processed':
+                dtype = self.arrays[chan_grp][0].get('processed_signals').dtype
+            else:
+                dtype = self.source_dtype
+            out = np.zeros((nb, width, self.nb_channel(chan_grp)), dtype=dtype)
+        assert out.shape[0] == nb
+        if nb == 0:
+            return out
+        
+        order = np.lexsort((peak_sample_indexes, seg_nums))
+        starts = peak_sample_indexes[order] + n_left
+        segs = seg_nums[order]
+        
+        # cut in blocks: a new segment, a big gap or block_size reached
+        new_block = np.zeros(nb, dtype='bool')
+        new_block[0] = True
+        new_block[1:] = (segs[1:]!=segs[:-1]) | (np.diff(starts)>max_gap)
+        run_id = np.cumsum(new_block) - 1
+        run_first = np.flatnonzero(new_block)
+        offset_in_run = starts - starts[run_first[run_id]]
+        block_id = run_id * (int(offset_in_run.max()//block_size) + 1) + offset_in_run//block_size
+        bounds = np.flatnonzero(np.diff(block_id)) + 1
+        bounds = np.concatenate([[0], bounds, [nb]])
+        
+        around = np.arange(width)
+        for b0, b1 in zip(bounds[:-1], bounds[1:]):
+            seg_num = int(segs[b0])
+            i_start = int(starts[b0])
+            i_stop = int(starts[b1-1]) + width
+            if i_start<0:
+                raise ValueError('Snippet out of signal bounds in segment {}'.format(seg_num))
+            block = np.asarray(self.get_signals_chunk(seg_num=seg_num, chan_grp=chan_grp,
+                        i_start=i_start, i_stop=i_stop, signal_type=signal_type))
+            if block.shape[0] != i_stop - i_start:
+                raise ValueError('Snippet out of signal bounds in segment {}'.format(seg_num))
+            local = starts[b0:b1] - i_start
+            out[order[b0:b1]] = block[local[:, None] + around[None, :], :]
+        
+        return out
+    
+    def set_write_behind(self, enabled=True, maxsize=64):
+        """
+        Enable/disable the write-behind mode: set_signals_chunk and
+        append_spikes only queue the data and the writes are done by a
+        background thread (see iotools.WriteBehindWriter).
+        flush_processed_signals and flush_spikes wait for all pending writes
+        and raise errors that happened in the thread.
+        """
+        if enabled and self._writer is None:
+            self._writer = WriteBehindWriter(maxsize=maxsize)
+        elif not enabled and self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+    
+    def _wait_pending_writes(self):
+        if self._writer is not None:
+            self._writer.barrier()
+    
     def reset_processed_signals(self, seg_num=0, chan_grp=0, dtype='float32'):
+        self._wait_pending_writes()
         self.arrays[chan_grp][seg_num].create_array('processed_signals', dtype, 
                             self.get_segment_shape(seg_num, chan_grp=chan_grp), 'memmap')
     
@@ -302,25 +460,137 @@ class DataIO:
 
         if signal_type=='processed':
             data = self.arrays[chan_grp][seg_num].get('processed_signals')
-            data[i_start:i_stop, :] = sigs_chunk
+            if self._writer is not None:
+                self._writer.submit_signals(data, i_start, i_stop, sigs_chunk)
+            else:
+                data[i_start:i_stop, :] = sigs_chunk
         
     def flush_processed_signals(self, seg_num=0, chan_grp=0):
+        self._wait_pending_writes()
         self.arrays[chan_grp][seg_num].flush_array('processed_signals')
     
     def reset_spikes(self, seg_num=0,  chan_grp=0, dtype=None):
         assert dtype is not None
+        self._wait_pending_writes()
         self.arrays[chan_grp][seg_num].initialize_array('spikes', 'memmap', dtype, (-1,))
         
     def append_spikes(self, seg_num=0, chan_grp=0, spikes=None):
         if spikes is None: return
-        self.arrays[chan_grp][seg_num].append_chunk('spikes', spikes)
+        if self._writer is not None:
+            self._writer.submit_append(self.arrays[chan_grp][seg_num], 'spikes', spikes)
+        else:
+            self.arrays[chan_grp][seg_num].append_chunk('spikes', spikes)
         
     def flush_spikes(self, seg_num=0, chan_grp=0):
+        self._wait_pending_writes()
         self.arrays[chan_grp][seg_num].finalize_array('spikes')
+        self._make_spike_index(seg_num=seg_num, chan_grp=chan_grp)
+    
+    def _make_spike_index(self, seg_num=0, chan_grp=0):
+        """
+        Sort spikes by index (in place) and make the persistent index by label
+        next to them:
+          * spikes_labels: unique labels
+          * spikes_label_offsets: spikes of spikes_labels[i] are
+            spikes_label_order[offsets[i]:offsets[i+1]]
+          * spikes_label_order: positions of spikes sorted by label then index
+        """
+        arrays = self.arrays[chan_grp][seg_num]
+        spikes = arrays.get('spikes')
+        if spikes.size>1 and np.any(np.diff(spikes['index'])<0):
+            order = np.argsort(spikes['index'], kind='stable')
+            spikes[:] = spikes[order]
+            if isinstance(spikes, np.memmap):
+                spikes.flush()
+        
+        labels = np.asarray(spikes['label'])
+        order = np.argsort(labels, kind='stable')
+        unique_labels, counts = np.unique(labels, return_counts=True)
+        offsets = np.zeros(unique_labels.size+1, dtype='int64')
+        offsets[1:] = np.cumsum(counts)
+        
+        # memmap of size 0 is not possible
+        memory_mode = 'memmap' if spikes.size>0 else 'ram'
+        arrays.add_array('spikes_labels', unique_labels.astype('int64'), memory_mode)
+        arrays.add_array('spikes_label_offsets', offsets, 'memmap')
+        arrays.add_array('spikes_label_order', order.astype('int64'), memory_mode)
     
-    def get_spikes(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None):
+    def _check_spike_index(self, seg_num=0, chan_grp=0):
+        arrays = self.arrays[chan_grp][seg_num]
+        spikes = arrays.get('spikes')
+        if 'spikes_label_order' not in arrays.keys() or arrays.get('spikes_label_order').size != spikes.size:
+            # old working dir without index
+            self._make_spike_index(seg_num=seg_num, chan_grp=chan_grp)
+    
+    def get_spikes(self, seg_num=0, chan_grp=0, i_start=None, i_stop=None,
+                        t_start=None, t_stop=None, labels=None):
+        """
+        Get spikes of one segment.
+        
+        i_start/i_stop are positions in the spikes array (as a slice).
+        
+        t_start/t_stop (in seconds) and labels (list of cluster labels) select
+        spikes with the spike index (see _make_spike_index) in O(log(n) + k).
+        In that case spikes are returned sorted by index.
+        """
+        self._wait_pending_writes()
         spikes = self.arrays[chan_grp][seg_num].get('spikes')
-        return spikes[i_start:i_stop]
+        
+        if t_start is None and t_stop is None and labels is None:
+            return spikes[i_start:i_stop]
+        
+        positions = self.get_spike_positions(seg_num=seg_num, chan_grp=chan_grp,
+                                t_start=t_start, t_stop=t_stop, labels=labels)
+        return spikes[positions]
+    
+    def get_spike_positions(self, seg_num=0, chan_grp=0, t_start=None, t_stop=None, labels=None):
+        """
+        Positions in the spikes array of spikes between t_start and t_stop
+        (seconds) with label in labels. Return a slice when labels is None,
+        otherwise a sorted array of positions.
+        """
+        self._wait_pending_writes()
+        self._check_spike_index(seg_num=seg_num, chan_grp=chan_grp)
+        arrays = self.arrays[chan_grp][seg_num]
+        spike_indexes = arrays.get('spikes')['index']
+        
+        ind_start = None if t_start is None else t_start * self.sample_rate
+        ind_stop = None if t_stop is None else t_stop * self.sample_rate
+        
+        if labels is None:
+            p1 = 0 if ind_start is None else bisect_sorted(spike_indexes, ind_start)
+            p2 = spike_indexes.size if ind_stop is None else bisect_sorted(spike_indexes, ind_stop)
+            return slice(p1, p2)
+        
+        spikes_labels = arrays.get('spikes_labels')
+        offsets = arrays.get('spikes_label_offsets')
+        order = arrays.get('spikes_label_order')
+        positions = []
+        for label in np.atleast_1d(labels):
+            i = bisect_sorted(spikes_labels, label)
+            if i>=spikes_labels.size or spikes_labels[i]!=label:
+                continue
+            lo, hi = int(offsets[i]), int(offsets[i+1])
+            p1 = lo if ind_start is None else bisect_sorted(spike_indexes, ind_start, lo=lo, hi=hi, indexer=order)
+            p2 = hi if ind_stop is None else bisect_sorted(spike_indexes, ind_stop, lo=lo, hi=hi, indexer=order)
+            positions.append(np.asarray(order[p1:p2]))
+        
+        if len(positions)==0:
+            return np.zeros(0, dtype='int64')
+        positions = np.concatenate(positions)
+        positions.sort()
+        return positions
+    
+    def get_spike_label_count(self, seg_num=0, chan_grp=0):
+        """
+        Return (labels, counts) of spikes using the spike index (no pass on spikes).
+        """
+        self._wait_pending_writes()
+        self._check_spike_index(seg_num=seg_num, chan_grp=chan_grp)
+        arrays = self.arrays[chan_grp][seg_num]
+        labels = np.array(arrays.get('spikes_labels'))
+        counts = np.diff(arrays.get('spikes_label_offsets'))
+        return labels, counts
     
     def save_catalogue(self, catalogue, name='initial'):
         catalogue = dict(catalogue)
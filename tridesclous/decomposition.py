@@ -1,4 +1,5 @@
 import numpy as np
+import concurrent.futures
 
 import sklearn
 import sklearn.decomposition
@@ -79,67 +80,135 @@ class PeakMaxOnChannel:
         return features
 
 
-class PcaByChannel:
-    def __init__(self, waveforms, catalogueconstructor=None, n_components_by_channel=3, **params):
+def _batched_pca(data, n_components):
+    """
+    Exact PCA of a stack of datasets data (nb_batch, n, dim) with one batched
+    covariance and eigen decomposition (in float64).
+    
+    The sign of each component is fixed (the largest absolute coefficient is
+    positive like sklearn svd_flip) so the result is reproducible.
+    
+    Returns means (nb_batch, dim) and components (nb_batch, n_components, dim).
+    """
+    data = np.asarray(data, dtype='float64')
+    means = np.mean(data, axis=1)
+    data = data - means[:, None, :]
+    cov = np.matmul(data.transpose(0, 2, 1), data)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    # eigh is ascending
+    components = eigvecs[:, :, ::-1][:, :, :n_components].transpose(0, 2, 1).copy()
+    ind = np.argmax(np.abs(components), axis=2)
+    signs = np.sign(np.take_along_axis(components, ind[:, :, None], axis=2))
+    signs[signs==0] = 1.
+    components *= signs
+    return means, components
+
+
+class _PcaByNeighborhood:
+    """
+    One PCA for each channel on the waveforms of its neighbors.
+    
+    Channels with the same number of neighbors are stacked and fitted with
+    one batched PCA (by blocks of channels to bound memory with max_bytes),
+    blocks are distributed in a thread pool when n_jobs>1 (numpy release the GIL).
+    transform is also one batched matmul by block.
+    """
+    def _fit(self, waveforms, neighbors, n_components, n_jobs=1, max_bytes=2**27):
+        nb_channel = waveforms.shape[2]
+        self.nb_channel = nb_channel
+        self.n_components = n_components
+        self.max_bytes = max_bytes
+        
+        sizes = np.array([np.sum(neighbors[c]) for c in range(nb_channel)])
+        if n_components>np.min(sizes)*waveforms.shape[1]:
+            raise ValueError('n_components must be <= nb neighbors * width')
+        
+        blocks = []
+        for size in np.unique(sizes):
+            channels,  = np.nonzero(sizes==size)
+            neighbors_index = np.array([np.nonzero(neighbors[c])[0] for c in channels], dtype='int64')
+            dim = waveforms.shape[1] * size
+            nb_by_block = max(1, int(max_bytes // (8 * (waveforms.shape[0]*dim + dim*dim))))
+            for i in range(0, channels.size, nb_by_block):
+                blocks.append((channels[i:i+nb_by_block], neighbors_index[i:i+nb_by_block]))
+        
+        def fit_block(block):
+            channels, neighbors_index = block
+            return _batched_pca(self._stack(waveforms, neighbors_index), n_components)
+        
+        if n_jobs == 1:
+            results = [fit_block(block) for block in blocks]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(fit_block, blocks))
+        
+        self.blocks = []
+        for (channels, neighbors_index), (means, components) in zip(blocks, results):
+            self.blocks.append((channels, neighbors_index, means, components))
+    
+    def _stack(self, waveforms, neighbors_index):
+        # (n, width, nb, size) > (nb, n, width*size) same flatten than waveforms[:, :, neighbors]
+        wfs = waveforms[:, :, neighbors_index]
+        nb, size = neighbors_index.shape
+        return wfs.transpose(2, 0, 1, 3).reshape(nb, waveforms.shape[0], waveforms.shape[1]*size)
+    
+    def transform(self, waveforms):
+        k = self.n_components
+        n = waveforms.shape[0]
+        all = np.zeros((n, self.nb_channel, k), dtype=waveforms.dtype)
+        if n == 0:
+            return all.reshape(n, -1)
+        for channels, neighbors_index, means, components in self.blocks:
+            dim = means.shape[1]
+            n_by_batch = max(1, int(self.max_bytes // (8 * channels.size * dim)))
+            for i in range(0, n, n_by_batch):
+                data = self._stack(waveforms[i:i+n_by_batch], neighbors_index).astype('float64')
+                data -= means[:, None, :]
+                # (nb, n, dim) x (nb, dim, k)
+                features = np.matmul(data, components.transpose(0, 2, 1))
+                all[i:i+n_by_batch, channels, :] = features.transpose(1, 0, 2)
+        return all.reshape(n, -1)
+
+
+class PcaByChannel(_PcaByNeighborhood):
+    """
+    One PCA by channel (exact PCA, all channels fitted at once with a batched
+    covariance and eigen decomposition).
+    Other params are ignored (kept for compatibility with IncrementalPCA params).
+    """
+    def __init__(self, waveforms, catalogueconstructor=None, n_components_by_channel=3, n_jobs=1, **params):
         cc = catalogueconstructor
         
         self.waveforms = waveforms
         self.n_components_by_channel = n_components_by_channel
-        self.pcas = []
-        for c in range(cc.nb_channel):
-            #~ print('c', c)
-            pca = sklearn.decomposition.IncrementalPCA(n_components=n_components_by_channel, **params)
-            pca.fit(waveforms[:,:,c])
-            self.pcas.append(pca)
+        self._fit(waveforms, np.eye(cc.nb_channel, dtype='bool'), n_components_by_channel, n_jobs=n_jobs)
 
         #In full PcaByChannel n_components_by_channel feature correspond to one channel
         self.channel_to_features = np.zeros((cc.nb_channel, cc.nb_channel*n_components_by_channel), dtype='bool')
         for c in range(cc.nb_channel):
             self.channel_to_features[c, c*n_components_by_channel:(c+1)*n_components_by_channel] = True
-
-    
-    def transform(self, waveforms):
-        n = self.n_components_by_channel
-        all = np.zeros((waveforms.shape[0], waveforms.shape[2]*n), dtype=waveforms.dtype)
-        for c, pca in enumerate(self.pcas):
-            all[:, c*n:(c+1)*n] = pca.transform(waveforms[:, :, c])
-        return all
     
 
 
-class NeighborhoodPca:
-    def __init__(self, waveforms, catalogueconstructor=None, n_components_by_neighborhood=6, radius_um=300., **params):
+class NeighborhoodPca(_PcaByNeighborhood):
+    """
+    One PCA by channel on the neighborhood (radius_um) of the channel (exact PCA,
+    channels with the same number of neighbors are fitted at once).
+    Other params are ignored (kept for compatibility with IncrementalPCA params).
+    """
+    def __init__(self, waveforms, catalogueconstructor=None, n_components_by_neighborhood=6, radius_um=300., n_jobs=1, **params):
         
         cc = catalogueconstructor
         
         self.n_components_by_neighborhood = n_components_by_neighborhood
         self.neighborhood = tools.get_neighborhood(cc.geometry, radius_um)
-        
-        self.pcas = []
-        for c in range(cc.nb_channel):
-            #~ print('c', c)
-            neighbors = self.neighborhood[c, :]
-            pca = sklearn.decomposition.IncrementalPCA(n_components=n_components_by_neighborhood, **params)
-            wfs = waveforms[:,:,neighbors]
-            wfs = wfs.reshape(wfs.shape[0], -1)
-            pca.fit(wfs)
-            self.pcas.append(pca)
+        self._fit(waveforms, self.neighborhood, n_components_by_neighborhood, n_jobs=n_jobs)
 
         #In full NeighborhoodPca n_components_by_neighborhood feature correspond to one channel
         self.channel_to_features = np.zeros((cc.nb_channel, cc.nb_channel*n_components_by_neighborhood), dtype='bool')
         for c in range(cc.nb_channel):
             self.channel_to_features[c, c*n_components_by_neighborhood:(c+1)*n_components_by_neighborhood] = True
 
-    def transform(self, waveforms):
-        n = self.n_components_by_neighborhood
-        all = np.zeros((waveforms.shape[0], waveforms.shape[2]*n), dtype=waveforms.dtype)
-        for c, pca in enumerate(self.pcas):
-            neighbors = self.neighborhood[c, :]
-            wfs = waveforms[:,:,neighbors]
-            wfs = wfs.reshape(wfs.shape[0], -1)
-            all[:, c*n:(c+1)*n] = pca.transform(wfs)
-        return all
-
 
 #~ class PeakMax_and_PCA:
     #~ def __init__(self, waveforms, catalogueconstructor=None, **params):
@@ -1,3 +1,5 @@
+import PyQt5 # this force pyqtgraph to deal with Qt5
+
 #for catalogue window
 from .myqt import QT,mkQApp
 from .cataloguecontroller import CatalogueController
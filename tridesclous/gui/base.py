@@ -1,6 +1,8 @@
 from .myqt import QT
 import pyqtgraph as pg
 
+from ..tools import bisect_sorted
+
 
 class ControllerBase(QT.QObject):
     spike_selection_changed = QT.pyqtSignal()
@@ -49,6 +51,19 @@ class ControllerBase(QT.QObject):
             if view==self.sender(): continue
             view.on_cluster_tag_changed()
 
+    def get_spike_slice(self, seg_num, i_start, i_stop):
+        """
+        Slice of self.spikes for seg_num with i_start<=index<i_stop
+        in O(log(n)). self.spikes must be sorted by segment then index.
+        """
+        segments = self.spikes['segment']
+        indexes = self.spikes['index']
+        lo = bisect_sorted(segments, seg_num, side='left')
+        hi = bisect_sorted(segments, seg_num, side='right', lo=lo)
+        p1 = bisect_sorted(indexes, i_start, lo=lo, hi=hi)
+        p2 = bisect_sorted(indexes, i_stop, lo=p1, hi=hi)
+        return slice(p1, p2)
+
     @property
     def channel_indexes(self):
         channel_group = self.dataio.channel_groups[self.chan_grp]
@@ -156,9 +156,9 @@ class CatalogueController(ControllerBase):
         self.cc.all_peaks['label'][mask] = label
         
         if on_new_cluster:
-            #self.on_new_cluster(label_changed=label_changed)#bug 
-            self.on_new_cluster(label_changed=None)
+            self.on_new_cluster(label_changed=label_changed)
             self.refresh_colors(reset=False)
+        return label_changed
         
     def get_threshold(self):
         threshold = self.cc.info['params_peakdetector']['relative_threshold']
@@ -188,19 +188,25 @@ class CatalogueController(ControllerBase):
     def on_new_cluster(self, label_changed=None):
         """
         label_changed can be remove/add/modify
+        If None all clusters are recomputed.
         """
         if len(self.cc.all_peaks['index']) == 0:
             return
         
-        self.cc.on_new_cluster()
+        self.cc.on_new_cluster(label_changed=label_changed)
         
         self.do_cluster_count()
         
         self.cc.compute_centroid(label_changed=label_changed)
         
-        #reset some metrics
+        #reset some metrics, cluster similarities are updated only for changed clusters
         for name in _persistent_metrics:
-            setattr(self.cc, name, None)
+            if name=='cluster_similarity' and label_changed is not None and self.cc.cluster_similarity is not None:
+                self.cc.compute_cluster_similarity(label_changed=label_changed)
+            elif name=='cluster_ratio_similarity' and label_changed is not None and self.cc.cluster_ratio_similarity is not None:
+                self.cc.compute_cluster_ratio_similarity(label_changed=label_changed)
+            else:
+                setattr(self.cc, name, None)
         
         self.check_plot_attributes()
 
@@ -219,10 +225,9 @@ class CatalogueController(ControllerBase):
         if new_label<0:
             new_label = max(max(self.cluster_labels)+1, 0)
         
-        for k in labels_to_merge:
-            mask = self.spike_label == k
-            self.change_spike_label(mask, new_label, on_new_cluster=False)
-        self.on_new_cluster()
+        mask = np.in1d(self.spike_label, labels_to_merge)
+        label_changed = self.change_spike_label(mask, new_label, on_new_cluster=False)
+        self.on_new_cluster(label_changed=label_changed)
     
     def tag_same_cell(self, labels_to_group):
         self.cc.tag_same_cell(labels_to_group)
@@ -243,9 +248,11 @@ class CatalogueController(ControllerBase):
     def project(self, method='pca', selection=None, **kargs):
         self.cc.project(method=method, selection=selection, **kargs)
     
-    def split_cluster(self, *args,  **kargs): #order_clusters=True,
-        self.cc.split_cluster(*args,  **kargs) #order_clusters=order_clusters,
-        self.on_new_cluster()
+    def split_cluster(self, label, *args,  **kargs): #order_clusters=True,
+        previous_labels = self.cluster_labels.copy()
+        self.cc.split_cluster(label, *args,  **kargs) #order_clusters=order_clusters,
+        new_labels = self.cluster_labels[~np.in1d(self.cluster_labels, previous_labels)]
+        self.on_new_cluster(label_changed=[label]+new_labels.tolist())
         self.refresh_colors(reset = False)
     
     @property
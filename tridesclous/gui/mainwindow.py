@@ -250,7 +250,7 @@ class MainWindow(QT.QMainWindow):
             self.catalogueconstructor.set_preprocessor_params(**p)
             
             t1 = time.perf_counter()
-            self.catalogueconstructor.estimate_signals_noise(seg_num=0, duration=10.)
+            self.catalogueconstructor.estimate_signals_noise(seg_num=0, **d['noise_estimation'])
             t2 = time.perf_counter()
             print('estimate_signals_noise', t2-t1)
             
@@ -323,7 +323,8 @@ class MainWindow(QT.QMainWindow):
             try:
                 initial_catalogue = self.dataio.load_catalogue(chan_grp=self.chan_grp)
                 peeler = Peeler(self.dataio)
-                peeler.change_params(catalogue=initial_catalogue, n_peel_level=d['n_peel_level'])
+                peeler.change_params(catalogue=initial_catalogue, n_peel_level=d['n_peel_level'],
+                                                peakdetector_engine=d['peakdetector_engine'])
                 
                 duration = d['duration'] if d['limit_duration'] else None
                 
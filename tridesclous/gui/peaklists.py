@@ -444,10 +444,10 @@ class ClusterPeakList(WidgetBase):
         self.pc_project_all(selection=self._selected_spikes())
     
     def move_selection_to_trash(self):
-        for k in self.selected_cluster():
-            mask = self.controller.spike_label == k
-            self.controller.change_spike_label(mask, -1, on_new_cluster=False)
-        self.controller.on_new_cluster(label_changed=None)
+        label_changed = self.selected_cluster()
+        mask = np.in1d(self.controller.spike_label, label_changed)
+        self.controller.change_spike_label(mask, -1, on_new_cluster=False)
+        self.controller.on_new_cluster(label_changed=label_changed+[-1])
         self.controller.refresh_colors(reset=False)
         self.refresh()
         self.spike_label_changed.emit()
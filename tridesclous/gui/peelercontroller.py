@@ -40,9 +40,14 @@ class PeelerController(ControllerBase):
         self.spikes = np.concatenate(self.spikes)
         
         self.nb_spike = int(self.spikes.size)
-        self.cluster_labels = np.unique(self.spikes['label'])
         
-        self.cluster_count = { k:np.sum(self.spikes['label']==k) for k in self.cluster_labels}
+        # count with the spike index of each segment (no pass on all spikes)
+        self.cluster_count = {}
+        for i in range(self.dataio.nb_segment):
+            labels, counts = self.dataio.get_spike_label_count(seg_num=i, chan_grp=self.chan_grp)
+            for k, count in zip(labels, counts):
+                self.cluster_count[k] = self.cluster_count.get(k, 0) + int(count)
+        self.cluster_labels = np.array(sorted(self.cluster_count.keys()), dtype='int64')
         
         
         self.cluster_visible = {k:True for k  in self.cluster_labels}
@@ -27,7 +27,8 @@ class Silhouette(WidgetBase):
     """
     **Silhouette**  display the silhouette score.
     
-    Implemented with sklearn. Must compute metrics first.
+    Must compute metrics first. For big catalogues (over size_max) the silhouette
+    is estimated on a subsample of each cluster (silhouette_method 'auto').
     
     See:
       * `Silhouette wikipedia <https://en.wikipedia.org/wiki/Silhouette_(clustering)>`_
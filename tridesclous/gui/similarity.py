@@ -2,6 +2,7 @@ from .myqt import QT
 import pyqtgraph as pg
 
 import numpy as np
+import scipy.sparse
 import matplotlib.cm
 import matplotlib.colors
 
@@ -94,9 +95,16 @@ class SpikeSimilarityView(BaseSimilarityView):
     **Spike similarity view** dispplay the spike-to-spike similarity. Only visible
     cluster are shown.
     
-    If nothing appear means : metrics are not computed yet or the size of the 
-    similarity is too big (over **max__size**).
+    If nothing appear means : metrics are not computed yet.
+    
+    For big catalogues the similarity is a sparse graph (only nearest neighbours
+    of each spike, others are 0) and at most **max_display** spikes are displayed:
+    seed spikes regularly taken in each cluster and their stored neighbours, so
+    that the displayed pairs are the ones in the graph.
     """
+    _params = BaseSimilarityView._params + [
+                      {'name': 'max_display', 'type': 'int', 'value' : 2000},
+        ]
     
     @property
     def similarity(self):
@@ -107,7 +115,7 @@ class SpikeSimilarityView(BaseSimilarityView):
             self.image.hide()
             return
         
-        _max = np.max(self.similarity)
+        _max = self.similarity.max()
         
         cluster_visible = self.controller.cluster_visible
         visibles = [c for c, v in self.controller.cluster_visible.items() if v and c>=0]
@@ -115,11 +123,23 @@ class SpikeSimilarityView(BaseSimilarityView):
         labels = self.controller.spike_label[self.controller.some_peaks_index]
         keep_ind,  = np.nonzero(np.in1d(labels, visibles))
         keep_label = labels[keep_ind]
-        order = np.argsort(keep_label)
+        order = np.argsort(keep_label, kind='mergesort')
         keep_ind = keep_ind[order]
         
+        if keep_ind.size>self.params['max_display']:
+            if scipy.sparse.issparse(self.similarity):
+                keep_ind = select_from_sparse_graph(self.similarity, keep_ind, self.params['max_display'])
+                order = np.argsort(labels[keep_ind], kind='mergesort')
+                keep_ind = keep_ind[order]
+            else:
+                sub = np.linspace(0, keep_ind.size-1, self.params['max_display']).astype('int64')
+                keep_ind = keep_ind[sub]
+        keep_label = labels[keep_ind]
+        
         if keep_ind.size>0:
             s = self.similarity[keep_ind,:][:, keep_ind]
+            if scipy.sparse.issparse(s):
+                s = s.toarray()
             self.image.setImage(s, lut=self.lut, levels=[0, _max])
             self.image.show()
             self.plot.setXRange(0, s.shape[0])
@@ -146,6 +166,32 @@ class SpikeSimilarityView(BaseSimilarityView):
         
 
 
+def select_from_sparse_graph(graph, keep_ind, max_display):
+    """
+    Select at most max_display rows of keep_ind for the display of a sparse
+    similarity graph: seeds regularly taken in keep_ind (sorted by cluster)
+    and their neighbours stored in the graph (only those in keep_ind).
+    A regular subsample would keep almost no pair of neighbours.
+    """
+    nb_neighbors = max(1, graph.nnz // max(graph.shape[0], 1))
+    nb_seed = max(1, max_display // (nb_neighbors + 1))
+    while True:
+        seeds = keep_ind[np.linspace(0, keep_ind.size-1, min(nb_seed, keep_ind.size)).astype('int64')]
+        sub = graph[seeds, :]
+        # each seed followed by its neighbours
+        candidates = np.concatenate([np.concatenate([[seed], sub.indices[sub.indptr[i]:sub.indptr[i+1]]])
+                                        for i, seed in enumerate(seeds)]).astype('int64')
+        candidates = candidates[np.in1d(candidates, keep_ind)]
+        # unique but keep the first occurrence order
+        _, first = np.unique(candidates, return_index=True)
+        candidates = candidates[np.sort(first)]
+        if candidates.size>=max_display or seeds.size==keep_ind.size:
+            break
+        # neighbours shared or not visible: more seeds
+        nb_seed *= 2
+    return candidates[:max_display]
+
+
 class BaseClusterSimilarityView(BaseSimilarityView):
     def refresh(self):
         if self.similarity is None:
@@ -404,7 +404,7 @@ class BaseTraceViewer(WidgetBase):
         # plot peak on signal
         all_spikes = self.controller.spikes
         if len(all_spikes)>0:
-            keep = (all_spikes['segment']==self.seg_num) & (all_spikes['index']>=ind1) & (all_spikes['index']<ind2)
+            keep = self.controller.get_spike_slice(self.seg_num, ind1, ind2)
             spikes_chunk = np.array(all_spikes[keep], copy=True)
             spikes_chunk['index'] -= ind1
             inwindow_ind = spikes_chunk['index']
@@ -507,6 +507,9 @@ class CatalogueTraceViewer(BaseTraceViewer):
     
     """
     def __init__(self, controller=None, signal_type = 'processed', parent=None):
+        if signal_type == 'processed' and not controller.info.get('processed_signals_saved', True):
+            # single pass catalogue: processed signals are not on disk
+            signal_type = 'initial'
         BaseTraceViewer.__init__(self, controller=controller, signal_type=signal_type, parent=parent)
     
     def _create_other_toolbar(self):
@@ -433,7 +433,8 @@ class WaveformViewer(WidgetBase):
     def _refresh_one_spike(self, n_selected):
         #TODO peak the selected peak if only one
         
-        if n_selected!=1 or not self.params['plot_selected_spike']: 
+        if n_selected!=1 or not self.params['plot_selected_spike'] or \
+                    not self.controller.info.get('processed_signals_saved', True):
             self.curve_one_waveform.setData([], [])
             return
         
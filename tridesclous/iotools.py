@@ -3,6 +3,8 @@ import json
 import numpy as np
 import io
 import sys
+import threading
+import queue
 
 class ArrayCollection:
     """
@@ -27,7 +29,11 @@ class ArrayCollection:
         return filename
 
     def flush_json(self):
-        with open(self._fname('arrays', ext='.json'), 'w', encoding='utf8') as f:
+        # write to a tmp file and then rename so that another process
+        # opening the same dirname never read a half written json
+        filename = self._fname('arrays', ext='.json')
+        tmp_filename = filename + '.tmp{}'.format(os.getpid())
+        with open(tmp_filename, 'w', encoding='utf8') as f:
             d = {}
             for name in self._array:
                 if self._array_attr[name]['state']=='a':
@@ -37,7 +43,8 @@ class ArrayCollection:
                 else:
                     dt = self._array[name].dtype.descr
                 d[name] = dict(dtype=dt, shape=list(self._array[name].shape))
-            json.dump(d, f, indent=4)        
+            json.dump(d, f, indent=4)
+        os.replace(tmp_filename, filename)
     
     def _fix_existing(self, name):
         # deal with a bug on windows when creating a memmap in w+
@@ -93,11 +100,13 @@ class ArrayCollection:
     def delete_array(self, name):
         if name not in self._array:
             return
-        #~ if self._array_attr[name]['memory_mode'] == 'memmap':
-            #~ #delete file if exist
-            #~ filename = self._fname(name)
+        memory_mode = self._array_attr[name]['memory_mode']
         self.detach_array(name)
-        raise(NotimplementedError)
+        if memory_mode == 'memmap':
+            #delete file if exist
+            filename = self._fname(name)
+            if os.path.exists(filename):
+                os.remove(filename)
         
         
     def detach_array(self, name):
@@ -198,5 +207,116 @@ class ArrayCollection:
     
     def keys(self):
         return self._array.keys()
+
+
+class WriteBehindWriter:
+    """
+    Background thread that does the writes on disk for DataIO
+    (processed signals chunks in a memmap and chunks appended to an
+    ArrayCollection) so that the processing loop is not stalled by the disk.
+    
+    Writes are queued (bounded queue, so the producer waits when the disk is
+    too slow), and the writes pending in the queue are coalesced: contiguous
+    chunks of the same array and appends to the same array are concatenated
+    and written at once, even when they are interleaved in the queue.
+    
+    barrier() waits until all queued writes are done. An error in the thread
+    is raised in the caller at the next submit or barrier.
+    """
+    def __init__(self, maxsize=64, max_coalesce=32):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.max_coalesce = max_coalesce
+        self._error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def submit_signals(self, arr, i_start, i_stop, data):
+        self._check_error()
+        # copy because some engines give a view on an internal buffer
+        self.queue.put(('signals', arr, i_start, i_stop, np.array(data)))
+    
+    def submit_append(self, collection, name, data):
+        self._check_error()
+        self.queue.put(('append', collection, name, None, np.array(data)))
     
+    def barrier(self):
+        self.queue.join()
+        self._check_error()
     
+    def close(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+    
+    def _check_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+    
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            tasks = [task]
+            while len(tasks)<self.max_coalesce:
+                try:
+                    task = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    # stop after the current writes
+                    self._do_writes(tasks)
+                    self.queue.task_done()
+                    return
+                tasks.append(task)
+            self._do_writes(tasks)
+    
+    def _do_writes(self, tasks):
+        # Group the batch by target: signals by array and contiguous range,
+        # appends by (collection, name). The Peeler alternates signals and
+        # spikes for each chunk so grouping only consecutive tasks would
+        # merge nothing. The order of tasks for one target is kept.
+        groups = []
+        last_signals_run = {}
+        append_groups = {}
+        for task in tasks:
+            if task[0] == 'signals':
+                key = id(task[1])
+                run = last_signals_run.get(key, None)
+                if run is not None and run[-1][3] == task[2]:
+                    run.append(task)
+                else:
+                    run = [task]
+                    groups.append(run)
+                    last_signals_run[key] = run
+            elif task[0] == 'append':
+                key = (id(task[1]), task[2])
+                if key in append_groups:
+                    append_groups[key].append(task)
+                else:
+                    append_groups[key] = [task]
+                    groups.append(append_groups[key])
+        
+        for group in groups:
+            try:
+                if self._error is None:
+                    kind = group[0][0]
+                    if len(group) == 1:
+                        # already a private copy (see submit_*)
+                        data = group[0][4]
+                    else:
+                        data = np.concatenate([task[4] for task in group], axis=0)
+                    if kind == 'signals':
+                        arr = group[0][1]
+                        arr[group[0][2]:group[-1][3]] = data
+                    elif kind == 'append':
+                        collection, name = group[0][1], group[0][2]
+                        collection.append_chunk(name, data)
+            except Exception as e:
+                self._error = e
+            finally:
+                for task in group:
+                    self.queue.task_done()
@@ -1,57 +1,267 @@
 import numpy as np
-import sklearn.metrics.pairwise
 import scipy.spatial
 
-import matplotlib.pyplot as plt
+# sklearn is imported inside functions to keep `import tridesclous` light
+
 
 def compute_similarity(data, method):
     if method in ('cosine_similarity',  'linear_kernel', 'polynomial_kernel',
                     'sigmoid_kernel', 'rbf_kernel', 'laplacian_kernel'):
+        import sklearn.metrics.pairwise
         func = getattr(sklearn.metrics.pairwise, method)
         return func(data)
     else:
         raise(NotImplementedError)
 
 
-def cosine_similarity_with_max(x):
+def compute_similarity_knn(data, method, n_neighbors=100, max_bytes=2**26):
+    """
+    Sparse similarity graph: for each row only the n_neighbors most similar rows
+    (itself included) are kept.
+    
+    The similarity is computed by blocks of rows against all rows, so the memory
+    is bounded by max_bytes for the temporary block (+ the graph itself:
+    data.shape[0]*n_neighbors values), whatever the number of rows.
+    
+    Returns
+    -------
+    similarity: scipy.sparse.csr_matrix (n, n) float32, indices sorted in each row.
+    """
+    import scipy.sparse
+    data = np.asarray(data)
+    n = data.shape[0]
+    k = min(n_neighbors, n)
+    
+    if method == 'cosine_similarity':
+        # normalize once, then each block is a dot product
+        norms = np.sqrt(np.sum(data.astype('float64')**2, axis=1))
+        norms[norms==0] = 1.
+        normed = data / norms[:, None]
+        func = lambda x, y: np.dot(x, y.T)
+        data = normed
+    elif method in ('linear_kernel', 'polynomial_kernel',
+                    'sigmoid_kernel', 'rbf_kernel', 'laplacian_kernel'):
+        import sklearn.metrics.pairwise
+        func = getattr(sklearn.metrics.pairwise, method)
+    else:
+        raise(NotImplementedError)
+    
+    block_size = max(1, int(max_bytes // (n * 8)))
+    indices = np.zeros((n, k), dtype='int64')
+    values = np.zeros((n, k), dtype='float32')
+    for i0 in range(0, n, block_size):
+        i1 = min(i0+block_size, n)
+        sim = func(data[i0:i1], data)
+        if k<n:
+            ind = np.argpartition(-sim, k-1, axis=1)[:, :k]
+        else:
+            ind = np.tile(np.arange(n), (i1-i0, 1))
+        ind.sort(axis=1)
+        indices[i0:i1] = ind
+        values[i0:i1] = np.take_along_axis(sim, ind, axis=1)
+    
+    indptr = np.arange(n+1, dtype='int64') * k
+    return scipy.sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(n, n))
+
+
+def cosine_similarity_with_max(x, rows=None, block_size=256):
     """
     Similar to cosine_similarity but normed by the max(abs) on each dim.
     
     m = np.maximum(np.abs(u), np.abs(v))
     similarity = np.dot(u, v.T)/np.dot(m, m.T)
     
+    Vectorized by blocks of rows: the dot products are one matrix product and
+    the denominator use sum(max(u**2, v**2)) = (|u|**2 + |v|**2 + sum(|u**2 - v**2|))/2
+    where the last term is a cityblock distance (scipy cdist in C).
+    Memory is block_size * x.shape[0] by temporary array.
+    
+    Parameters
+    ----------
+    x: np.array (n, dim)
+    rows: None or array of int
+        If not None only theses rows of the similarity are computed.
+    
+    Returns
+    -------
+    similarity: np.array (n, n) or (len(rows), n) if rows is given.
+        similarity of a row with itself is 1.
     """
-    def func(u, v):
-        #cosine affinity
-        #~ sim_final = np.dot(u, v.T)/(np.sqrt(np.dot(u, u.T))*np.sqrt(np.dot(v, v.T)))
-        
-        #cosine affinity
-        sim_final = np.dot(u, v.T)
-        #~ sim_final /= (np.sqrt(np.dot(u, u.T))*np.sqrt(np.dot(v, v.T)))
-        m = np.maximum(np.abs(u), np.abs(v))
-        sim_final /= np.dot(m, m.T)
-        return sim_final
+    x = np.asarray(x, dtype='float64')
+    n = x.shape[0]
+    if rows is None:
+        rows = np.arange(n)
+    rows = np.asarray(rows, dtype='int64')
     
-    cluster_similarity = scipy.spatial.distance.pdist(x, metric=func)
-    cluster_similarity = scipy.spatial.distance.squareform(cluster_similarity)
-    cluster_similarity += np.eye(cluster_similarity.shape[0])
-    return cluster_similarity
+    x2 = x**2
+    norm2 = np.sum(x2, axis=1)
     
+    similarity = np.zeros((rows.size, n), dtype='float64')
+    for i0 in range(0, rows.size, block_size):
+        r = rows[i0:i0+block_size]
+        dot = np.dot(x[r], x.T)
+        l1 = scipy.spatial.distance.cdist(x2[r], x2, metric='cityblock')
+        similarity[i0:i0+r.size] = dot / ((norm2[r, None] + norm2[None, :] + l1)/2.)
+    similarity[np.arange(rows.size), rows] = 1.
     
+    return similarity
 
 
-def compute_silhouette(data, labels, metric='euclidean'):
+def update_similarity(similarity, labels, new_labels, x, label_changed, func=cosine_similarity_with_max):
+    """
+    Update a similarity matrix between clusters after some clusters changes.
+    Only rows (and columns) of changed or new clusters are computed with func,
+    others are copied from the previous matrix.
+    
+    Parameters
+    ----------
+    similarity: np.array (len(labels), len(labels))
+        Previous similarity.
+    labels: labels of previous similarity
+    new_labels: labels of the new similarity (rows of x)
+    x: np.array (len(new_labels), dim)
+    label_changed: labels that have been modified
+    
+    Returns
+    -------
+    new_similarity: np.array (len(new_labels), len(new_labels))
+    """
+    labels = np.asarray(labels)
+    new_labels = np.asarray(new_labels)
+    n = new_labels.size
+    
+    if labels.size>0:
+        # position of new_labels in labels
+        order = np.argsort(labels)
+        ind = np.searchsorted(labels, new_labels, sorter=order)
+        ind = order[np.clip(ind, 0, labels.size-1)]
+        unchanged = labels[ind]==new_labels
+    else:
+        ind = np.zeros(n, dtype='int64')
+        unchanged = np.zeros(n, dtype='bool')
+    unchanged &= ~np.in1d(new_labels, label_changed)
+    
+    new_similarity = np.zeros((n, n), dtype=similarity.dtype)
+    keep, = np.nonzero(unchanged)
+    new_similarity[np.ix_(keep, keep)] = similarity[np.ix_(ind[keep], ind[keep])]
+    
+    rows, = np.nonzero(~unchanged)
+    if rows.size>0:
+        sim_rows = func(x, rows=rows)
+        new_similarity[rows, :] = sim_rows
+        new_similarity[:, rows] = sim_rows.T
+    
+    return new_similarity
 
-    #~ self.silhouette_avg = silhouette_score(data, labels)
-    silhouette_values = sklearn.metrics.silhouette_samples(data, labels)
-        
-    #~ self.silhouette_by_labels = {}
-    #~ labels_list = np.unique(labels)
-    #~ for k in labels_list:
-        #~ v = silhouette_values[k==labels]
-        #~ v.sort()
-        #~ self.silhouette_by_labels[k] = v
-    #~ silhouette_avg = np.mean(silhouette_values)
+
+def compute_silhouette(data, labels, metric='euclidean', method='exact', n_by_cluster=100, max_bytes=2**26):
+    """
+    Silhouette of each sample (same as sklearn.metrics.silhouette_samples
+    with the euclidean metric) without the N x N distance matrix.
+    
+    Distances are computed by blocks of rows and columns in float64 with
+    |x-y|**2 = |x|**2 + |y|**2 - 2*x.y (one matrix product by block) and directly
+    summed by cluster (another matrix product with the one hot labels), so the
+    memory is bounded by max_bytes whatever the number of samples.
+    
+    Parameters
+    ----------
+    method: 'exact', 'subsample' or 'centroid'
+        'exact': mean distances to all samples of each cluster. O(N**2) time.
+        'subsample': mean distances are estimated on a stratified subsample
+        (at most n_by_cluster samples of each cluster). O(N*K*n_by_cluster) time.
+        'centroid': simplified silhouette, distances to each cluster centroid
+        (mean) instead of mean distances. O(N*K) time.
     
-    return silhouette_values#, silhouette_avg
+    Returns
+    -------
+    silhouette_values: np.array (N, )
+    """
+    assert metric=='euclidean', 'only euclidean metric is implemented'
+    labels = np.asarray(labels)
+    n = data.shape[0]
+    cluster_labels, lab_ind, cluster_sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    nb_cluster = cluster_labels.size
+    if not 1 < nb_cluster < n:
+        raise ValueError('Number of labels is {}. Valid values are 2 to n_samples - 1 (inclusive)'.format(nb_cluster))
+    
+    if method == 'centroid':
+        ref_data = np.zeros((nb_cluster, data.shape[1]), dtype='float64')
+        for i in range(nb_cluster):
+            ref_data[i] = np.mean(data[lab_ind==i], axis=0)
+        ref_ind = None
+        ref_lab_ind = np.arange(nb_cluster)
+    elif method in ('exact', 'subsample'):
+        if method == 'exact':
+            ref_ind = np.arange(n)
+        else:
+            n_by_cluster = max(n_by_cluster, 2)
+            ref_ind = []
+            for i in range(nb_cluster):
+                ind, = np.nonzero(lab_ind==i)
+                if ind.size>n_by_cluster:
+                    ind = np.random.choice(ind, size=n_by_cluster, replace=False)
+                ref_ind.append(ind)
+            ref_ind = np.sort(np.concatenate(ref_ind))
+        ref_data = data
+        ref_lab_ind = lab_ind[ref_ind]
+    else:
+        raise ValueError('method must be exact, subsample or centroid')
+    
+    nb_ref = ref_lab_ind.size
+    ref_counts = np.bincount(ref_lab_ind, minlength=nb_cluster).astype('float64')
+    
+    # temporary arrays by block: distances (block_size**2) and data (block_size*dim) in float64
+    block_size = max(1, int(np.sqrt(max_bytes / 8 / 4)))
+    block_size = min(block_size, max(1, int(max_bytes / 8 / 2 / data.shape[1])))
+    
+    silhouette_values = np.zeros(n, dtype='float64')
+    for r0 in range(0, n, block_size):
+        r1 = min(r0+block_size, n)
+        x = np.asarray(data[r0:r1], dtype='float64')
+        x_norm2 = np.sum(x**2, axis=1)
+        
+        # sum of distance to each cluster
+        dist_sums = np.zeros((r1-r0, nb_cluster), dtype='float64')
+        for c0 in range(0, nb_ref, block_size):
+            c1 = min(c0+block_size, nb_ref)
+            if ref_ind is None:
+                y = ref_data[c0:c1]
+            else:
+                y = np.asarray(ref_data[ref_ind[c0:c1]], dtype='float64')
+            y_norm2 = np.sum(y**2, axis=1)
+            dist = x_norm2[:, None] + y_norm2[None, :] - 2*np.dot(x, y.T)
+            np.maximum(dist, 0., out=dist)
+            np.sqrt(dist, out=dist)
+            if ref_ind is not None:
+                # distance to itself is 0
+                same = np.arange(r0, r1)[:, None] == ref_ind[None, c0:c1]
+                dist[same] = 0.
+            one_hot = np.zeros((c1-c0, nb_cluster), dtype='float64')
+            one_hot[np.arange(c1-c0), ref_lab_ind[c0:c1]] = 1.
+            dist_sums += np.dot(dist, one_hot)
+        
+        own = lab_ind[r0:r1]
+        rows = np.arange(r1-r0)
+        if method == 'centroid':
+            a = dist_sums[rows, own]
+        else:
+            # itself is not counted in its own cluster
+            if method == 'exact':
+                in_ref = np.ones(r1-r0, dtype='bool')
+            else:
+                in_ref = np.in1d(np.arange(r0, r1), ref_ind)
+            n_own = ref_counts[own] - in_ref
+            a = dist_sums[rows, own] / np.maximum(n_own, 1)
+        
+        mean_dist = dist_sums / np.maximum(ref_counts, 1)[None, :]
+        mean_dist[rows, own] = np.inf
+        mean_dist[:, ref_counts==0] = np.inf
+        b = np.min(mean_dist, axis=1)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sil = (b - a) / np.maximum(a, b)
+        sil[cluster_sizes[own]==1] = 0.
+        silhouette_values[r0:r1] = np.nan_to_num(sil)
     
+    return silhouette_values
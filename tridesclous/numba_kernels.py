@@ -0,0 +1,158 @@
+"""
+numba kernels for PeakDetectorEngine_Numba and SignalPreprocessor_Numba.
+
+This module is only imported when a numba engine is used so that
+``import tridesclous`` does not import (and initialize) numba.
+"""
+import numpy as np
+import numba
+
+
+# peak detector
+@numba.jit(nopython=True, cache=True)
+def _numba_sum_rectified(sig, thresh, sign, sum_rectified):
+    # the sum is done in sum_rectified itself to have the same precision
+    # (float32) than np.sum
+    for s in range(sig.shape[0]):
+        sum_rectified[s] = 0
+        for c in range(sig.shape[1]):
+            v = sig[s, c]
+            if sign==1 and v>=thresh:
+                sum_rectified[s] += v
+            elif sign==-1 and v<=-thresh:
+                sum_rectified[s] += v
+
+
+@numba.jit(nopython=True, cache=True)
+def _numba_is_peak(sig_rectified, i, k, thresh, sign):
+    v = sig_rectified[i]
+    if sign==1:
+        if not v>thresh:
+            return False
+        for j in range(1, k+1):
+            if not (v>sig_rectified[i-j] and v>=sig_rectified[i+j]):
+                return False
+    else:
+        if not v<-thresh:
+            return False
+        for j in range(1, k+1):
+            if not (v<sig_rectified[i-j] and v<=sig_rectified[i+j]):
+                return False
+    return True
+
+
+@numba.jit(nopython=True, cache=True)
+def _numba_detect_peaks_in_rectified(sig_rectified, k, thresh, sign, ind_peaks):
+    nb_peak = 0
+    for i in range(k, sig_rectified.size-k):
+        if _numba_is_peak(sig_rectified, i, k, thresh, sign):
+            ind_peaks[nb_peak] = i
+            nb_peak += 1
+    return nb_peak
+
+
+@numba.jit(nopython=True, cache=True)
+def _numba_detect_peaks_in_chunk(sig, k, thresh, sign, sum_rectified, ind_peaks):
+    # sum for sample s and extremum test for sample s-k in the same loop
+    nb_peak = 0
+    for s in range(sig.shape[0]):
+        sum_rectified[s] = 0
+        for c in range(sig.shape[1]):
+            v = sig[s, c]
+            if sign==1 and v>=thresh:
+                sum_rectified[s] += v
+            elif sign==-1 and v<=-thresh:
+                sum_rectified[s] += v
+        i = s - k
+        if i>=k and _numba_is_peak(sum_rectified, i, k, thresh, sign):
+            ind_peaks[nb_peak] = i
+            nb_peak += 1
+    return nb_peak
+
+
+# signal preprocessor
+@numba.jit(nopython=True, cache=True)
+def _numba_forward_sosfilt(coefficients, chunk, zi, out):
+    # same as scipy.signal.sosfilt (in float64) on chunk casted to float32
+    nb_section = coefficients.shape[0]
+    for s in range(chunk.shape[0]):
+        for c in range(chunk.shape[1]):
+            x_cur = np.float64(np.float32(chunk[s, c]))
+            for sec in range(nb_section):
+                x_new = coefficients[sec, 0] * x_cur + zi[sec, 0, c]
+                zi[sec, 0, c] = coefficients[sec, 1] * x_cur - coefficients[sec, 4] * x_new + zi[sec, 1, c]
+                zi[sec, 1, c] = coefficients[sec, 2] * x_cur - coefficients[sec, 5] * x_new
+                x_cur = x_new
+            out[s, c] = x_cur
+
+
+@numba.jit(nopython=True, cache=True)
+def _numba_select(a, k):
+    # in place quickselect: a[k] is the k-th smallest, smaller are on the left
+    left = 0
+    right = a.size - 1
+    while right>left:
+        pivot = a[(left+right)//2]
+        i = left
+        j = right
+        while i<=j:
+            while a[i]<pivot:
+                i += 1
+            while a[j]>pivot:
+                j -= 1
+            if i<=j:
+                a[i], a[j] = a[j], a[i]
+                i += 1
+                j -= 1
+        if k<=j:
+            right = j
+        elif k>=i:
+            left = i
+        else:
+            break
+
+
+@numba.jit(nopython=True, cache=True)
+def _numba_backward_sosfilt_car_normalize(coefficients, backward_chunk, zi, out, 
+                    common_ref_removal, normalize, medians, mads, tmp_row):
+    # backward filter from the end of backward_chunk, only the first out.shape[0]
+    # samples are kept. As soon as one sample is filtered on all channels
+    # the common reference is removed and it is normalized.
+    nb_section = coefficients.shape[0]
+    nb_channel = backward_chunk.shape[1]
+    n_out = out.shape[0]
+    half = np.float32(0.5)
+    for s in range(backward_chunk.shape[0]-1, -1, -1):
+        for c in range(nb_channel):
+            x_cur = np.float64(backward_chunk[s, c])
+            for sec in range(nb_section):
+                x_new = coefficients[sec, 0] * x_cur + zi[sec, 0, c]
+                zi[sec, 0, c] = coefficients[sec, 1] * x_cur - coefficients[sec, 4] * x_new + zi[sec, 1, c]
+                zi[sec, 1, c] = coefficients[sec, 2] * x_cur - coefficients[sec, 5] * x_new
+                x_cur = x_new
+            if s<n_out:
+                out[s, c] = x_cur
+        
+        if s>=n_out:
+            continue
+        
+        if common_ref_removal:
+            for c in range(nb_channel):
+                tmp_row[c] = out[s, c]
+            m = nb_channel // 2
+            _numba_select(tmp_row, m)
+            if nb_channel % 2 == 1:
+                med = tmp_row[m]
+            else:
+                # after selection the m-1 th is the max of the left part
+                left = tmp_row[0]
+                for c in range(1, m):
+                    if tmp_row[c]>left:
+                        left = tmp_row[c]
+                med = (left + tmp_row[m]) * half
+            for c in range(nb_channel):
+                out[s, c] -= med
+        
+        if normalize:
+            for c in range(nb_channel):
+                out[s, c] = (out[s, c] - medians[c]) / mads[c]
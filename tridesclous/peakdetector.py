@@ -3,6 +3,8 @@ Here 2 version for
 
 """
 
+import importlib.util
+
 import numpy as np
 
 #~ from pyacq.core.stream.ringbuffer import RingBuffer
@@ -15,6 +17,9 @@ try:
 except ImportError:
     HAVE_PYOPENCL = False
 
+# numba is imported (see numba_kernels) only when the numba engine is used
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
 
 def detect_peaks_in_chunk(sig, k, thresh, peak_sign):
     sig = sig.copy()
@@ -53,6 +58,75 @@ def _detect_peaks_in_rectified(sig_rectified, k, thresh, peak_sign):
     return ind_peaks
 
 
+def get_peak_candidates(sig, floor):
+    """
+    Sparse representation of a normalized chunk for peak re-detection:
+    all samples with abs(value)>=floor.
+
+    For any threshold>=floor the rectified sum only depends on these samples,
+    so detect_peaks_in_candidates give exactly the same peaks than
+    detect_peaks_in_chunk without reading the signals again.
+
+    Returns indexes, channels, values sorted by index then channel.
+    """
+    indexes, channels = np.nonzero(np.abs(sig)>=floor)
+    return indexes, channels, sig[indexes, channels]
+
+
+def detect_peaks_in_candidates(indexes, channels, values, nb_channel, k, thresh, peak_sign):
+    """
+    Same as detect_peaks_in_chunk but on candidates given by get_peak_candidates
+    (with floor<=thresh). indexes must be sorted.
+
+    The rectified sum is non zero only on samples that have candidates, so
+    the local extremum over +-k samples is tested only against the (at most k)
+    non zero neighbours on each side.
+
+    Returns the peak indexes (no border removed).
+    """
+    if peak_sign == '+':
+        keep = values>=thresh
+    else:
+        keep = values<=-thresh
+    indexes, channels, values = indexes[keep], channels[keep], values[keep]
+
+    times, inv = np.unique(indexes, return_inverse=True)
+    # same dense rows than detect_peaks_in_chunk so that the float sum is identical
+    rectified = np.zeros((times.size, nb_channel), dtype=values.dtype)
+    rectified[inv, channels] = values
+    if nb_channel>1:
+        sum_rectified = np.sum(rectified, axis=1)
+    else:
+        sum_rectified = rectified[:, 0]
+
+    if peak_sign == '+':
+        peaks = sum_rectified>thresh
+    else:
+        peaks = sum_rectified<-thresh
+
+    n = times.size
+    for d in range(1, k+1):
+        # neighbours at rank d on the right and left (if not too far)
+        near = np.zeros(n, dtype='bool')
+        near[:n-d] = (times[d:] - times[:n-d])<=k
+        if not np.any(near):
+            break
+        right = np.ones(n, dtype='bool')
+        left = np.ones(n, dtype='bool')
+        if peak_sign == '+':
+            right[:n-d] = sum_rectified[:n-d]>=sum_rectified[d:]
+            left[d:] = sum_rectified[d:]>sum_rectified[:n-d]
+        else:
+            right[:n-d] = sum_rectified[:n-d]<=sum_rectified[d:]
+            left[d:] = sum_rectified[d:]<sum_rectified[:n-d]
+        peaks[near] &= right[near]
+        near_left = np.zeros(n, dtype='bool')
+        near_left[d:] = near[:n-d]
+        peaks[near_left] &= left[near_left]
+
+    return times[peaks]
+
+
 class PeakDetectorEngine_Numpy:
     def __init__(self, sample_rate, nb_channel, chunksize, dtype,):
         self.sample_rate = sample_rate
@@ -129,6 +203,62 @@ class PeakDetectorEngine_Numpy:
         
 
 
+def detect_peaks_in_chunk_numba(sig, k, thresh, peak_sign):
+    """
+    Same as detect_peaks_in_chunk but rectification, channel summation
+    and local extremum are done in one pass with numba.
+    """
+    assert HAVE_NUMBA, 'numba is not installed'
+    from .numba_kernels import _numba_detect_peaks_in_chunk
+    sig = np.ascontiguousarray(sig)
+    sign = {'+':1, '-':-1}[peak_sign]
+    sum_rectified = np.zeros(sig.shape[0], dtype=sig.dtype)
+    ind_peaks = np.zeros(sig.shape[0], dtype='int64')
+    nb_peak = _numba_detect_peaks_in_chunk(sig, k, thresh, sign, sum_rectified, ind_peaks)
+    return ind_peaks[:nb_peak]
+
+
+class PeakDetectorEngine_Numba(PeakDetectorEngine_Numpy):
+    """
+    Same as PeakDetectorEngine_Numpy but rectification, channel summation and
+    local extremum are done with numba without temporary arrays.
+    """
+    def __init__(self, sample_rate, nb_channel, chunksize, dtype,):
+        assert HAVE_NUMBA, 'numba is not installed'
+        PeakDetectorEngine_Numpy.__init__(self, sample_rate, nb_channel, chunksize, dtype)
+        from . import numba_kernels
+        self.kernels = numba_kernels
+    
+    def process_data(self, pos, newbuf):
+        newbuf = np.ascontiguousarray(newbuf)
+        n = newbuf.shape[0]
+        sum_rectified = self.sum_rectified[:n]
+        self.kernels._numba_sum_rectified(newbuf, self.relative_threshold, self.sign, sum_rectified)
+        self.fifo_sum_rectified.new_chunk(sum_rectified, pos)
+        
+        k = self.n_span
+        if pos-(n+2*k)<0:
+            # the very first buffer is sacrified because of peak span
+            return None, None
+        
+        sig_rectified = self.fifo_sum_rectified.get_data(pos-(n+2*k), pos)
+        nb_peak = self.kernels._numba_detect_peaks_in_rectified(sig_rectified, k, self.relative_threshold, self.sign, self.ind_peaks)
+        
+        if nb_peak>0:
+            ind_peaks = self.ind_peaks[:nb_peak] + pos - n -2*k
+            self.n_peak += ind_peaks.size
+            return self.n_peak, ind_peaks
+
+        return None, None
+    
+    def change_params(self, peak_sign=None, relative_threshold=None, peak_span=None):
+        PeakDetectorEngine_Numpy.change_params(self, peak_sign=peak_sign, 
+                    relative_threshold=relative_threshold, peak_span=peak_span)
+        self.sign = {'+':1, '-':-1}[self.peak_sign]
+        self.sum_rectified = np.zeros(self.chunksize, dtype=self.dtype)
+        self.ind_peaks = np.zeros(self.chunksize, dtype='int64')
+
+
 class PeakDetectorEngine_OpenCL:
     """
     Same as PeakDetectorEngine but implemented with OpenCl.
@@ -291,6 +421,7 @@ class PeakDetectorEngine_OpenCL:
     """
 
 
-peakdetector_engines = { 'numpy' : PeakDetectorEngine_Numpy, 'opencl' : PeakDetectorEngine_OpenCL}
+peakdetector_engines = { 'numpy' : PeakDetectorEngine_Numpy, 'opencl' : PeakDetectorEngine_OpenCL,
+                'numba' : PeakDetectorEngine_Numba}
 
 
@@ -2,17 +2,18 @@ import os
 import json
 from collections import OrderedDict
 import time
+import concurrent.futures
 
 import numpy as np
 import scipy.signal
 
 
 from . import signalpreprocessor
-from .peakdetector import  detect_peaks_in_chunk
+from .peakdetector import  detect_peaks_in_chunk, detect_peaks_in_chunk_numba
 from . import waveformextractor
+from .tools import FifoBuffer
+from .dataio import DataIO
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 
 try:
@@ -58,13 +59,33 @@ class Peeler:
 
     def change_params(self, catalogue=None, n_peel_level=2,chunksize=1024, 
                                         internal_dtype='float32', 
-                                        #~ signalpreprocessor_engine='numpy',
+                                        use_sparse_template=False,
+                                        peakdetector_engine='numpy',
+                                        signalpreprocessor_engine='numpy',
+                                        prefetch=0,
+                                        write_behind=False,
                                         ):
         assert catalogue is not None
         self.catalogue = catalogue
+        self.peakdetector_engine = peakdetector_engine
+        self.signalpreprocessor_engine = signalpreprocessor_engine
+        # number of chunks read ahead in a background thread (0=no thread)
+        self.prefetch = prefetch
+        # processed signals and spikes written on disk by a background thread
+        self.write_behind = write_behind
+        if peakdetector_engine == 'numpy':
+            self.detect_peaks_in_chunk = detect_peaks_in_chunk
+        elif peakdetector_engine == 'numba':
+            self.detect_peaks_in_chunk = detect_peaks_in_chunk_numba
+        else:
+            raise ValueError('peakdetector_engine {} not supported by Peeler'.format(peakdetector_engine))
         self.n_peel_level = n_peel_level
         self.chunksize = chunksize
         self.internal_dtype= internal_dtype
+        # opt-in: channel-restricted matching changes the sorting results
+        # (a peak on a channel in no sparse_mask stays unclassified)
+        # old catalogue do not have sparse_mask
+        self.use_sparse_template = use_sparse_template and 'sparse_mask' in self.catalogue
         
         # precompute some value for jitter estimation
         n = self.catalogue['cluster_labels'].size
@@ -79,7 +100,16 @@ class Peeler:
 
             self.catalogue['wf1_norm2'][i] = wf1.dot(wf1)
             self.catalogue['wf2_norm2'][i] = wf2.dot(wf2)
-            self.catalogue['wf1_dot_wf2'][i] = wf1.dot(wf2)        
+            self.catalogue['wf1_dot_wf2'][i] = wf1.dot(wf2)
+        
+        # precompute flatten centers and their norm for batch classification
+        centers0 = self.catalogue['centers0']
+        self.catalogue['centers0_flat'] = np.ascontiguousarray(centers0.reshape(centers0.shape[0], -1))
+        self.catalogue['centers0_norm2'] = np.sum(self.catalogue['centers0_flat']**2, axis=1)
+        
+        self.catalogue['use_sparse_template'] = self.use_sparse_template
+        if self.use_sparse_template:
+            self.catalogue['sparse_candidates'] = make_sparse_candidates(self.catalogue)
     
     def process_one_chunk(self,  pos, sigs_chunk):
         abs_head_index, preprocessed_chunk = self.signalpreprocessor.process_data(pos, sigs_chunk)
@@ -89,10 +119,9 @@ class Peeler:
         if preprocessed_chunk is  None:
             return
         
-        #shift rsiruals buffer and put the new one on right side
-        n = self.fifo_residuals.shape[0]-preprocessed_chunk.shape[0]
-        self.fifo_residuals[:n,:] = self.fifo_residuals[-n:,:]
-        self.fifo_residuals[n:,:] = preprocessed_chunk
+        #put the new chunk on right side of residuals fifo (no shift copy)
+        self.fifo_residuals_buffer.new_chunk(preprocessed_chunk, abs_head_index)
+        self.fifo_residuals = self.fifo_residuals_buffer.buffer
         
         # relation between inside chunk index and abs index
         shift = abs_head_index - self.fifo_residuals.shape[0]
@@ -100,15 +129,14 @@ class Peeler:
         all_spikes = []
         for level in range(self.n_peel_level):
             #detect peaks
-            local_index = detect_peaks_in_chunk(self.fifo_residuals, self.n_span, self.relative_threshold, self.peak_sign)
+            local_index = self.detect_peaks_in_chunk(self.fifo_residuals, self.n_span, self.relative_threshold, self.peak_sign)
             #~ print('abs_head_index', abs_head_index, 'shift', shift)
             #~ print('local_index', local_index,  self.fifo_residuals.shape)
             #~ exit()
-            spikes  = classify_and_align(local_index, self.fifo_residuals, self.catalogue)
+            spikes  = classify_and_align_batch(local_index, self.fifo_residuals, self.catalogue)
             
             good_spikes = spikes.compress(spikes['label']>=0)
-            prediction = make_prediction_signals(good_spikes, self.fifo_residuals.dtype, self.fifo_residuals.shape, self.catalogue)
-            self.fifo_residuals -= prediction
+            subtract_prediction_signals(good_spikes, self.fifo_residuals, self.catalogue)
             
             # for output
             good_spikes['index'] += shift
@@ -137,8 +165,7 @@ class Peeler:
         self.sample_rate = sample_rate
         self.source_dtype = source_dtype
         
-        #~ SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines[self.signalpreprocessor_engine]
-        SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines['numpy']
+        SignalPreprocessor_class = signalpreprocessor.signalpreprocessor_engines[self.signalpreprocessor_engine]
         self.signalpreprocessor = SignalPreprocessor_class(sample_rate, nb_channel, self.chunksize, source_dtype)
         
         p = dict(self.catalogue['params_signalpreprocessor'])
@@ -160,14 +187,14 @@ class Peeler:
         
         self.total_spike = 0
         
-        self.fifo_residuals = np.zeros((self.n_side+self.chunksize, nb_channel), 
-                                                                dtype=self.internal_dtype)
+        self.fifo_residuals_buffer = FifoBuffer((self.n_side+self.chunksize, nb_channel), self.internal_dtype)
+        self.fifo_residuals = self.fifo_residuals_buffer.buffer
     
     
     def initialize_online_loop(self, sample_rate=None, nb_channel=None, source_dtype=None):
         self._initialize_before_each_segment(sample_rate=sample_rate, nb_channel=nb_channel, source_dtype=source_dtype)
     
-    def run_offline_loop_one_segment(self, seg_num=0, chan_grp=0, duration=None):
+    def run_offline_loop_one_segment(self, seg_num=0, chan_grp=0, duration=None, progressbar=True):
         kargs = {}
         kargs['sample_rate'] = self.dataio.sample_rate
         kargs['nb_channel'] = self.dataio.nb_channel(chan_grp)
@@ -183,30 +210,94 @@ class Peeler:
         
         self.dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=self.internal_dtype)
         self.dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
-
+        if self.write_behind:
+            self.dataio.set_write_behind(True)
+        try:
+            iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
+                                                        i_stop=length, signal_type='initial', return_type='raw_numpy',
+                                                        prefetch=self.prefetch)
+            if HAVE_TQDM and progressbar:
+                iterator = tqdm(iterable=iterator, total=length//self.chunksize)
+            for pos, sigs_chunk in iterator:
+                #~ print(pos, length, pos/length)
+                sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
+                #~ print('ici')
+                #~ print(sig_index)
+                #~ print(preprocessed_chunk.shape)
+                #~ print(total_spike)
+                #~ print(spikes)
+                # save preprocessed_chunk to file
+                # TODO optional ???
+                self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num,chan_grp=chan_grp,
+                            i_start=sig_index-preprocessed_chunk.shape[0], i_stop=sig_index,
+                            signal_type='processed')
+                
+                if spikes is not None and spikes.size>0:
+                    self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=spikes)
+
+            self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
+            self.dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+        finally:
+            # always stop the writer thread, even on error, so that the
+            # DataIO is not left in write-behind mode
+            if self.write_behind:
+                self.dataio.set_write_behind(False)
+
+    def run_offline_loop_one_shard(self, seg_num=0, chan_grp=0, i_start=0, i_stop=None, keep_start=0, keep_stop=None):
+        """
+        Peel the samples [i_start, i_stop[ of one segment but only keep the
+        result for [keep_start, keep_stop[. The samples before keep_start are a
+        warmup for the filter and the residual fifo, the samples after
+        keep_stop let the spikes near keep_stop be fully peeled.
+        
+        processed_signals must already exist (see DataIO.reset_processed_signals)
+        and only [keep_start, keep_stop[ is written in it.
+        Spikes are returned and not written.
+        
+        This is used by run_peeler_time_sharded.
+        """
+        kargs = {}
+        kargs['sample_rate'] = self.dataio.sample_rate
+        kargs['nb_channel'] = self.dataio.nb_channel(chan_grp)
+        kargs['source_dtype'] = self.dataio.source_dtype
+        self._initialize_before_each_segment(**kargs)
+        
+        if i_stop is None:
+            i_stop = self.dataio.get_segment_length(seg_num)
+        if keep_stop is None:
+            keep_stop = i_stop
+        
         iterator = self.dataio.iter_over_chunk(seg_num=seg_num, chan_grp=chan_grp, chunksize=self.chunksize, 
-                                                    i_stop=length, signal_type='initial', return_type='raw_numpy')
-        if HAVE_TQDM:
-            iterator = tqdm(iterable=iterator, total=length//self.chunksize)
-        for pos, sigs_chunk in iterator:
-            #~ print(pos, length, pos/length)
-            sig_index, preprocessed_chunk, total_spike, spikes = self.process_one_chunk(pos, sigs_chunk)
-            #~ print('ici')
-            #~ print(sig_index)
-            #~ print(preprocessed_chunk.shape)
-            #~ print(total_spike)
-            #~ print(spikes)
-            # save preprocessed_chunk to file
-            # TODO optional ???
-            self.dataio.set_signals_chunk(preprocessed_chunk, seg_num=seg_num,chan_grp=chan_grp,
-                        i_start=sig_index-preprocessed_chunk.shape[0], i_stop=sig_index,
-                        signal_type='processed')
+                                        i_start=i_start, i_stop=i_stop, signal_type='initial', return_type='raw_numpy',
+                                        prefetch=self.prefetch)
+        if self.write_behind:
+            self.dataio.set_write_behind(True)
+        all_spikes = []
+        try:
+            for pos, sigs_chunk in iterator:
+                ret = self.process_one_chunk(pos, sigs_chunk)
+                if ret is None:
+                    continue
+                sig_index, preprocessed_chunk, total_spike, spikes = ret
+                
+                n = preprocessed_chunk.shape[0]
+                i0 = max(sig_index - n, keep_start)
+                i1 = min(sig_index, keep_stop)
+                if i1>i0:
+                    self.dataio.set_signals_chunk(preprocessed_chunk[i0-sig_index+n:i1-sig_index+n], 
+                                seg_num=seg_num, chan_grp=chan_grp, i_start=i0, i_stop=i1, signal_type='processed')
+                
+                keep = (spikes['index']>=keep_start) & (spikes['index']<keep_stop)
+                all_spikes.append(spikes[keep])
             
-            if spikes is not None and spikes.size>0:
-                self.dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=spikes)
-
-        self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
-        self.dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+            self.dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
+        finally:
+            if self.write_behind:
+                self.dataio.set_write_behind(False)
+        
+        if len(all_spikes) == 0:
+            return np.zeros(0, dtype=_dtype_spike)
+        return np.concatenate(all_spikes)
 
     def run_offline_all_segment(self, chan_grp=0, duration=None):
         #TODO remove chan_grp here because it is redundant from catalogue['chan_grp']
@@ -218,6 +309,245 @@ class Peeler:
     run = run_offline_all_segment
 
 
+def _run_one_peeler_job(dirname, chan_grp, seg_num, catalogue_name, peeler_params, duration):
+    """
+    Run the Peeler on one (chan_grp, seg_num) in the current process.
+    
+    The DataIO is opened here (and not pickled from the parent) so that
+    each process has its own memmaps and file handles in ArrayCollection.
+    """
+    t1 = time.perf_counter()
+    dataio = DataIO(dirname=dirname)
+    catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, **peeler_params)
+    peeler.run_offline_loop_one_segment(seg_num=seg_num, chan_grp=chan_grp, duration=duration, progressbar=False)
+    t2 = time.perf_counter()
+    
+    result = dict(chan_grp=chan_grp, seg_num=seg_num, nb_spike=peeler.total_spike, run_time=t2-t1)
+    return result
+
+
+def run_peeler_parallel(dataio, chan_grps=None, seg_nums=None, n_jobs=None, duration=None,
+                catalogue_name='initial', peeler_params={}, progress_callback=None):
+    """
+    Run the offline Peeler on several channel groups and segments using
+    a pool of processes. Each (chan_grp, seg_num) is an independent job
+    that opens its own DataIO on dataio.dirname, so results are
+    identical to the serial Peeler.run() for each channel group.
+    
+    Parameters
+    ----------
+    dataio: DataIO
+        Already initialized DataIO with a catalogue for each chan_grp.
+    chan_grps: list or None
+        Channel groups to peel. None means all channel groups.
+    seg_nums: list or None
+        Segments to peel. None means all segments.
+    n_jobs: int or None
+        Number of processes. None means os.cpu_count().
+        n_jobs=1 run all jobs in the current process.
+    duration: float or None
+        Same as Peeler.run_offline_loop_one_segment.
+    catalogue_name: str
+        Name of the catalogue to load for each chan_grp.
+    peeler_params: dict
+        Parameters given to Peeler.change_params (except catalogue).
+    progress_callback: callable or None
+        Called as progress_callback(nb_done, nb_job, result) each time
+        a job is finished (in completion order).
+    
+    Returns
+    -------
+    results: list of dict
+        One dict per job with keys chan_grp, seg_num, nb_spike, run_time,
+        sorted by (chan_grp, seg_num).
+    """
+    if chan_grps is None:
+        chan_grps = list(dataio.channel_groups.keys())
+    if seg_nums is None:
+        seg_nums = list(range(dataio.nb_segment))
+    
+    jobs = [(dataio.dirname, chan_grp, seg_num, catalogue_name, peeler_params, duration)
+                            for chan_grp in chan_grps for seg_num in seg_nums]
+    results = _run_jobs(_run_one_peeler_job, jobs, n_jobs, progress_callback)
+    
+    # the spikes and processed_signals have been rewritten by other DataIO instances
+    dataio._open_processed_data()
+    
+    results = sorted(results, key=lambda r: (r['chan_grp'], r['seg_num']))
+    return results
+
+
+def _run_jobs(func, jobs, n_jobs, progress_callback, get_result=None):
+    """
+    Run func(*args) for each args in jobs with a pool of n_jobs processes
+    (or in the current process when n_jobs==1) and return outputs in jobs order.
+    """
+    nb_job = len(jobs)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, nb_job))
+    if get_result is None:
+        get_result = lambda out: out
+    
+    outputs = [None] * nb_job
+    nb_done = 0
+    if n_jobs == 1:
+        for i, args in enumerate(jobs):
+            outputs[i] = func(*args)
+            nb_done += 1
+            if progress_callback is not None:
+                progress_callback(nb_done, nb_job, get_result(outputs[i]))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(func, *args): i for i, args in enumerate(jobs)}
+            for future in concurrent.futures.as_completed(futures):
+                # an exception in a worker is raised here
+                i = futures[future]
+                outputs[i] = future.result()
+                nb_done += 1
+                if progress_callback is not None:
+                    progress_callback(nb_done, nb_job, get_result(outputs[i]))
+    return outputs
+
+
+def _run_one_peeler_shard(dirname, chan_grp, seg_num, catalogue_name, peeler_params, 
+                    i_start, i_stop, keep_start, keep_stop):
+    t1 = time.perf_counter()
+    dataio = DataIO(dirname=dirname)
+    catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, **peeler_params)
+    spikes = peeler.run_offline_loop_one_shard(seg_num=seg_num, chan_grp=chan_grp, i_start=i_start, i_stop=i_stop,
+                    keep_start=keep_start, keep_stop=keep_stop)
+    t2 = time.perf_counter()
+    
+    result = dict(chan_grp=chan_grp, seg_num=seg_num, keep_start=keep_start, keep_stop=keep_stop,
+                        nb_spike=spikes.size, run_time=t2-t1)
+    return result, spikes
+
+
+def run_peeler_time_sharded(dataio, seg_num=0, chan_grp=0, n_shard=None, n_jobs=None, duration=None,
+                overlap=None, catalogue_name='initial', peeler_params={}, progress_callback=None):
+    """
+    Run the offline Peeler on one long segment split in time shards that are
+    peeled concurrently by a pool of processes.
+    
+    Each shard owns the samples [keep_start, keep_stop[ but is peeled on
+    [keep_start-overlap, keep_stop+overlap[: the left part is a warmup for the
+    forward filter and the residual fifo, the right part let the spikes near
+    keep_stop be fully peeled (backward filter, n_side, several peel levels).
+    Each shard writes its own part of processed_signals, so the memmap is
+    seamless, and the spikes are merged in the parent process.
+    
+    The first shard is exactly the serial run. The other shards are identical
+    to the serial run as soon as the filter transient of the warmup is below
+    the noise, which is the case with the default overlap. Spikes are
+    attributed to the shard that owns their index; a spike found on both sides
+    of a shard border with the same label less than peak_span apart (this only
+    happen if the residual differ slightly) is kept only once.
+    
+    Parameters
+    ----------
+    dataio: DataIO
+        Already initialized DataIO with a catalogue for chan_grp.
+    seg_num: int
+        The segment to peel.
+    chan_grp: int
+        The channel group.
+    n_shard: int or None
+        Number of time shards. None means n_jobs.
+    n_jobs: int or None
+        Number of processes. None means os.cpu_count().
+    duration: float or None
+        Same as Peeler.run_offline_loop_one_segment.
+    overlap: int or None
+        Number of samples peeled on each side of a shard and not kept.
+        None means lostfront_chunksize + n_side + peak_width.
+        It is rounded up to a multiple of chunksize plus one chunk.
+    catalogue_name: str
+        Name of the catalogue to load.
+    peeler_params: dict
+        Parameters given to Peeler.change_params (except catalogue).
+    progress_callback: callable or None
+        Called as progress_callback(nb_done, nb_shard, result) each time
+        a shard is finished.
+    
+    Returns
+    -------
+    results: list of dict
+        One dict per shard with keys chan_grp, seg_num, keep_start, keep_stop,
+        nb_spike, run_time.
+    """
+    catalogue = dataio.load_catalogue(name=catalogue_name, chan_grp=chan_grp)
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=catalogue, **peeler_params)
+    peeler._initialize_before_each_segment(sample_rate=dataio.sample_rate, 
+                nb_channel=dataio.nb_channel(chan_grp), source_dtype=dataio.source_dtype)
+    chunksize = peeler.chunksize
+    
+    if duration is not None:
+        length = int(duration*dataio.sample_rate)
+    else:
+        length = dataio.get_segment_length(seg_num)
+    length -= length%chunksize
+    nb_chunk = length // chunksize
+    
+    if overlap is None:
+        overlap = peeler.signalpreprocessor.lostfront_chunksize + peeler.n_side + catalogue['peak_width']
+    overlap = (int(np.ceil(overlap / chunksize)) + 1) * chunksize
+    
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_shard is None:
+        n_shard = n_jobs
+    n_shard = max(1, min(n_shard, nb_chunk))
+    
+    bounds = np.linspace(0, nb_chunk, n_shard+1).astype('int64') * chunksize
+    jobs = []
+    for k in range(n_shard):
+        keep_start, keep_stop = int(bounds[k]), int(bounds[k+1])
+        i_start = max(0, keep_start - overlap)
+        i_stop = min(length, keep_stop + overlap)
+        jobs.append((dataio.dirname, chan_grp, seg_num, catalogue_name, peeler_params,
+                                i_start, i_stop, keep_start, keep_stop))
+    
+    # shared by all shards, each one write its own part
+    dataio.reset_processed_signals(seg_num=seg_num, chan_grp=chan_grp, dtype=peeler.internal_dtype)
+    dataio.flush_processed_signals(seg_num=seg_num, chan_grp=chan_grp)
+    
+    outputs = _run_jobs(_run_one_peeler_shard, jobs, n_jobs, progress_callback, get_result=lambda out: out[0])
+    results = [result for result, spikes in outputs]
+    all_spikes = [spikes for result, spikes in outputs]
+    
+    # remove duplicated spikes at shard borders
+    for k in range(1, n_shard):
+        left, right = all_spikes[k-1], all_spikes[k]
+        if left.size == 0 or right.size == 0:
+            continue
+        border = int(bounds[k])
+        left_near = left[left['index'] >= border - peeler.n_span]
+        keep = np.ones(right.size, dtype='bool')
+        for i in np.flatnonzero(right['index'] < border + peeler.n_span):
+            same = (left_near['label'] == right[i]['label']) & \
+                    (np.abs(left_near['index'] - right[i]['index']) < peeler.n_span)
+            if np.any(same):
+                keep[i] = False
+        all_spikes[k] = right[keep]
+        results[k]['nb_spike'] = all_spikes[k].size
+    
+    all_spikes = np.concatenate(all_spikes)
+    all_spikes = all_spikes.take(np.argsort(all_spikes['index'], kind='stable'))
+    
+    dataio.reset_spikes(seg_num=seg_num, chan_grp=chan_grp, dtype=_dtype_spike)
+    if all_spikes.size > 0:
+        dataio.append_spikes(seg_num=seg_num, chan_grp=chan_grp, spikes=all_spikes)
+    dataio.flush_spikes(seg_num=seg_num, chan_grp=chan_grp)
+    
+    return results
+
+
 
 
     
@@ -262,7 +592,7 @@ def classify_and_align(local_indexes, residual, catalogue, maximum_jitter_shift=
         # take it if better
         #TODO debug peak shift
         if np.abs(jitter) > 0.5 and label >=0:
-            prev_ind, prev_label, prev_jitter = label, jitter, ind
+            prev_label, prev_jitter, prev_ind = label, jitter, ind
             
             shift = -int(np.round(jitter))
             #~ print('classify_and_align shift', shift)
@@ -319,7 +649,16 @@ def estimate_one_jitter(waveform, catalogue):
       * h2_norm2: error at order2
     """
     
-    cluster_idx = np.argmin(np.sum(np.sum((catalogue['centers0']-waveform)**2, axis = 1), axis = 1))
+    if catalogue.get('use_sparse_template', False):
+        # only clusters that have the peak max channel in their sparse mask
+        peak_chan = _get_peak_channels(waveform[None, -catalogue['n_left'], :], catalogue)[0]
+        candidates, channels, centers_flat, centers_norm2 = catalogue['sparse_candidates'][peak_chan]
+        if candidates.size==0:
+            return LABEL_UNCLASSIFIED, 0.
+        distances = centers_norm2 - 2 * np.dot(centers_flat, waveform[:, channels].flatten())
+        cluster_idx = candidates[np.argmin(distances)]
+    else:
+        cluster_idx = np.argmin(np.sum(np.sum((catalogue['centers0']-waveform)**2, axis = 1), axis = 1))
     k = catalogue['cluster_labels'][cluster_idx]
     chan = catalogue['max_on_channel'][cluster_idx]
     #~ print('cluster_idx', cluster_idx, 'k', k, 'chan', chan)
@@ -381,57 +720,269 @@ def estimate_one_jitter(waveform, catalogue):
         return LABEL_UNCLASSIFIED, 0.
 
 
-def make_prediction_signals(spikes, dtype, shape, catalogue):
-    #~ n_left, peak_width, 
+def classify_and_align_batch(local_indexes, residual, catalogue, maximum_jitter_shift=4):
+    """
+    Same as classify_and_align but all peaks are processed at once
+    instead of one python loop per peak.
+
+    catalogue must contain 'centers0_flat' and 'centers0_norm2'
+    (precomputed in Peeler.change_params).
+
+    local_indexes is index of peaks inside residual and not
+    the absolute peak_pos. So time scaling must be done outside.
+    """
+    width = catalogue['peak_width']
+    n_left = catalogue['n_left']
+    spikes = np.zeros(local_indexes.shape[0], dtype=_dtype_spike)
+    spikes['index'] = local_indexes
+    if local_indexes.size==0:
+        return spikes
+
+    ind = local_indexes + n_left
+    spikes['label'][ind+width>=residual.shape[0]] = LABEL_RIGHT_LIMIT
+    spikes['label'][ind<0] = LABEL_LEFT_LIMIT
+    valid, = np.nonzero((ind>=0) & (ind+width<residual.shape[0]))
+    ind = ind[valid]
+
+    labels, jitters = estimate_jitter_batch(residual, ind, catalogue)
+
+    # if more than one sample of jitter
+    # then we try a peak shift
+    # take it if better
+    shifts = -np.round(jitters).astype('int64')
+    try_shift = (np.abs(jitters) > 0.5) & (labels>=0)
+
+    bad = try_shift & (np.abs(shifts)>maximum_jitter_shift)
+    labels[bad] = LABEL_MAXIMUM_SHIFT
+    try_shift &= ~bad
+
+    shifted_ind = ind + shifts
+    bad = try_shift & (shifted_ind+width>=residual.shape[0])
+    labels[bad] = LABEL_RIGHT_LIMIT
+    try_shift &= ~bad
+
+    bad = try_shift & (shifted_ind<0)
+    labels[bad] = LABEL_LEFT_LIMIT
+    try_shift &= ~bad
+
+    jitters[labels<0] = 0.
+
+    sel, = np.nonzero(try_shift)
+    if sel.size>0:
+        new_labels, new_jitters = estimate_jitter_batch(residual, shifted_ind[sel], catalogue)
+        keep = np.abs(new_jitters)<np.abs(jitters[sel])
+        sel = sel[keep]
+        labels[sel] = new_labels[keep]
+        jitters[sel] = new_jitters[keep]
+        spikes['index'][valid[sel]] += shifts[sel]
+
+    spikes['label'][valid] = labels
+    spikes['jitter'][valid] = jitters
+
+    return spikes
+
+
+def estimate_jitter_batch(residual, indexes, catalogue):
+    """
+    Vectorized version of estimate_one_jitter for several peaks.
+
+    indexes are the start of each waveform in residual (already shifted by n_left)
+    and must be inside residual.
+
+    The nearest cluster is found with one matrix product using:
+    |wf - c|^2 = |wf|^2 - 2 wf.c + |c|^2
+    (|wf|^2 is the same for all clusters so not computed)
+
+    Returns labels and jitters arrays.
+    """
+    n = indexes.size
+    labels = np.zeros(n, dtype='int64')
+    jitters = np.zeros(n, dtype='float64')
+    if n==0:
+        return labels, jitters
+
+    width = catalogue['peak_width']
+    waveforms = residual[indexes[:, None] + np.arange(width)[None, :], :]
+
+    if catalogue.get('use_sparse_template', False):
+        cluster_idx = _nearest_cluster_sparse(waveforms, catalogue)
+    else:
+        flat = waveforms.reshape(n, -1)
+        distances = catalogue['centers0_norm2'][None, :] - 2 * np.dot(flat, catalogue['centers0_flat'].T)
+        cluster_idx = np.argmin(distances, axis=1)
     
+    # peaks with no candidate cluster (sparse case) are not classified
+    labels[:] = LABEL_UNCLASSIFIED
+    found, = np.nonzero(cluster_idx>=0)
+    if found.size>0:
+        labels[found], jitters[found] = _estimate_jitter_for_clusters(waveforms[found], cluster_idx[found], catalogue)
+    
+    return labels, jitters
+
+
+def _estimate_jitter_for_clusters(waveforms, cluster_idx, catalogue):
+    n = waveforms.shape[0]
+    labels = np.zeros(n, dtype='int64')
+    jitters = np.zeros(n, dtype='float64')
+    
+    chans = catalogue['max_on_channel'][cluster_idx]
+
+    wf = waveforms[np.arange(n), :, chans]
+    wf0 = catalogue['centers0'][cluster_idx, :, chans]
+    wf1 = catalogue['centers1'][cluster_idx, :, chans]
+    wf2 = catalogue['centers2'][cluster_idx, :, chans]
+    wf1_norm2 = catalogue['wf1_norm2'][cluster_idx]
+    wf2_norm2 = catalogue['wf2_norm2'][cluster_idx]
+    wf1_dot_wf2 = catalogue['wf1_dot_wf2'][cluster_idx]
+
+    h = wf - wf0
+    h0_norm2 = np.sum(h**2, axis=1)
+    h_dot_wf1 = np.sum(h*wf1, axis=1)
+    jitter0 = h_dot_wf1/wf1_norm2
+    h1_norm2 = np.sum((h-jitter0[:, None]*wf1)**2, axis=1)
+
+    #order 1 is better than order 0
+    order1 = h0_norm2 > h1_norm2
+    jitter1 = np.zeros(n, dtype='float64')
+    j0 = jitter0[order1]
+    h_dot_wf2 = np.sum(h[order1]*wf2[order1], axis=1)
+    rss_first = -2*h_dot_wf1[order1] + 2*j0*(wf1_norm2[order1] - h_dot_wf2) + 3*j0**2*wf1_dot_wf2[order1] + j0**3*wf2_norm2[order1]
+    rss_second = 2*(wf1_norm2[order1] - h_dot_wf2) + 6*j0*wf1_dot_wf2[order1] + 3*j0**2*wf2_norm2[order1]
+    jitter1[order1] = j0 - rss_first/rss_second
+
+    #prediction should be smaller than original (which have noise)
+    #otherwise the prediction is bad
+    j = jitter1[:, None]
+    pred = wf0 + j*wf1 + j**2/2*wf2
+    ok = np.sum(wf**2, axis=1) > np.sum((wf-pred)**2, axis=1)
+
+    labels[:] = LABEL_UNCLASSIFIED
+    labels[ok] = catalogue['cluster_labels'][cluster_idx[ok]]
+    jitters[ok] = jitter1[ok]
+
+    return labels, jitters
+
+
+def _get_peak_channels(peak_values, catalogue):
+    """
+    peak_values is (nb_peak, nb_channel) the value of residual at peak time.
+    """
+    if catalogue['params_peakdetector']['peak_sign'] == '-':
+        return np.argmin(peak_values, axis=1)
+    else:
+        return np.argmax(peak_values, axis=1)
+
+
+def make_sparse_candidates(catalogue):
+    """
+    For each channel, precompute which clusters must be compared
+    to a peak that have its max on this channel, and the centers restricted
+    to the union of the sparse mask of these clusters.
+    Outside its own mask a center is set to zero.
+    
+    Returns a list (one by channel) of (candidates, channels, centers_flat, centers_norm2)
+    """
+    sparse_mask = np.asarray(catalogue['sparse_mask'], dtype='bool')
+    centers0 = catalogue['centers0']
+    nb_channel = centers0.shape[2]
+    sparse_candidates = []
+    for chan in range(nb_channel):
+        candidates, = np.nonzero(sparse_mask[:, chan])
+        channels, = np.nonzero(np.any(sparse_mask[candidates, :], axis=0))
+        centers = centers0[candidates, :, :][:, :, channels] * sparse_mask[candidates, :][:, None, channels]
+        centers_flat = np.ascontiguousarray(centers.reshape(candidates.size, -1))
+        centers_norm2 = np.sum(centers_flat**2, axis=1)
+        sparse_candidates.append((candidates, channels, centers_flat, centers_norm2))
+    return sparse_candidates
+
+
+def _nearest_cluster_sparse(waveforms, catalogue):
+    """
+    Nearest cluster for each waveform but peaks are grouped by max channel
+    and only compared to candidate clusters on their channels.
+    So the cost scale with the unit footprint and not with nb_channel.
+    
+    Returns cluster_idx, -1 when no candidate.
+    """
+    n = waveforms.shape[0]
+    cluster_idx = -np.ones(n, dtype='int64')
+    peak_chans = _get_peak_channels(waveforms[:, -catalogue['n_left'], :], catalogue)
+    for chan in np.unique(peak_chans):
+        candidates, channels, centers_flat, centers_norm2 = catalogue['sparse_candidates'][chan]
+        if candidates.size==0:
+            continue
+        sel, = np.nonzero(peak_chans==chan)
+        flat = waveforms[sel][:, :, channels].reshape(sel.size, -1)
+        distances = centers_norm2[None, :] - 2 * np.dot(flat, centers_flat.T)
+        cluster_idx[sel] = candidates[np.argmin(distances, axis=1)]
+    return cluster_idx
+
+
+def make_prediction_signals(spikes, dtype, shape, catalogue):
     prediction = np.zeros(shape, dtype=dtype)
-    for i in range(spikes.size):
-        k = spikes[i]['label']
-        if k<0: continue
-        
-        #~ cluster_idx = np.nonzero(catalogue['cluster_labels']==k)[0][0]
-        cluster_idx = catalogue['label_to_index'][k]
-        
-        #~ print('make_prediction_signals', 'k', k, 'cluster_idx', cluster_idx)
-        
-        # prediction with no interpolation
-        #~ wf0 = catalogue['centers0'][cluster_idx,:,:]
-        #~ pred = wf0
-        
-        # predict with tailor approximate with derivative
-        #~ wf1 = catalogue['centers1'][cluster_idx,:,:]
-        #~ wf2 = catalogue['centers2'][cluster_idx]
-        #~ pred = wf0 +jitter*wf1 + jitter**2/2*wf2
-        
-        #predict with with precilputed splin
-        r = catalogue['subsample_ratio']
-        pos = spikes[i]['index'] + catalogue['n_left']
-        jitter = spikes[i]['jitter']
-        #TODO debug that sign
-        shift = -int(np.round(jitter))
-        pos = pos + shift
-        
-        #TODO debug that sign
-        #~ if shift >=1:
-            #~ print('jitter', jitter, 'jitter+shift', jitter+shift, 'shift', shift)
-        #~ int_jitter = int((jitter+shift)*r) + r//2
-        int_jitter = int((jitter+shift)*r) + r//2
-        #~ int_jitter = -int((jitter+shift)*r) + r//2
-        
-        #~ assert int_jitter>=0
-        #~ assert int_jitter<r
-        #TODO this is wrong we should move index first
-        #~ int_jitter = max(int_jitter, 0)
-        #~ int_jitter = min(int_jitter, r-1)
-        
-        pred = catalogue['interp_centers0'][cluster_idx, int_jitter::r, :]
-        #~ print(pred.shape)
-        #~ print(int_jitter, spikes[i]['jitter'])
-        
-        
-        #~ print(prediction[pos:pos+catalogue['peak_width'], :].shape)
-        if pos>0 and  pos+catalogue['peak_width']<shape[0]:
-            prediction[pos:pos+catalogue['peak_width'], :] += pred
-        
+    add_prediction_signals(spikes, prediction, catalogue, sign=1)
     return prediction
 
+
+def subtract_prediction_signals(spikes, residual, catalogue):
+    """
+    Same as residual -= make_prediction_signals(...) but in place without
+    allocating a full size prediction array.
+    """
+    add_prediction_signals(spikes, residual, catalogue, sign=-1)
+
+
+def add_prediction_signals(spikes, signals, catalogue, sign=1):
+    """
+    Add (sign=1) or subtract (sign=-1) in place the prediction of all spikes
+    to signals.
+    
+    All template slices are taken from catalogue['interp_centers0'] at once
+    with fancy indexing. When spikes do not overlap they are written with
+    a single fancy indexing, otherwise they are accumulated in place with
+    np.add.at/np.subtract.at.
+    """
+    spikes = spikes[spikes['label']>=0]
+    if spikes.size == 0:
+        return
+    
+    peak_width = catalogue['peak_width']
+    r = catalogue['subsample_ratio']
+    
+    cluster_labels = np.asarray(catalogue['cluster_labels'])
+    sorter = np.argsort(cluster_labels)
+    cluster_idx = sorter[np.searchsorted(cluster_labels, spikes['label'], sorter=sorter)]
+    
+    #predict with with precilputed splin
+    jitter = spikes['jitter']
+    #TODO debug that sign
+    shift = -np.round(jitter).astype('int64')
+    pos = spikes['index'] + catalogue['n_left'] + shift
+    int_jitter = np.trunc((jitter+shift)*r).astype('int64') + r//2
+    int_jitter = np.clip(int_jitter, 0, r-1)
+    
+    keep = (pos>0) & (pos+peak_width<signals.shape[0])
+    if not np.any(keep):
+        return
+    pos, cluster_idx, int_jitter = pos[keep], cluster_idx[keep], int_jitter[keep]
+    
+    # (nb_spike, peak_width, nb_channel)
+    sub_index = int_jitter[:, None] + r * np.arange(peak_width)[None, :]
+    preds = catalogue['interp_centers0'][cluster_idx[:, None], sub_index, :]
+    
+    sample_index = pos[:, None] + np.arange(peak_width)[None, :]
+    sorted_pos = np.sort(pos)
+    if np.all(np.diff(sorted_pos)>=peak_width):
+        # no overlap between spikes: a simple fancy indexing is enough (faster)
+        if sign>=0:
+            signals[sample_index] += preds
+        else:
+            signals[sample_index] -= preds
+    else:
+        # overlapping spikes: unbuffered accumulation directly in signals
+        # (no temporary spanning the first to the last spike)
+        if sign>=0:
+            np.add.at(signals, sample_index, preds)
+        else:
+            np.subtract.at(signals, sample_index, preds)
+
@@ -152,8 +152,7 @@ class Peeler_OpenCl(Peeler):
             spikes  = classify_and_align(local_index, self.fifo_residuals, self.catalogue)
             
             good_spikes = spikes.compress(spikes['label']>=0)
-            prediction = make_prediction_signals(good_spikes, self.fifo_residuals.dtype, self.fifo_residuals.shape, self.catalogue)
-            self.fifo_residuals -= prediction
+            subtract_prediction_signals(good_spikes, self.fifo_residuals, self.catalogue)
             pyopencl.enqueue_copy(self.queue,  self.fifo_residuals_cl, self.fifo_residuals)
             
             # for output
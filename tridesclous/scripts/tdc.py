@@ -6,10 +6,19 @@ Very basic comand line for tridesclous
 import sys
 import os
 import argparse
+import json
+import time
+import concurrent.futures
 
+try:
+    import resource
+    HAVE_RESOURCE = True
+except ImportError:
+    HAVE_RESOURCE = False
 
-import pyqtgraph as pg
 import tridesclous as tdc
+from tridesclous.params import (fullchain_params, features_params_by_methods,
+            cluster_params_by_methods, peeler_params, get_default_params)
 
 comand_list =[
     'mainwin',
@@ -22,7 +31,187 @@ comand_list =[
 txt_command_list = ', '.join(comand_list)
 
 
+def make_default_params():
+    """
+    Default parameters for headless makecatalogue/runpeeler.
+    Same keys and values as the GUI dialogs (fullchain_params, first feature
+    and cluster methods, peeler_params), see tridesclous/params.py.
+    A JSON file given with -p only need to contain the keys to change,
+    each group is updated over the defaults.
+    """
+    params = get_default_params(fullchain_params)
+    params['feature_method'] = list(features_params_by_methods.keys())[0]
+    params['feature_kargs'] = get_default_params(features_params_by_methods[params['feature_method']])
+    params['cluster_method'] = list(cluster_params_by_methods.keys())[0]
+    params['cluster_kargs'] = get_default_params(cluster_params_by_methods[params['cluster_method']])
+    params['trash_small_cluster'] = 10
+    # capture waveforms and noise during run_signalprocessor and do not save processed signals
+    params['single_pass'] = False
+    params['peeler'] = get_default_params(peeler_params)
+    # headless: peel the whole segments by default
+    params['peeler']['limit_duration'] = False
+    return params
+
+default_params = make_default_params()
+
+
+def load_params(filename=None):
+    params = {k: (dict(v) if isinstance(v, dict) else v) for k, v in default_params.items()}
+    if filename is None:
+        return params
+    with open(filename, 'r', encoding='utf8') as f:
+        user_params = json.load(f)
+    for k, v in user_params.items():
+        if k not in params:
+            raise ValueError('Unknown parameter {} in {}'.format(k, filename))
+        if isinstance(params[k], dict) and k not in ('feature_kargs', 'cluster_kargs'):
+            params[k].update(v)
+        else:
+            params[k] = v
+    return params
+
+
+def get_peak_rss():
+    """Peak resident memory in MB of this process and its finished children."""
+    if not HAVE_RESOURCE:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return rss / 1024.**2
+    return rss / 1024.
+
+
+def make_catalogue_one_group(dirname, chan_grp, params):
+    """
+    Run the full catalogue chain (same as MainWindow.initialize_catalogue)
+    for one channel group and save the catalogue.
+    Return a list of (stage, run_time, info) for the timing report.
+    """
+    dataio = tdc.DataIO(dirname=dirname)
+    catalogueconstructor = tdc.CatalogueConstructor(dataio=dataio, chan_grp=chan_grp)
+    
+    report = []
+    def run_stage(name, func, *args, **kargs):
+        t1 = time.perf_counter()
+        func(*args, **kargs)
+        t2 = time.perf_counter()
+        report.append((name, t2-t1, {}))
+    
+    p = {}
+    p.update(params['preprocessor'])
+    p.update(params['peak_detector'])
+    run_stage('set_preprocessor_params', catalogueconstructor.set_preprocessor_params, **p)
+    run_stage('estimate_signals_noise', catalogueconstructor.estimate_signals_noise, seg_num=0,
+                    **params['noise_estimation'])
+    if params['single_pass']:
+        wf_params = params['extract_waveforms']
+        assert wf_params.get('mode', 'rand')=='rand' and not wf_params.get('align_waveform', False), \
+                    'single_pass only for mode=rand and align_waveform=False'
+        capture_waveforms = dict(n_left=wf_params['n_left'], n_right=wf_params['n_right'], nb_max=wf_params['nb_max'],
+                    nb_noise_snippet=params['noise_snippet']['nb_snippet'])
+        run_stage('run_signalprocessor', catalogueconstructor.run_signalprocessor, duration=params['duration'],
+                    capture_waveforms=capture_waveforms, save_processed_signals=False)
+    else:
+        run_stage('run_signalprocessor', catalogueconstructor.run_signalprocessor, duration=params['duration'])
+    
+    nb_sample = 0
+    for seg_num in range(dataio.nb_segment):
+        length = dataio.get_segment_length(seg_num)
+        nb_sample += min(length, int(params['duration']*dataio.sample_rate))
+    report[-1][2]['nb_sample'] = nb_sample
+    report[-1][2]['nb_peak'] = catalogueconstructor.nb_peak
+    
+    if not params['single_pass']:
+        run_stage('extract_some_waveforms', catalogueconstructor.extract_some_waveforms, **params['extract_waveforms'])
+        run_stage('extract_some_noise', catalogueconstructor.extract_some_noise, **params['noise_snippet'])
+    run_stage('extract_some_features', catalogueconstructor.extract_some_features,
+                    method=params['feature_method'], **params['feature_kargs'])
+    run_stage('find_clusters', catalogueconstructor.find_clusters,
+                    method=params['cluster_method'], **params['cluster_kargs'])
+    if params['trash_small_cluster'] > 0:
+        run_stage('trash_small_cluster', catalogueconstructor.trash_small_cluster, n=params['trash_small_cluster'])
+    run_stage('order_clusters', catalogueconstructor.order_clusters)
+    run_stage('save_catalogue', catalogueconstructor.save_catalogue)
+    
+    return chan_grp, report
+
+
+def run_makecatalogue(dirname, chan_grps, params, n_jobs=1):
+    """
+    Run make_catalogue_one_group for all chan_grps with n_jobs processes
+    and print a timing report.
+    """
+    t0 = time.perf_counter()
+    results = []
+    if n_jobs == 1 or len(chan_grps) == 1:
+        for chan_grp in chan_grps:
+            results.append(make_catalogue_one_group(dirname, chan_grp, params))
+            print_catalogue_report(*results[-1])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(make_catalogue_one_group, dirname, chan_grp, params) for chan_grp in chan_grps]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+                print_catalogue_report(*results[-1])
+    t1 = time.perf_counter()
+    
+    nb_sample = sum(info['nb_sample'] for _, report in results for name, _, info in report if 'nb_sample' in info)
+    print('makecatalogue total: {} channel group(s) in {:.2f} s, {:.0f} samples/s, peak RSS {}'.format(
+                    len(chan_grps), t1-t0, nb_sample/(t1-t0), format_rss(get_peak_rss())))
+    return results
+
+
+def print_catalogue_report(chan_grp, report):
+    print('chan_grp {}'.format(chan_grp))
+    for name, run_time, info in report:
+        txt = '  {:<25} {:8.2f} s'.format(name, run_time)
+        if 'nb_sample' in info:
+            txt += '  {:.0f} samples/s  nb_peak {}'.format(info['nb_sample']/run_time, info['nb_peak'])
+        print(txt)
+
+
+def run_runpeeler(dirname, chan_grps, params, n_jobs=1):
+    """
+    Run the Peeler on all chan_grps and segments with n_jobs processes
+    (with run_peeler_parallel) and print a timing report.
+    """
+    dataio = tdc.DataIO(dirname=dirname)
+    peeler_params = dict(params['peeler'])
+    duration = peeler_params.pop('duration')
+    if not peeler_params.pop('limit_duration'):
+        duration = None
+    
+    def progress_callback(nb_done, nb_job, result):
+        print('  {}/{} chan_grp {} seg_num {} nb_spike {} {:.2f} s'.format(nb_done, nb_job,
+                    result['chan_grp'], result['seg_num'], result['nb_spike'], result['run_time']))
+    
+    t0 = time.perf_counter()
+    results = tdc.run_peeler_parallel(dataio, chan_grps=chan_grps, n_jobs=n_jobs, duration=duration,
+                    peeler_params=peeler_params, progress_callback=progress_callback)
+    t1 = time.perf_counter()
+    
+    nb_sample = 0
+    for chan_grp in chan_grps:
+        for seg_num in range(dataio.nb_segment):
+            length = dataio.get_segment_length(seg_num)
+            if duration is not None:
+                length = min(length, int(duration*dataio.sample_rate))
+            nb_sample += length
+    nb_spike = sum(r['nb_spike'] for r in results)
+    print('runpeeler total: {} job(s) in {:.2f} s, {:.0f} samples/s, {:.0f} spikes/s, nb_spike {}, peak RSS {}'.format(
+                    len(results), t1-t0, nb_sample/(t1-t0), nb_spike/(t1-t0), nb_spike, format_rss(get_peak_rss())))
+    return results
+
+
+def format_rss(rss):
+    if rss is None:
+        return 'unknown'
+    return '{:.0f} MB'.format(rss)
+
+
 def open_mainwindow():
+        import pyqtgraph as pg
         app = pg.mkQApp()
         win = tdc.MainWindow()
         win.show()
@@ -35,8 +224,9 @@ def main():
     parser.add_argument('command', help='command in [{}]'.format(txt_command_list), default='mainwin', nargs='?')
     
     parser.add_argument('-d', '--dirname', help='working directory', default=None)
-    parser.add_argument('-c', '--chan_grp', type=int, help='channel group index', default=0)
+    parser.add_argument('-c', '--chan_grp', type=int, help='channel group index (default all channel groups for makecatalogue/runpeeler, 0 otherwise)', default=None)
     parser.add_argument('-p', '--parameters', help='JSON parameter file', default=None)
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes for makecatalogue/runpeeler', default=1)
     
     
     args = parser.parse_args(argv)
@@ -55,21 +245,36 @@ def main():
     
     #~ print(command)
     
-    if command in ['cataloguewin', 'peelerwin']:
+    if command in ['cataloguewin', 'peelerwin', 'makecatalogue', 'runpeeler']:
         if not tdc.DataIO.check_initialized(dirname):
             print('{} is not initialized'.format(dirname))
             exit()
         dataio = tdc.DataIO(dirname=dirname)
         print(dataio)
     
+    if command in ['makecatalogue', 'runpeeler']:
+        if args.chan_grp is None:
+            chan_grps = list(dataio.channel_groups.keys())
+        else:
+            chan_grps = [args.chan_grp]
+        params = load_params(args.parameters)
+        # catalogue colors use seaborn that import matplotlib.pyplot:
+        # force a non interactive backend on machines without display
+        os.environ.setdefault('MPLBACKEND', 'agg')
+    elif args.chan_grp is None:
+        args.chan_grp = 0
+    
+    if command in ['mainwin', 'cataloguewin', 'peelerwin', 'init']:
+        import pyqtgraph as pg
+    
     if command=='mainwin':
         open_mainwindow()
     
     elif command=='makecatalogue':
-        pass
+        run_makecatalogue(dirname, chan_grps, params, n_jobs=args.jobs)
     
     elif command=='runpeeler':
-        pass
+        run_runpeeler(dirname, chan_grps, params, n_jobs=args.jobs)
         
     elif command=='cataloguewin':
         catalogueconstructor = tdc.CatalogueConstructor(dataio=dataio, chan_grp=args.chan_grp)
@@ -94,5 +299,5 @@ def main():
     
 
 if __name__ =='__main__':
-    open_mainwindow()
+    main()
 
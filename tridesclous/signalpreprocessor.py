@@ -1,3 +1,5 @@
+import importlib.util
+
 import scipy.signal
 import numpy as np
 
@@ -8,6 +10,9 @@ try:
 except ImportError:
     HAVE_PYOPENCL = False
 
+# numba is imported (see numba_kernels) only when the numba engine is used
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
 
 #~ from pyacq.dsp.overlapfiltfilt import SosFiltfilt_Scipy
 from .tools import FifoBuffer
@@ -145,6 +150,69 @@ class SignalPreprocessor_Numpy(SignalPreprocessor_base):
 
 
 
+class SignalPreprocessor_Numba(SignalPreprocessor_base):
+    """
+    Same as SignalPreprocessor_Numpy but with numba:
+       * the forward filter is done in place in a preallocated buffer
+       * the backward filter, common reference removal and normalization
+         are done in one pass (sample by sample backward) directly in a
+         preallocated output buffer.
+    
+    The filters are computed in float64 like scipy.signal.sosfilt and the
+    output is float32 (output_dtype). The result is the same as the numpy
+    engine within float32 rounding.
+    
+    Caution: the returned chunk is a view on an internal buffer that is
+    overwritten at the next call of process_data.
+    """
+    def __init__(self,sample_rate, nb_channel, chunksize, input_dtype):
+        assert HAVE_NUMBA, 'numba is not installed'
+        SignalPreprocessor_base.__init__(self,sample_rate, nb_channel, chunksize, input_dtype)
+        from . import numba_kernels
+        self.kernels = numba_kernels
+    
+    def change_params(self, **kargs):
+        SignalPreprocessor_base.change_params(self, **kargs)
+        
+        self.coefficients_f64 = np.ascontiguousarray(self.coefficients, dtype='float64')
+        self.zi = np.zeros((self.nb_section, 2, self.nb_channel), dtype='float64')
+        self.zi_backward = np.zeros((self.nb_section, 2, self.nb_channel), dtype='float64')
+        self.forward_chunk = np.zeros((self.chunksize, self.nb_channel), dtype=self.output_dtype)
+        self.output = np.zeros((self.chunksize, self.nb_channel), dtype=self.output_dtype)
+        self.tmp_row = np.zeros(self.nb_channel, dtype=self.output_dtype)
+        
+        if self.normalize:
+            self.medians = np.ascontiguousarray(self.signals_medians, dtype=self.output_dtype)
+            self.mads = np.ascontiguousarray(self.signals_mads, dtype=self.output_dtype)
+        else:
+            self.medians = np.zeros(self.nb_channel, dtype=self.output_dtype)
+            self.mads = np.ones(self.nb_channel, dtype=self.output_dtype)
+    
+    def process_data(self, pos, data):
+        n = data.shape[0]
+        forward_chunk = self.forward_chunk[:n]
+        self.kernels._numba_forward_sosfilt(self.coefficients_f64, np.ascontiguousarray(data), self.zi, forward_chunk)
+        self.forward_buffer.new_chunk(forward_chunk, index=pos)
+        
+        start = pos-self.backward_chunksize
+        if start<-self.lostfront_chunksize:
+            return None, None
+        
+        if start>0:
+            backward_chunk = self.forward_buffer.get_data(start,pos)
+        else:
+            backward_chunk = self.forward_buffer.get_data(0,pos)
+            start = 0
+        pos2 = pos-self.lostfront_chunksize
+        
+        data2 = self.output[:pos2-start]
+        self.zi_backward[:] = 0
+        self.kernels._numba_backward_sosfilt_car_normalize(self.coefficients_f64, backward_chunk, self.zi_backward, data2,
+                    self.common_ref_removal, self.normalize, self.medians, self.mads, self.tmp_row)
+        
+        return pos2, data2
+
+
 class SignalPreprocessor_OpenCL(SignalPreprocessor_base):
     """
     Implementation in OpenCL depending on material and nb_channel
@@ -365,4 +433,5 @@ class SignalPreprocessor_OpenCL(SignalPreprocessor_base):
 
 
 signalpreprocessor_engines = { 'numpy' : SignalPreprocessor_Numpy,
-                                                'opencl' : SignalPreprocessor_OpenCL}
+                                                'opencl' : SignalPreprocessor_OpenCL,
+                                                'numba' : SignalPreprocessor_Numba}
@@ -7,6 +7,7 @@ from tridesclous import download_dataset
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
 from tridesclous.tools import median_mad
+from tridesclous import labelcodes
 
 from matplotlib import pyplot
 
@@ -76,6 +77,12 @@ def test_catalogue_constructor():
         for seg_num in range(dataio.nb_segment):
             mask = catalogueconstructor.all_peaks['segment']==seg_num
             print('seg_num', seg_num, 'nb peak',  np.sum(mask))
+        
+        # re detection from peak_candidates cache give the same peaks than the full pass
+        all_peaks_cache = catalogueconstructor.all_peaks.copy()
+        catalogueconstructor.re_detect_peak(peakdetector_engine='numpy',
+                                            peak_sign='-', relative_threshold=5, peak_span=0.0002, use_cache=False)
+        assert np.array_equal(all_peaks_cache, catalogueconstructor.all_peaks)
 
         
         
@@ -270,6 +277,42 @@ def test_make_catalogue():
     
 
 
+def test_make_catalogue_single_pass():
+    # waveforms and noise captured during the signal processing, no processed signals on disk
+    if os.path.exists('test_catalogueconstructor_single_pass'):
+        shutil.rmtree('test_catalogueconstructor_single_pass')
+        
+    dataio = DataIO(dirname='test_catalogueconstructor_single_pass')
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=[5, 6, 7, 8, 9], chan_grp=0)
+    
+    catalogueconstructor = CatalogueConstructor(dataio=dataio)
+    catalogueconstructor.set_preprocessor_params(chunksize=1024, highpass_freq=300., lowpass_freq=5000.,
+                                    lostfront_chunksize=128, peak_sign='-', relative_threshold=7, peak_span=0.0005)
+    catalogueconstructor.estimate_signals_noise(seg_num=0, duration=10.)
+    
+    t1 = time.perf_counter()
+    catalogueconstructor.run_signalprocessor(duration=10.,
+                capture_waveforms=dict(n_left=-12, n_right=15, nb_max=10000, nb_noise_snippet=300),
+                save_processed_signals=False)
+    t2 = time.perf_counter()
+    print('run_signalprocessor single pass', t2-t1)
+    
+    for seg_num in range(dataio.nb_segment):
+        assert 'processed_signals' not in dataio.arrays[0][seg_num].keys()
+    assert catalogueconstructor.some_waveforms.shape[1:] == (27, 5)
+    assert catalogueconstructor.some_noise_snippet.shape[0] > 0
+    
+    catalogueconstructor.project(method='global_pca', n_components=5)
+    catalogueconstructor.find_clusters(method='kmeans', n_clusters=5)
+    catalogueconstructor.save_catalogue()
+    
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    # 2 samples are removed on each side
+    assert catalogue['centers0'].shape[1:] == (23, 5)
+
+
 def test_ratio_amplitude():
     dataio = DataIO(dirname='test_catalogueconstructor')
     catalogueconstructor = CatalogueConstructor(dataio=dataio)
@@ -277,6 +320,79 @@ def test_ratio_amplitude():
     pairs = catalogueconstructor.detect_similar_waveform_ratio(0.5)
     print(pairs)
 
+
+def test_incremental_cluster_bookkeeping():
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.on_new_cluster()
+    cc.compute_centroid()
+    
+    # merge 2 clusters and only recompute changed clusters
+    k0, k1 = cc.positive_cluster_labels[:2]
+    mask = np.in1d(cc.all_peaks['label'], [k0, k1])
+    cc.all_peaks['label'][mask] = k0
+    t1 = time.perf_counter()
+    cc.on_new_cluster(label_changed=[k0, k1])
+    cc.compute_centroid(label_changed=[k0, k1])
+    t2 = time.perf_counter()
+    print('incremental on_new_cluster + compute_centroid', t2-t1)
+    clusters = cc.clusters.copy()
+    centroids = dict(cc.centroids)
+    
+    # same as full computation
+    cc.on_new_cluster()
+    cc.compute_centroid()
+    for name in ('cluster_label', 'nb_peak', 'max_on_channel', 'waveform_rms'):
+        assert np.array_equal(clusters[name], cc.clusters[name], equal_nan=True)
+    assert sorted(centroids.keys()) == sorted(cc.centroids.keys())
+    for k in centroids:
+        assert np.array_equal(centroids[k]['median'], cc.centroids[k]['median'])
+
+
+def test_extract_all_features():
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.extract_some_features(method='global_pca', n_components=5)
+    
+    all_features = {}
+    for n_jobs in [1, 2]:
+        t1 = time.perf_counter()
+        cc.extract_all_features(batch_size=1000, n_jobs=n_jobs)
+        t2 = time.perf_counter()
+        print('extract_all_features n_jobs', n_jobs, t2-t1)
+        assert cc.all_features.shape == (cc.nb_peak, 5)
+        # same features than some_features for sampled peaks
+        if not cc.info['params_waveformextractor']['align_waveform']:
+            assert np.allclose(cc.all_features[cc.some_peaks_index], cc.some_features, atol=1e-4)
+        all_features[n_jobs] = np.array(cc.all_features)
+    
+    # same result with several processes (NaN on borders at the same place)
+    assert np.array_equal(all_features[1], all_features[2], equal_nan=True)
+
+
+def test_propagate_labels():
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.extract_some_features(method='global_pca', n_components=5)
+    cc.find_clusters(method='kmeans', n_clusters=5)
+    cc.extract_all_features(batch_size=1000)
+    some_labels = cc.all_peaks['label'][cc.some_peaks_index].copy()
+    
+    for space in ['features', 'waveforms']:
+        cc.propagate_labels(space=space, batch_size=1000)
+        labels = cc.all_peaks['label']
+        # sampled peaks keep their label
+        assert np.array_equal(labels[cc.some_peaks_index], some_labels)
+        assert np.all(np.in1d(labels, np.concatenate([some_labels, [labelcodes.LABEL_UNCLASSIFIED]])))
+        for k in cc.positive_cluster_labels:
+            assert cc.clusters[cc.cluster_labels==k]['nb_peak'][0] == np.sum(labels==k)
+        
+        # max_distance=0. : nothing is propagated
+        cc.propagate_labels(space=space, max_distance=0., batch_size=1000)
+        not_some = np.ones(cc.nb_peak, dtype='bool')
+        not_some[cc.some_peaks_index] = False
+        assert np.all(cc.all_peaks['label'][not_some] == labelcodes.LABEL_UNCLASSIFIED)
+
     
 if __name__ == '__main__':
     test_catalogue_constructor()
@@ -284,6 +400,10 @@ if __name__ == '__main__':
     #~ compare_nb_waveforms()
     
     #~ test_make_catalogue()
+    #~ test_make_catalogue_single_pass()
     #~ test_ratio_amplitude()
+    #~ test_incremental_cluster_bookkeeping()
+    #~ test_extract_all_features()
+    #~ test_propagate_labels()
 
 
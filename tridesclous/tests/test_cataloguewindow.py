@@ -1,4 +1,5 @@
 from tridesclous import *
+from tridesclous.gui import *
 import  pyqtgraph as pg
 from matplotlib import pyplot
 
@@ -78,6 +79,27 @@ def test_SpikeSimilarityView():
     similarityview.show()
     app.exec_()
 
+def test_select_from_sparse_graph():
+    import numpy as np
+    from tridesclous.metrics import compute_similarity_knn
+    from tridesclous.gui.similarity import select_from_sparse_graph
+    
+    # 250 small well separated clusters of 20 spikes: the 20 neighbours of
+    # a spike are its cluster
+    rng = np.random.RandomState(0)
+    centers = rng.randn(250, 20) * 10.
+    data = (centers[np.repeat(np.arange(250), 20)] + rng.randn(5000, 20) * 0.1).astype('float32')
+    graph = compute_similarity_knn(data, 'rbf_kernel', n_neighbors=20)
+    keep_ind = np.arange(5000)
+    
+    sel = select_from_sparse_graph(graph, keep_ind, 500)
+    assert sel.size == 500
+    assert np.unique(sel).size == sel.size
+    # much more pairs displayed than a regular subsample (about 2 by row)
+    regular = keep_ind[np.linspace(0, keep_ind.size-1, 500).astype('int64')]
+    assert graph[sel, :][:, sel].nnz > 5 * graph[regular, :][:, regular].nnz
+
+
 def test_ClusterSimilarityView():
     controller = get_controller()
     controller.compute_cluster_similarity()
@@ -1,12 +1,18 @@
 import numpy as np
 import time
+import sys
 import os
 import shutil
 
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
+from tridesclous.cluster import minibatch_kmeans, sparse_dbscan
+from tridesclous import labelcodes
 
-from tridesclous import mkQApp, CatalogueWindow
+import sklearn.cluster
+import sklearn.metrics
+import multiprocessing
+import pytest
 
 from matplotlib import pyplot
 
@@ -17,6 +23,8 @@ from matplotlib import pyplot
 
 
 def test_dirtycut():
+    pytest.importorskip('PyQt5')
+    from tridesclous.gui import mkQApp, CatalogueWindow
     dirname = 'test_catalogueconstructor'
     #~ dirname = '/home/samuel/Documents/projet/tridesclous/example/tridesclous_locust/'
     
@@ -41,5 +49,121 @@ def test_dirtycut():
     app.exec_()
 
 
+def make_blobs(n, nb_cluster=5, dim=5):
+    rng = np.random.RandomState(0)
+    centers = rng.randn(nb_cluster, dim) * 10.
+    true_labels = rng.randint(0, nb_cluster, size=n)
+    features = centers[true_labels] + rng.randn(n, dim)
+    return features.astype('float32'), true_labels
+
+
+def test_minibatch_kmeans(tmp_path):
+    features, true_labels = make_blobs(20000)
+    # from a memmap
+    mm = np.memmap(str(tmp_path / 'test_minibatch_kmeans.raw'), dtype='float32', mode='w+', shape=features.shape)
+    mm[:] = features
+    labels = minibatch_kmeans(mm, n_clusters=5, batch_size=1000)
+    assert labels.shape == (20000, )
+    assert sklearn.metrics.adjusted_rand_score(true_labels, labels)>0.99
+    # reproducible
+    assert np.array_equal(labels, minibatch_kmeans(mm, n_clusters=5, batch_size=1000))
+    
+    # NaN rows (border peaks in all_features) are not clustered
+    mm[:10] = np.nan
+    labels = minibatch_kmeans(mm, n_clusters=5, batch_size=1000)
+    assert np.all(labels[:10] == labelcodes.LABEL_UNCLASSIFIED)
+    assert sklearn.metrics.adjusted_rand_score(true_labels[10:], labels[10:])>0.99
+    del mm
+
+
+def test_sparse_dbscan():
+    features, true_labels = make_blobs(5000)
+    labels = sparse_dbscan(features, eps=1.5, min_samples=5, n_neighbors=30, batch_size=1000)
+    ref_labels = sklearn.cluster.DBSCAN(eps=1.5, min_samples=5).fit_predict(features)
+    # same core points, same clusters for this well separated data
+    assert sklearn.metrics.adjusted_rand_score(ref_labels, labels)>0.99
+
+
+def test_find_clusters_all_features():
+    # run test_catalogueconstructor.py before this (all_features exists)
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    assert cc.all_features is not None
+    valid = np.all(np.isfinite(cc.all_features), axis=1)
+    
+    for method, kargs in [('minibatchkmeans', dict(n_clusters=5, batch_size=1000)),
+                            ('sparse_dbscan', dict(eps=3., batch_size=1000))]:
+        cc.find_clusters(method=method, space='all_features', **kargs)
+        labels = cc.all_peaks['label']
+        assert np.all(labels[~valid] == labelcodes.LABEL_UNCLASSIFIED)
+        if method == 'minibatchkmeans':
+            assert np.all(np.in1d(labels[valid], np.arange(5)))
+        for k in cc.positive_cluster_labels:
+            assert cc.clusters[cc.cluster_labels==k]['nb_peak'][0] == np.sum(labels==k)
+
+
+def test_find_clusters_all_features_selection():
+    # run test_catalogueconstructor.py before this (all_features exists)
+    dataio = DataIO(dirname='test_catalogueconstructor')
+    cc = CatalogueConstructor(dataio=dataio)
+    cc.find_clusters(method='minibatchkmeans', space='all_features', n_clusters=5, batch_size=1000)
+    
+    # split one cluster
+    k = cc.positive_cluster_labels[0]
+    selection = cc.all_peaks['label'] == k
+    old_labels = cc.all_peaks['label'].copy()
+    max_label = max(cc.cluster_labels)
+    
+    cc.find_clusters(method='sparse_dbscan', selection=selection, space='all_features',
+                        eps=3., min_samples=50, batch_size=1000)
+    new_labels = cc.all_peaks['label']
+    assert np.array_equal(new_labels[~selection], old_labels[~selection])
+    # new clusters are after the old ones, noise and NaN rows keep their codes
+    split = new_labels[selection]
+    assert np.all((split > max_label) | (split == labelcodes.LABEL_TRASH) | (split == labelcodes.LABEL_UNCLASSIFIED))
+    for k in cc.positive_cluster_labels:
+        assert cc.clusters[cc.cluster_labels==k]['nb_peak'][0] == np.sum(new_labels==k)
+
+
+def _run_cluster_method(n, name, queue):
+    # resource is unix only
+    import resource
+    features, true_labels = make_blobs(n)
+    m0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    if name == 'kmeans':
+        sklearn.cluster.KMeans(n_clusters=5, n_init=1).fit_predict(features)
+    elif name == 'minibatchkmeans':
+        minibatch_kmeans(features, n_clusters=5)
+    elif name == 'dbscan':
+        sklearn.cluster.DBSCAN(eps=3.).fit_predict(features)
+    elif name == 'sparse_dbscan':
+        sparse_dbscan(features, eps=3.)
+    t1 = time.perf_counter()
+    # ru_maxrss is in kB on linux
+    queue.put((t1-t0, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - m0)/1024.))
+
+
+def test_cluster_benchmark():
+    if sys.platform.startswith('win'):
+        pytest.skip('resource module is unix only')
+    # one process by method to measure the peak memory (ru_maxrss)
+    # eps is big compared to cluster spread : dense neighborhoods
+    ctx = multiprocessing.get_context('spawn')
+    for n in [5000, 10000]:
+        for name in ['kmeans', 'minibatchkmeans', 'dbscan', 'sparse_dbscan']:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_run_cluster_method, args=(n, name, queue))
+            proc.start()
+            duration, memory = queue.get()
+            proc.join()
+            print(n, name, 'time', round(duration, 3), 's', 'peak memory', round(memory, 1), 'MB')
+
+
 if __name__ == '__main__':
     test_dirtycut()
+    #~ test_minibatch_kmeans()
+    #~ test_sparse_dbscan()
+    #~ test_find_clusters_all_features()
+    #~ test_find_clusters_all_features_selection()
+    #~ test_cluster_benchmark()
@@ -1,5 +1,6 @@
 import pytest
 import os, tempfile, shutil
+import time
 import numpy as np
 
 from tridesclous import download_dataset
@@ -115,11 +116,127 @@ def test_dataio_catalogue():
     
     
 
-    
-    
+
+def test_iter_over_chunk_prefetch():
+    if os.path.exists('test_DataIO_prefetch'):
+        shutil.rmtree('test_DataIO_prefetch')
+    os.mkdir('test_DataIO_prefetch')
+    
+    sigs = np.random.randn(50000, 8).astype('float32')
+    filename = os.path.join('test_DataIO_prefetch', 'sigs.raw')
+    sigs.tofile(filename)
+    
+    dataio = DataIO(dirname=os.path.join('test_DataIO_prefetch', 'tdc'))
+    dataio.set_data_source(type='RawData', filenames=[filename], dtype='float32', 
+                    sample_rate=10000., total_channel=8)
+    dataio.set_channel_groups({0:{'channels':[1, 3, 5]}})
+    
+    chunks = list(dataio.iter_over_chunk(seg_num=0, chunksize=1024))
+    for prefetch, prefetch_block in [(1, None), (4, None), (3, 16)]:
+        chunks2 = list(dataio.iter_over_chunk(seg_num=0, chunksize=1024, prefetch=prefetch, prefetch_block=prefetch_block))
+        assert len(chunks2) == len(chunks)
+        for (i_stop, sigs_chunk), (i_stop2, sigs_chunk2) in zip(chunks, chunks2):
+            assert i_stop == i_stop2
+            assert np.array_equal(sigs_chunk, sigs_chunk2)
+    
+    # consumer stop before the end: the thread must stop
+    for i, (i_stop, sigs_chunk) in enumerate(dataio.iter_over_chunk(seg_num=0, chunksize=1024, prefetch=2)):
+        if i==3:
+            break
+    
+    # errors in the thread are raised in the caller
+    try:
+        list(dataio.iter_over_chunk(seg_num=0, chunksize=1024, prefetch=2, signal_type='not_valid'))
+        raised = False
+    except Exception:
+        raised = True
+    assert raised
+
+
+def test_get_spikes_with_index():
+    if os.path.exists('test_DataIO_spikes'):
+        shutil.rmtree('test_DataIO_spikes')
+    os.mkdir('test_DataIO_spikes')
+    
+    sigs = np.zeros((100000, 4), dtype='float32')
+    filename = os.path.join('test_DataIO_spikes', 'sigs.raw')
+    sigs.tofile(filename)
+    dataio = DataIO(dirname=os.path.join('test_DataIO_spikes', 'tdc'))
+    dataio.set_data_source(type='RawData', filenames=[filename], dtype='float32', 
+                    sample_rate=10000., total_channel=4)
+    
+    _dtype_spike = [('index', 'int64'), ('label', 'int64'), ('jitter', 'float64'),]
+    spikes = np.zeros(5000, dtype=_dtype_spike)
+    spikes['index'] = np.sort(np.random.randint(0, 100000, size=5000))
+    spikes['label'] = np.random.randint(-1, 8, size=5000)
+    
+    dataio.reset_spikes(seg_num=0, chan_grp=0, dtype=_dtype_spike)
+    # unsorted chunk at the end are sorted by flush_spikes
+    dataio.append_spikes(seg_num=0, chan_grp=0, spikes=spikes[:4000])
+    dataio.append_spikes(seg_num=0, chan_grp=0, spikes=spikes[4000:][::-1])
+    dataio.flush_spikes(seg_num=0, chan_grp=0)
+    
+    # reopen to check that the index is persistent
+    dataio = DataIO(dirname=os.path.join('test_DataIO_spikes', 'tdc'))
+    all_spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    assert np.all(np.diff(all_spikes['index'])>=0)
+    
+    t_start, t_stop = 2.5, 7.
+    for labels in [None, [3], [0, 5, -1], [12]]:
+        spikes2 = dataio.get_spikes(seg_num=0, chan_grp=0, t_start=t_start, t_stop=t_stop, labels=labels)
+        keep = (all_spikes['index']>=t_start*10000.) & (all_spikes['index']<t_stop*10000.)
+        if labels is not None:
+            keep &= np.in1d(all_spikes['label'], labels)
+        assert np.array_equal(spikes2, all_spikes[keep])
+    
+    labels, counts = dataio.get_spike_label_count(seg_num=0, chan_grp=0)
+    for k, count in zip(labels, counts):
+        assert count == np.sum(spikes['label']==k)
+
+
+
+def test_get_some_waveforms():
+    if os.path.exists('test_DataIO_waveforms'):
+        shutil.rmtree('test_DataIO_waveforms')
+    os.mkdir('test_DataIO_waveforms')
+    
+    filenames = []
+    for seg_num in range(2):
+        sigs = np.random.randn(50000, 4).astype('float32')
+        filename = os.path.join('test_DataIO_waveforms', 'sigs{}.raw'.format(seg_num))
+        sigs.tofile(filename)
+        filenames.append(filename)
+    dataio = DataIO(dirname=os.path.join('test_DataIO_waveforms', 'tdc'))
+    dataio.set_data_source(type='RawData', filenames=filenames, dtype='float32', 
+                    sample_rate=10000., total_channel=4)
+    
+    n_left, width = -20, 50
+    nb = 3000
+    seg_nums = np.random.randint(0, 2, size=nb)
+    indexes = np.random.randint(-n_left, 50000-width-n_left, size=nb)
+    
+    for block_size, max_gap in [(65536, 4096), (500, 30)]:
+        t1 = time.perf_counter()
+        wfs = dataio.get_some_waveforms(seg_nums, 0, indexes, n_left, width, signal_type='initial', 
+                        block_size=block_size, max_gap=max_gap)
+        t2 = time.perf_counter()
+        print('get_some_waveforms', block_size, max_gap, t2-t1)
+        
+        t1 = time.perf_counter()
+        for i in range(nb):
+            wf = dataio.get_signals_chunk(seg_num=seg_nums[i], chan_grp=0, i_start=indexes[i]+n_left, 
+                            i_stop=indexes[i]+n_left+width, signal_type='initial')
+            assert np.array_equal(wfs[i], wf)
+        t2 = time.perf_counter()
+        print('get_signals_chunk loop', t2-t1)
+
+
 if __name__=='__main__':
     
     test_DataIO()
+    #~ test_iter_over_chunk_prefetch()
+    #~ test_get_spikes_with_index()
+    #~ test_get_some_waveforms()
     #~ test_DataIO_probes()
     #~ test_dataio_catalogue()
     
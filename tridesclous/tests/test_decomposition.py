@@ -1,12 +1,14 @@
 import numpy as np
 import time
+import pytest
 import os
 import shutil
 
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
+from tridesclous.decomposition import PcaByChannel, NeighborhoodPca
 
-from tridesclous import mkQApp, CatalogueWindow
+import sklearn.decomposition
 
 from matplotlib import pyplot
 
@@ -53,14 +55,83 @@ def test_one_decomposition():
     t1 = time.perf_counter()
     print('extract_some_features', t1-t0)
 
+    pytest.importorskip('PyQt5')
+    from tridesclous.gui import mkQApp, CatalogueWindow
     app = mkQApp()
     win = CatalogueWindow(catalogueconstructor)
     win.show()
     app.exec_()    
 
 
+class FakeCatalogueConstructor:
+    def __init__(self, nb_channel):
+        self.nb_channel = nb_channel
+        self.geometry = np.zeros((nb_channel, 2))
+        self.geometry[:, 1] = np.arange(nb_channel) * 50.
+
+
+def make_fake_waveforms(n, width, nb_channel):
+    rng = np.random.RandomState(42)
+    basis = rng.randn(4, width, nb_channel)
+    waveforms = np.tensordot(rng.randn(n, 4), basis, axes=1) + rng.randn(n, width, nb_channel) * 0.1
+    return waveforms.astype('float32')
+
+
+def test_pca_by_neighborhood_batched():
+    nb_channel = 10
+    waveforms = make_fake_waveforms(500, 20, nb_channel)
+    cc = FakeCatalogueConstructor(nb_channel)
+    
+    # same features than one sklearn exact PCA by channel (up to the sign)
+    for projector, n in [(PcaByChannel(waveforms, catalogueconstructor=cc, n_components_by_channel=3), 3),
+                    (NeighborhoodPca(waveforms, catalogueconstructor=cc, n_components_by_neighborhood=3, radius_um=120.), 3)]:
+        features = projector.transform(waveforms)
+        assert features.shape == (500, nb_channel*n)
+        for c in range(nb_channel):
+            if isinstance(projector, PcaByChannel):
+                wfs = waveforms[:, :, c]
+            else:
+                wfs = waveforms[:, :, projector.neighborhood[c, :]].reshape(500, -1)
+            ref = sklearn.decomposition.PCA(n_components=n, svd_solver='full').fit_transform(wfs)
+            feat = features[:, c*n:(c+1)*n]
+            signs = np.sign(np.sum(ref*feat, axis=0))
+            assert np.allclose(feat, ref*signs, atol=1e-3)
+        
+        # transform by small batches is the same
+        assert np.allclose(features[:7], projector.transform(waveforms[:7]), atol=1e-5)
+    
+    # reproducible : same result for small blocks, threads and a second fit
+    p1 = NeighborhoodPca(waveforms, catalogueconstructor=cc, n_components_by_neighborhood=3, radius_um=120.)
+    p2 = NeighborhoodPca(waveforms, catalogueconstructor=cc, n_components_by_neighborhood=3, radius_um=120., n_jobs=2)
+    p3 = NeighborhoodPca(waveforms, catalogueconstructor=cc, n_components_by_neighborhood=3, radius_um=120.)
+    p3._fit(waveforms, p3.neighborhood, 3, max_bytes=1)
+    f1 = p1.transform(waveforms)
+    assert np.array_equal(f1, p2.transform(waveforms))
+    assert np.allclose(f1, p3.transform(waveforms), atol=1e-5)
+
+
+def test_pca_by_channel_benchmark():
+    width = 40
+    n = 5000
+    for nb_channel in [4, 32, 128]:
+        waveforms = make_fake_waveforms(n, width, nb_channel)
+        cc = FakeCatalogueConstructor(nb_channel)
+        
+        t0 = time.perf_counter()
+        pcas = [sklearn.decomposition.IncrementalPCA(n_components=3).fit(waveforms[:, :, c]) for c in range(nb_channel)]
+        for c, pca in enumerate(pcas):
+            pca.transform(waveforms[:, :, c])
+        t1 = time.perf_counter()
+        projector = PcaByChannel(waveforms, catalogueconstructor=cc, n_components_by_channel=3)
+        projector.transform(waveforms)
+        t2 = time.perf_counter()
+        print('nb_channel', nb_channel, 'IncrementalPCA loop', t1-t0, 'batched', t2-t1)
+
+
 if __name__ == '__main__':
     #~ test_all_decomposition()
+    #~ test_pca_by_neighborhood_batched()
+    #~ test_pca_by_channel_benchmark()
     
     test_one_decomposition()
 
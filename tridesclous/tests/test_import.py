@@ -0,0 +1,54 @@
+import sys
+import subprocess
+
+import pytest
+
+
+_heavy_modules = ['PyQt5', 'pyqtgraph', 'matplotlib', 'seaborn', 'sklearn', 'numba', 'tridesclous.gui']
+
+# generous bound, the headless import is well below 1 s on a laptop
+_max_import_time = 5.
+
+
+def test_import_headless():
+    # in a fresh interpreter: import time and no GUI/plotting module loaded
+    code = """
+import sys, time
+t0 = time.perf_counter()
+import tridesclous
+from tridesclous import DataIO, CatalogueConstructor, Peeler
+t1 = time.perf_counter()
+print(t1 - t0)
+print(' '.join(m for m in {} if m in sys.modules))
+""".format(_heavy_modules)
+    out = subprocess.check_output([sys.executable, '-c', code]).decode().split('\n')
+    import_time = float(out[0])
+    loaded = out[1].split()
+    print('import tridesclous', import_time, 's')
+    assert len(loaded) == 0, 'loaded at import : {}'.format(loaded)
+    assert import_time < _max_import_time, 'import tridesclous took {:.2f} s'.format(import_time)
+
+
+def test_import_star_headless():
+    # "from tridesclous import *" is used in tests and examples
+    code = """
+import sys
+from tridesclous import *
+print(' '.join(m for m in {} if m in sys.modules))
+""".format(_heavy_modules)
+    out = subprocess.check_output([sys.executable, '-c', code]).decode().split('\n')
+    loaded = out[0].split()
+    assert len(loaded) == 0, 'loaded by import * : {}'.format(loaded)
+
+
+def test_import_gui_lazy():
+    pytest.importorskip('PyQt5')
+    import tridesclous
+    assert callable(tridesclous.CatalogueWindow)
+    assert 'tridesclous.gui' in sys.modules
+
+
+if __name__ == '__main__':
+    test_import_headless()
+    test_import_star_headless()
+    test_import_gui_lazy()
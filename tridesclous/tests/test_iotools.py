@@ -1,6 +1,6 @@
 import numpy as np
 
-from tridesclous.iotools import ArrayCollection
+from tridesclous.iotools import ArrayCollection, WriteBehindWriter
 
 
 def test_ArrayCollection():
@@ -29,6 +29,65 @@ def test_ArrayCollection_several_open():
     ac.add_array('data', data6, 'memmap')
     data7 = ac.get('data')
     print(type(data7), data7)
+
+
+
+def test_WriteBehindWriter():
+    ac = ArrayCollection(dirname='test_WriteBehindWriter')
+    sigs = np.random.randn(10000, 4).astype('float32')
+    arr = ac.create_array('sigs', 'float32', sigs.shape, 'memmap')
+    ac.initialize_array('spikes', 'memmap', 'int64', (-1,))
+    
+    writer = WriteBehindWriter(maxsize=8)
+    chunk = np.zeros((100, 4), dtype='float32')
+    for i in range(100):
+        # the writer must copy because the buffer is reused
+        chunk[:] = sigs[i*100:(i+1)*100]
+        writer.submit_signals(arr, i*100, (i+1)*100, chunk)
+        writer.submit_append(ac, 'spikes', np.arange(i*3, (i+1)*3))
+    writer.barrier()
+    ac.finalize_array('spikes')
+    
+    assert np.array_equal(arr, sigs)
+    assert np.array_equal(ac.get('spikes'), np.arange(300))
+    
+    # error in thread is raised in the caller
+    class BadArray:
+        def __setitem__(self, k, v):
+            raise IOError('disk full')
+    writer.submit_signals(BadArray(), 0, 100, chunk)
+    try:
+        writer.barrier()
+        raised = False
+    except IOError:
+        raised = True
+    assert raised
+    
+    writer.close()
+
+
+def test_WriteBehindWriter_coalesce():
+    # interleaved signals/appends (like the Peeler does) must be grouped by target
+    class Recorder:
+        def __init__(self):
+            self.calls = []
+        def __setitem__(self, k, v):
+            self.calls.append((k.start, k.stop, v.shape[0]))
+        def append_chunk(self, name, data):
+            self.calls.append((name, data.size))
+    
+    arr, collection = Recorder(), Recorder()
+    writer = WriteBehindWriter(maxsize=16)
+    # stop the thread and feed the batch by hand
+    writer.close()
+    for i in range(4):
+        writer.queue.put(('signals', arr, i*10, (i+1)*10, np.zeros((10, 2))))
+        writer.queue.put(('append', collection, 'spikes', None, np.arange(3)))
+    tasks = [writer.queue.get_nowait() for i in range(8)]
+    writer._do_writes(tasks)
+    
+    assert arr.calls == [(0, 40, 40)]
+    assert collection.calls == [('spikes', 12)]
     
     
     
@@ -37,4 +96,5 @@ def test_ArrayCollection_several_open():
     
 if __name__=='__main__':
     #~ test_ArrayCollection()
-    test_ArrayCollection_several_open()
\ No newline at end of file
+    test_ArrayCollection_several_open()
+    #~ test_WriteBehindWriter()
\ No newline at end of file
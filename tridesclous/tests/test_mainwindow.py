@@ -1,4 +1,5 @@
 from tridesclous import *
+from tridesclous.gui import *
 import  pyqtgraph as pg
 
 
@@ -1,5 +1,11 @@
+import time
+
+import numpy as np
+import scipy.spatial
+
 from tridesclous import *
-import  pyqtgraph as pg
+from tridesclous.metrics import cosine_similarity_with_max, update_similarity, compute_similarity_knn, compute_similarity
+from tridesclous.metrics import compute_silhouette
 import matplotlib.pyplot as plt
 
 # run test_catalogueconstructor.py before this
@@ -34,6 +40,78 @@ def test_cluster_ratio():
     plt.show()
 
 
+def test_cosine_similarity_with_max():
+    x = np.random.randn(60, 500)
+    
+    # reference: one python call by pair
+    def func(u, v):
+        m = np.maximum(np.abs(u), np.abs(v))
+        return np.dot(u, v.T) / np.dot(m, m.T)
+    t1 = time.perf_counter()
+    ref = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(x, metric=func))
+    ref += np.eye(x.shape[0])
+    t2 = time.perf_counter()
+    sim = cosine_similarity_with_max(x, block_size=16)
+    t3 = time.perf_counter()
+    print('pdist', t2-t1, 'vectorized', t3-t2)
+    assert np.allclose(sim, ref)
+    
+    rows = [3, 10, 59]
+    assert np.allclose(cosine_similarity_with_max(x, rows=rows), ref[rows, :])
+    
+    # update after 2 changed and 1 removed and 1 new
+    labels = np.arange(59)
+    new_labels = np.array([l for l in range(60) if l!=7])
+    x2 = x.copy()
+    x2[[3, 12], :] = np.random.randn(2, 500)
+    sim2 = update_similarity(sim[:59, :59], labels, new_labels, x2[new_labels], [3, 12, 7])
+    assert np.allclose(sim2, cosine_similarity_with_max(x2[new_labels]))
+
+
+def test_compute_similarity_knn():
+    x = np.random.randn(2000, 300).astype('float32')
+    n_neighbors = 20
+    
+    t1 = time.perf_counter()
+    graph = compute_similarity_knn(x, 'cosine_similarity', n_neighbors=n_neighbors, max_bytes=2**20)
+    t2 = time.perf_counter()
+    print('compute_similarity_knn', t2-t1)
+    assert graph.shape == (2000, 2000)
+    assert graph.nnz == 2000 * n_neighbors
+    
+    # same values and same top k than the dense similarity
+    dense = compute_similarity(x, 'cosine_similarity')
+    topk = -np.sort(-dense, axis=1)[:, :n_neighbors]
+    values = -np.sort(-graph.data.reshape(2000, n_neighbors), axis=1)
+    assert np.allclose(values, topk, atol=1e-5)
+    coo = graph.tocoo()
+    assert np.allclose(coo.data, dense[coo.row, coo.col], atol=1e-5)
+
+
+def test_compute_silhouette():
+    import sklearn.metrics
+    
+    x = np.concatenate([np.random.randn(n, 200) + c for n, c in [(600, 0.), (400, .3), (300, 1.), (1, 5.)]])
+    x = x.astype('float32')
+    labels = np.repeat([0, 1, 2, -1], [600, 400, 300, 1])
+    
+    t1 = time.perf_counter()
+    ref = sklearn.metrics.silhouette_samples(x, labels)
+    t2 = time.perf_counter()
+    silhouette = compute_silhouette(x, labels, method='exact', max_bytes=2**20)
+    t3 = time.perf_counter()
+    print('sklearn', t2-t1, 'blocked', t3-t2)
+    assert np.allclose(silhouette, ref, atol=1e-5)
+    
+    for method in ('subsample', 'centroid'):
+        approx = compute_silhouette(x, labels, method=method, n_by_cluster=100)
+        print(method, 'mean error', np.mean(np.abs(approx-ref)))
+        assert np.corrcoef(approx, ref)[0, 1] > 0.9
+
+
 if __name__ == '__main__':
     #~ test_all_metrics()
-    test_cluster_ratio()
\ No newline at end of file
+    test_cluster_ratio()
+    #~ test_cosine_similarity_with_max()
+    #~ test_compute_similarity_knn()
+    #~ test_compute_silhouette()
\ No newline at end of file
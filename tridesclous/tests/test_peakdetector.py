@@ -1,7 +1,10 @@
 from tridesclous import get_dataset
-from tridesclous.peakdetector import peakdetector_engines
+from tridesclous.peakdetector import peakdetector_engines, HAVE_NUMBA
+from tridesclous.peakdetector import detect_peaks_in_chunk, detect_peaks_in_chunk_numba
+from tridesclous.peakdetector import get_peak_candidates, detect_peaks_in_candidates
 
 import time
+import pytest
 
 import scipy.signal
 import numpy as np
@@ -51,6 +54,8 @@ def test_compare_offline_online_engines():
         #~ engines = ['numpy']
     else:
         engines = ['numpy']
+    if HAVE_NUMBA:
+        engines.append('numba')
 
     # get sigs
     sigs, sample_rate = get_dataset(name='olfactory_bulb')
@@ -164,6 +169,62 @@ def test_compare_offline_online_engines():
     
     
 
+
+def test_detect_peaks_in_chunk_numba():
+    if not HAVE_NUMBA:
+        pytest.skip('numba not installed')
+    
+    sample_rate = 30000.
+    chunksize = 1024
+    nloop = 50
+    k = int(sample_rate*0.0005)//2
     
+    for nb_channel in [1, 4, 16, 64, 256]:
+        sigs = np.random.randn(chunksize*nloop, nb_channel).astype('float32')
+        sigs[::537, :] -= 20.
+        
+        for peak_sign in ['-', '+']:
+            peaks = {}
+            
+            # warmup jit
+            detect_peaks_in_chunk_numba(sigs[:chunksize], k, 5., peak_sign)
+            
+            for name, func in [('numpy', detect_peaks_in_chunk), ('numba', detect_peaks_in_chunk_numba)]:
+                t1 = time.perf_counter()
+                peaks[name] = [func(sigs[i*chunksize:(i+1)*chunksize], k, 5., peak_sign) for i in range(nloop)]
+                t2 = time.perf_counter()
+                print('nb_channel', nb_channel, 'peak_sign', peak_sign, name, 
+                            'chunk latency {:.1f} us'.format((t2-t1)/nloop*1e6))
+            
+            for i in range(nloop):
+                # float32 sum order can differ with many channels
+                if nb_channel<=8:
+                    assert np.array_equal(peaks['numpy'][i], peaks['numba'][i])
+                else:
+                    assert abs(peaks['numpy'][i].size - peaks['numba'][i].size) <= 1
+
+
+def test_detect_peaks_in_candidates():
+    sample_rate = 30000.
+    floor = 3.
+    for nb_channel in [1, 4, 16]:
+        sigs = np.random.randn(100000, nb_channel).astype('float32')
+        sigs[::537, :] -= 20.
+        sigs[::411, :] += 15.
+        
+        indexes, channels, values = get_peak_candidates(sigs, floor)
+        print('nb_channel', nb_channel, 'nb candidate', indexes.size)
+        for peak_sign in ['-', '+']:
+            for thresh in [3., 4., 6.]:
+                for peak_span in [0.0001, 0.0005, 0.002]:
+                    k = max(1, int(sample_rate*peak_span)//2)
+                    peaks = detect_peaks_in_chunk(sigs, k, thresh, peak_sign)
+                    peaks2 = detect_peaks_in_candidates(indexes, channels, values, nb_channel, k, thresh, peak_sign)
+                    peaks2 = peaks2[(peaks2>=k) & (peaks2<sigs.shape[0]-k)]
+                    assert np.array_equal(peaks, peaks2)
+
+
 if __name__ == '__main__':
-    test_compare_offline_online_engines()
\ No newline at end of file
+    test_compare_offline_online_engines()
+    test_detect_peaks_in_chunk_numba()
+    test_detect_peaks_in_candidates()
\ No newline at end of file
@@ -6,11 +6,14 @@ import time
 import os
 import shutil
 
-import  pyqtgraph as pg
 
 from tridesclous.dataio import DataIO
 from tridesclous.catalogueconstructor import CatalogueConstructor
 from tridesclous import Peeler, Peeler_OpenCl
+from tridesclous.peeler import run_peeler_parallel, run_peeler_time_sharded
+from tridesclous.peeler import classify_and_align, classify_and_align_batch
+from tridesclous.peeler import make_prediction_signals, subtract_prediction_signals
+from tridesclous.peakdetector import detect_peaks_in_chunk
 
 from tridesclous.peeler_OLD import PeelerOLD
 
@@ -84,6 +87,8 @@ def setup_catalogue():
 
 
 def open_catalogue_window():
+    import pyqtgraph as pg
+    from tridesclous.gui import CatalogueWindow
     dataio = DataIO(dirname='test_peeler')
     catalogueconstructor = CatalogueConstructor(dataio=dataio)
     app = pg.mkQApp()
@@ -111,7 +116,151 @@ def test_peeler():
     
 
 
+def test_classify_and_align_batch():
+    dataio = DataIO(dirname='test_peeler')
+    
+    for use_sparse_template in [False, True]:
+        print('use_sparse_template', use_sparse_template)
+        initial_catalogue = dataio.load_catalogue(chan_grp=0)
+        peeler = Peeler(dataio)
+        peeler.change_params(catalogue=initial_catalogue, n_peel_level=2, chunksize=1024,
+                    use_sparse_template=use_sparse_template)
+        catalogue = peeler.catalogue
+        
+        residual = np.array(dataio.get_signals_chunk(seg_num=0, chan_grp=0, i_start=0, i_stop=100000, signal_type='processed'))
+        params = catalogue['params_peakdetector']
+        n_span = max(1, int(dataio.sample_rate*params['peak_span'])//2)
+        local_index = detect_peaks_in_chunk(residual, n_span, params['relative_threshold'], params['peak_sign'])
+        print('nb peak', local_index.size)
+        
+        t1 = time.perf_counter()
+        spikes_loop = classify_and_align(local_index, residual, catalogue)
+        t2 = time.perf_counter()
+        print('classify_and_align', t2-t1, 'spikes/s', local_index.size/(t2-t1))
+        
+        t1 = time.perf_counter()
+        spikes_batch = classify_and_align_batch(local_index, residual, catalogue)
+        t2 = time.perf_counter()
+        print('classify_and_align_batch', t2-t1, 'spikes/s', local_index.size/(t2-t1))
+        
+        assert spikes_batch.dtype == spikes_loop.dtype
+        assert np.array_equal(spikes_batch['index'], spikes_loop['index'])
+        assert np.array_equal(spikes_batch['label'], spikes_loop['label'])
+        assert np.allclose(spikes_batch['jitter'], spikes_loop['jitter'], atol=1e-5)
+
+
+def _make_prediction_signals_loop(spikes, dtype, shape, catalogue):
+    # reference: the original per spike implementation
+    prediction = np.zeros(shape, dtype=dtype)
+    r = catalogue['subsample_ratio']
+    for i in range(spikes.size):
+        k = spikes[i]['label']
+        if k<0: continue
+        cluster_idx = catalogue['label_to_index'][k]
+        pos = spikes[i]['index'] + catalogue['n_left']
+        jitter = spikes[i]['jitter']
+        shift = -int(np.round(jitter))
+        pos = pos + shift
+        int_jitter = int((jitter+shift)*r) + r//2
+        pred = catalogue['interp_centers0'][cluster_idx, int_jitter::r, :]
+        if pos>0 and  pos+catalogue['peak_width']<shape[0]:
+            prediction[pos:pos+catalogue['peak_width'], :] += pred
+    return prediction
+
+
+def test_subtract_prediction_signals():
+    dataio = DataIO(dirname='test_peeler')
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    nb_channel = catalogue['centers0'].shape[2]
+    shape = (1024+200, nb_channel)
+    residual = np.random.randn(*shape).astype('float32')
+    
+    for nb_spike in [5, 50]:
+        # with 50 spikes some of them overlap
+        spikes = np.zeros(nb_spike, dtype=[('index', 'int64'), ('label', 'int64'), ('jitter', 'float64'),])
+        spikes['index'] = np.random.randint(0, shape[0], size=nb_spike)
+        spikes['label'] = np.random.choice(catalogue['cluster_labels'], size=nb_spike)
+        spikes['jitter'] = np.random.uniform(-1.5, 1.5, size=nb_spike)
+        
+        t1 = time.perf_counter()
+        prediction_loop = _make_prediction_signals_loop(spikes, residual.dtype, shape, catalogue)
+        t2 = time.perf_counter()
+        print('loop prediction', t2-t1)
+        expected = residual - prediction_loop
+        
+        prediction = make_prediction_signals(spikes, residual.dtype, shape, catalogue)
+        assert np.allclose(prediction, prediction_loop, atol=1e-5)
+        
+        residual2 = residual.copy()
+        t1 = time.perf_counter()
+        subtract_prediction_signals(spikes, residual2, catalogue)
+        t2 = time.perf_counter()
+        print('subtract_prediction_signals', t2-t1)
+        
+        # the summation order differs when spikes overlap
+        assert np.allclose(residual2, expected, atol=1e-5)
+
+
+def test_run_peeler_parallel():
+    dataio = DataIO(dirname='test_peeler')
+    initial_catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    # serial reference
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=initial_catalogue, n_peel_level=2, chunksize=1024)
+    t1 = time.perf_counter()
+    peeler.run(chan_grp=0)
+    t2 = time.perf_counter()
+    print('serial', t2-t1)
+    spikes_serial = [dataio.get_spikes(seg_num=seg_num, chan_grp=0).copy() for seg_num in range(dataio.nb_segment)]
+    
+    def progress_callback(nb_done, nb_job, result):
+        print(nb_done, '/', nb_job, result)
+    
+    t1 = time.perf_counter()
+    results = run_peeler_parallel(dataio, chan_grps=[0], n_jobs=2, 
+                peeler_params=dict(n_peel_level=2, chunksize=1024), progress_callback=progress_callback)
+    t2 = time.perf_counter()
+    print('parallel', t2-t1)
+    
+    assert len(results) == dataio.nb_segment
+    for seg_num in range(dataio.nb_segment):
+        spikes = dataio.get_spikes(seg_num=seg_num, chan_grp=0)
+        assert results[seg_num]['nb_spike'] == spikes.size
+        assert np.array_equal(spikes, spikes_serial[seg_num])
+
+
+def test_run_peeler_time_sharded():
+    dataio = DataIO(dirname='test_peeler')
+    initial_catalogue = dataio.load_catalogue(chan_grp=0)
+    
+    # serial reference
+    peeler = Peeler(dataio)
+    peeler.change_params(catalogue=initial_catalogue, n_peel_level=2, chunksize=1024)
+    peeler.run_offline_loop_one_segment(seg_num=0, chan_grp=0)
+    spikes_serial = dataio.get_spikes(seg_num=0, chan_grp=0).copy()
+    spikes_serial = spikes_serial.take(np.argsort(spikes_serial['index'], kind='stable'))
+    sigs_serial = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed').copy()
+    
+    for n_shard in [1, 4]:
+        t1 = time.perf_counter()
+        results = run_peeler_time_sharded(dataio, seg_num=0, chan_grp=0, n_shard=n_shard, n_jobs=n_shard,
+                    peeler_params=dict(n_peel_level=2, chunksize=1024))
+        t2 = time.perf_counter()
+        print('n_shard', n_shard, t2-t1)
+        assert len(results) == n_shard
+        
+        spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+        sigs = dataio.get_signals_chunk(seg_num=0, chan_grp=0, signal_type='processed')
+        assert np.all(np.diff(spikes['index'])>=0)
+        assert np.array_equal(spikes, spikes_serial)
+        assert np.allclose(sigs, sigs_serial, atol=1e-4)
+
+
 def open_PeelerWindow():
+    import pyqtgraph as pg
+    from tridesclous.gui import PeelerWindow
     dataio = DataIO(dirname='test_peeler')
     initial_catalogue = dataio.load_catalogue(chan_grp=0)
 
@@ -168,4 +317,12 @@ if __name__ =='__main__':
     
     #~ test_compare_peeler()
     
+    #~ test_classify_and_align_batch()
+    
+    #~ test_subtract_prediction_signals()
+    
+    #~ test_run_peeler_parallel()
+    
+    #~ test_run_peeler_time_sharded()
+    
     open_PeelerWindow()
@@ -1,7 +1,8 @@
 from tridesclous import get_dataset
-from tridesclous.signalpreprocessor import signalpreprocessor_engines
+from tridesclous.signalpreprocessor import signalpreprocessor_engines, HAVE_NUMBA
 
 import time
+import pytest
 
 import scipy.signal
 import numpy as np
@@ -55,6 +56,8 @@ def test_compare_offline_online_engines():
         #~ engines = ['numpy']
     else:
         engines = ['numpy']
+    if HAVE_NUMBA:
+        engines.append('numba')
 
 
     # get sigs
@@ -157,6 +160,54 @@ def test_compare_offline_online_engines():
     
 
 
+def test_compare_numba_numpy_engines():
+    if not HAVE_NUMBA:
+        pytest.skip('numba not installed')
+    
+    sample_rate = 20000.
+    chunksize = 1024
+    nloop = 100
+    
+    for nb_channel in [4, 7, 32]:
+        sigs = (np.random.randn(chunksize*nloop, nb_channel)*200 + 1000).astype('int16')
+        for common_ref_removal in [False, True]:
+            params = {
+                        'common_ref_removal' : common_ref_removal,
+                        'highpass_freq': 300.,
+                        'lowpass_freq': 5000.,
+                        'smooth_size':0,
+                        'output_dtype': 'float32',
+                        'normalize' : True,
+                        'lostfront_chunksize': 128,
+                        'signals_medians' : np.random.randn(nb_channel).astype('float32'),
+                        'signals_mads' : np.random.rand(nb_channel).astype('float32') + 1.,
+                        }
+            
+            online_sigs = {}
+            for engine in ['numpy', 'numba']:
+                SignalPreprocessorClass = signalpreprocessor_engines[engine]
+                signalpreprocessor = SignalPreprocessorClass(sample_rate, nb_channel, chunksize, sigs.dtype)
+                # first call for jit
+                signalpreprocessor.change_params(**params)
+                signalpreprocessor.process_data(chunksize, sigs[:chunksize])
+                signalpreprocessor.change_params(**params)
+                
+                all_online_sigs = []
+                t1 = time.perf_counter()
+                for i in range(nloop):
+                    pos = (i+1)*chunksize
+                    pos2, preprocessed_chunk = signalpreprocessor.process_data(pos, sigs[pos-chunksize:pos,:])
+                    if preprocessed_chunk is not None:
+                        # numba engine return a view on internal buffer
+                        all_online_sigs.append(preprocessed_chunk.copy())
+                t2 = time.perf_counter()
+                print('nb_channel', nb_channel, 'common_ref_removal', common_ref_removal, engine, 'process time', t2-t1)
+                online_sigs[engine] = np.concatenate(all_online_sigs)
+            
+            assert online_sigs['numpy'].shape == online_sigs['numba'].shape
+            assert np.allclose(online_sigs['numpy'], online_sigs['numba'], atol=1e-4)
+
+
 def test_smooth_with_filtfilt():
     sigs = np.zeros((100, 1), 'float32')
     #~ sigs[49] = 6
@@ -211,5 +262,6 @@ def test_smooth_with_filtfilt():
     
 if __name__ == '__main__':
     test_compare_offline_online_engines()
+    test_compare_numba_numpy_engines()
     #~ test_smooth_with_filtfilt()
 
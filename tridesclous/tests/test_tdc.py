@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import subprocess
+
+from tridesclous import download_dataset
+from tridesclous.dataio import DataIO
+from tridesclous.scripts.tdc import load_params
+
+
+def test_default_params():
+    params = load_params()
+    assert params['noise_estimation']['duration'] == 10.
+    assert params['noise_estimation']['method'] == 'exact'
+    assert params['feature_method'] == 'global_pca'
+    assert params['cluster_method'] == 'kmeans'
+    assert not params['peeler']['limit_duration']
+
+
+def test_tdc_makecatalogue_runpeeler(tmp_path):
+    # smoke test of the headless commands in a subprocess
+    dirname = str(tmp_path / 'test_tdc')
+    dataio = DataIO(dirname=dirname)
+    localdir, filenames, params = download_dataset(name='olfactory_bulb')
+    dataio.set_data_source(type='RawData', filenames=filenames, **params)
+    dataio.add_one_channel_group(channels=[5, 6, 7, 8, 9], chan_grp=0)
+
+    params = {
+        'duration': 10.,
+        'noise_estimation': {'duration': 5.},
+        'peak_detector': {'relative_threshold': 7., 'peak_span': 0.0005},
+        'extract_waveforms': {'n_left': -12, 'n_right': 15, 'nb_max': 2000},
+        'peeler': {'limit_duration': True, 'duration': 10.},
+    }
+    param_file = str(tmp_path / 'params.json')
+    with open(param_file, 'w', encoding='utf8') as f:
+        json.dump(params, f)
+
+    # run from the repo root so that tridesclous is importable even if not installed
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for command in ['makecatalogue', 'runpeeler']:
+        out = subprocess.check_output([sys.executable, '-m', 'tridesclous.scripts.tdc', command,
+                        '-d', dirname, '-p', param_file], stderr=subprocess.STDOUT, cwd=root).decode()
+        print(out)
+        assert '{} total'.format(command) in out
+
+    dataio = DataIO(dirname=dirname)
+    catalogue = dataio.load_catalogue(chan_grp=0)
+    assert catalogue['cluster_labels'].size > 0
+    spikes = dataio.get_spikes(seg_num=0, chan_grp=0)
+    assert spikes.size > 0
+
+
+if __name__ == '__main__':
+    test_default_params()
@@ -1,9 +1,10 @@
 import pandas as pd
 import numpy as np
-from tridesclous.tools import median_mad, FifoBuffer, get_neighborhood, fix_prb_file_py2
+from tridesclous.tools import median_mad, FifoBuffer, get_neighborhood, fix_prb_file_py2, StreamingMedianMad
 
 from urllib.request import urlretrieve
 import time
+import itertools
 
 def test_get_median_mad():
     pass
@@ -20,6 +21,94 @@ def test_FifoBuffer():
     assert np.all(data2[-1,:]==4095)
     #~ print(data2)
 
+def test_FifoBuffer_wrap():
+    # many chunks to go several times over the internal buffer
+    n = 3
+    chunksize = 100
+    fifo = FifoBuffer((chunksize+30, n), dtype='int64', capacity_factor=2)
+    for i in range(50):
+        data = np.tile(np.arange(chunksize)[:, None], (1, n))+i*chunksize
+        fifo.new_chunk(data, chunksize*(i+1))
+        if i>0:
+            data2 = fifo.get_data(chunksize*(i+1)-chunksize-30, chunksize*(i+1))
+            assert np.array_equal(data2[:, 0], np.arange(chunksize*(i+1)-chunksize-30, chunksize*(i+1)))
+            assert np.array_equal(fifo.buffer, data2)
+
+
+def test_FifoBuffer_benchmark():
+    # compare bytes copied and latency by chunk with the old way:
+    # shift all the buffer for each chunk
+    nb_channel = 32
+    nloop = 200
+    for chunksize, fifo_size in itertools.product([256, 1024, 4096, 16384], ['+128', '*2']):
+        if fifo_size == '+128':
+            # like Peeler.fifo_residuals or SignalPreprocessor.forward_buffer
+            shape = (chunksize+128, nb_channel)
+        else:
+            # like PeakDetector.fifo_sum_rectified
+            shape = (chunksize*2, nb_channel)
+        data = np.random.randn(chunksize, nb_channel).astype('float32')
+        
+        buffer = np.zeros(shape, dtype='float32')
+        t1 = time.perf_counter()
+        for i in range(nloop):
+            n = buffer.shape[0]-data.shape[0]
+            buffer[:n] = buffer[-n:]
+            buffer[n:] = data
+        t2 = time.perf_counter()
+        bytes_shift = nloop*buffer.nbytes
+        
+        fifo = FifoBuffer(shape, dtype='float32')
+        bytes_fifo = 0
+        t3 = time.perf_counter()
+        for i in range(nloop):
+            head = fifo.head
+            fifo.new_chunk(data, (i+1)*chunksize)
+            bytes_fifo += data.nbytes
+            if fifo.head<head:
+                bytes_fifo += (shape[0]-chunksize)*nb_channel*4
+        t4 = time.perf_counter()
+        
+        print('chunksize', chunksize, 'fifo_size', shape[0],
+            'shift: {:.1f}us {} bytes/chunk'.format((t2-t1)/nloop*1e6, bytes_shift//nloop),
+            'fifo: {:.1f}us {} bytes/chunk'.format((t4-t3)/nloop*1e6, bytes_fifo//nloop))
+        assert bytes_fifo<bytes_shift
+
+
+def test_StreamingMedianMad():
+    nb_channel = 5
+    # gaussian noise + some big spikes + offset
+    sigs = np.random.randn(300000, nb_channel)*np.arange(1, nb_channel+1) + np.arange(nb_channel)*10.
+    sigs[np.random.randint(0, sigs.shape[0], size=3000), :] -= 50.
+    sigs = sigs.astype('float32')
+    
+    t1 = time.perf_counter()
+    med, mad = median_mad(sigs, axis=0)
+    t2 = time.perf_counter()
+    print('median_mad', t2-t1)
+    
+    t1 = time.perf_counter()
+    estimator = StreamingMedianMad(nb_channel)
+    for i in range(0, sigs.shape[0], 1024):
+        estimator.new_chunk(sigs[i:i+1024])
+    med2, mad2 = estimator.get_median_mad()
+    t2 = time.perf_counter()
+    print('StreamingMedianMad', t2-t1)
+    
+    # documented tolerance: 1 bin for the median, 2 for the mad
+    bin_width = 2*estimator.half_range/estimator.nb_bin*mad/1.4826
+    assert np.all(np.abs(med2 - med) < bin_width)
+    assert np.all(np.abs(mad2 - mad) < 2*bin_width*1.4826)
+    print(np.abs(mad2 - mad)/mad)
+    
+    # less samples than init_size: exact
+    estimator = StreamingMedianMad(nb_channel)
+    estimator.new_chunk(sigs[:1024])
+    med3, mad3 = estimator.get_median_mad()
+    med4, mad4 = median_mad(sigs[:1024].astype('float64'), axis=0)
+    assert np.allclose(med3, med4) and np.allclose(mad3, mad4)
+
+
 def test_get_neighborhood():
     geometry = [[0,0], [0, 100], [100, 100]]
     radius_um = 120
@@ -38,5 +127,8 @@ def test_fix_prb_file_py2():
 if __name__ == '__main__':
     #~ test_get_median_mad()
     #~ test_FifoBuffer()
+    #~ test_FifoBuffer_wrap()
+    #~ test_FifoBuffer_benchmark()
+    #~ test_StreamingMedianMad()
     #~ test_get_neighborhood()
     test_fix_prb_file_py2()
\ No newline at end of file
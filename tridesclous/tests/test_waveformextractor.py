@@ -6,7 +6,7 @@ import time
 from tridesclous import get_dataset
 from tridesclous.signalpreprocessor import SignalPreprocessor_Numpy
 from tridesclous.peakdetector import PeakDetectorEngine_Numpy
-from tridesclous.waveformextractor import OnlineWaveformExtractor, cut_full
+from tridesclous.waveformextractor import OnlineWaveformExtractor, cut_full, align_waveforms_upsampled, ReservoirWaveformCapture
 
 
 
@@ -147,11 +147,82 @@ def test_compare_offline_online_engines():
     pyplot.show()
     
 
-
+def test_align_waveforms_upsampled():
+    n_left, n_right = -15, 30
+    peak_width = n_right - n_left
+    nb, nb_channel, ratio = 200, 4, 20
+    
+    t = np.arange(peak_width*3) - (peak_width - n_left)
+    long_wfs = np.random.randn(nb, peak_width*3, nb_channel).astype('float32')*.2
+    jitters = np.random.uniform(-.5, .5, size=nb)
+    long_wfs[:, :, 1] -= 5*np.exp(-((t[None, :]-jitters[:, None])/2.)**2)
+    
+    for peak_sign in ['-', '+']:
+        if peak_sign=='+':
+            long_wfs = -long_wfs
+        t1 = time.perf_counter()
+        aligned = align_waveforms_upsampled(long_wfs, n_left, peak_sign, ratio=ratio, max_bytes=2**20)
+        t2 = time.perf_counter()
+        print('align_waveforms_upsampled', t2-t1)
+        
+        # one by one
+        t1 = time.perf_counter()
+        for i in range(nb):
+            wf2 = scipy.signal.resample(long_wfs[i], peak_width*3*ratio, axis=0)
+            wf2_around_peak = wf2[(peak_width-n_left-2)*ratio:(peak_width-n_left+3)*ratio, :]
+            if peak_sign=='+':
+                ind_chan_max = np.argmax(wf2_around_peak[ratio, :])
+                ind_max = np.argmax(wf2_around_peak[:, ind_chan_max])
+            else:
+                ind_chan_max = np.argmin(wf2_around_peak[ratio, :])
+                ind_max = np.argmin(wf2_around_peak[:, ind_chan_max])
+            i1 = peak_width*ratio + ind_max - ratio*2
+            wf_short = wf2[i1:i1+peak_width*ratio:ratio, :]
+            assert np.allclose(aligned[i], wf_short, atol=1e-5)
+        t2 = time.perf_counter()
+        print('one by one', t2-t1)
+    
+    
+
+def test_ReservoirWaveformCapture():
+    nb_channel, chunksize = 4, 1024
+    n_left, n_right = -20, 30
+    sigs = np.random.randn(chunksize*50, nb_channel).astype('float32')
+    all_peaks = np.sort(np.random.choice(np.arange(10, sigs.shape[0]-10), size=2000, replace=False))
+    noise_indexes = np.random.choice(np.arange(100, sigs.shape[0]-100), size=50, replace=False)
+    
+    for nb_max in [5000, 500]:
+        capture = ReservoirWaveformCapture(nb_channel, chunksize, n_left, n_right, nb_max, 'float32')
+        capture.new_segment(0, noise_indexes)
+        t1 = time.perf_counter()
+        for i in range(sigs.shape[0]//chunksize):
+            pos = (i+1)*chunksize
+            # chunks do not start at 0 (like with lostfront_chunksize) and peaks are reported with delay
+            pos2 = pos - 100
+            chunk = sigs[max(0, pos2-chunksize):pos2]
+            chunk_peaks = all_peaks[(all_peaks>=pos2-chunksize-50) & (all_peaks<pos2-50)]
+            capture.new_chunk(pos2, chunk, chunk_peaks)
+        t2 = time.perf_counter()
+        print('ReservoirWaveformCapture', nb_max, t2-t1)
+        
+        peak_nums, waveforms = capture.get_waveforms()
+        assert capture.nb_peak == np.sum(all_peaks<sigs.shape[0]-150)
+        assert waveforms.shape[0] == min(nb_max, capture.nb_seen)
+        assert np.all(np.diff(peak_nums)>0)
+        for num, wf in zip(peak_nums, waveforms):
+            ind = all_peaks[num]
+            assert np.array_equal(wf, sigs[ind+n_left:ind+n_right])
+        
+        segments, indexes, snippets = capture.get_noise()
+        assert np.array_equal(indexes, np.sort(noise_indexes[noise_indexes<sigs.shape[0]-150]))
+        for ind, snippet in zip(indexes, snippets):
+            assert np.array_equal(snippet, sigs[ind+n_left:ind+n_right])
 
 
 if __name__ == '__main__':
     test_compare_offline_online_engines()
+    #~ test_align_waveforms_upsampled()
+    #~ test_ReservoirWaveformCapture()
     
 
 
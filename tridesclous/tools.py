@@ -1,5 +1,4 @@
 import numpy as np
-import sklearn.metrics.pairwise
 import re
 
 def median_mad(data, axis=0):
@@ -23,6 +22,95 @@ def median_mad(data, axis=0):
     return med, mad
 
 
+class StreamingMedianMad:
+    """
+    Approximate median and MAD by channel computed chunk by chunk
+    without keeping the signals.
+    
+    The first init_size samples are kept to compute an exact first
+    guess (med0, mad0). Then each channel has a fixed bin histogram
+    on [med0-half_range*mad0, med0+half_range*mad0] with nb_bin bins
+    (+ one bin for underflow and one for overflow) that is updated
+    with np.bincount for each chunk.
+    
+    At the end the median is the 0.5 quantile of the histogram
+    (linear interpolation inside bins) and the MAD is the smallest t
+    with CDF(med+t)-CDF(med-t)=0.5 (found by bisection), so only one
+    pass is needed.
+    
+    Tolerance: with bin width w = 2*half_range/nb_bin*mad0 (~1% of the MAD
+    with default params), the error is below w for the median and below 2*w
+    for the MAD (before the 1.4826 factor). With the interpolation the error
+    is in practice much smaller (<0.1% of the MAD).
+    """
+    def __init__(self, nb_channel, nb_bin=8192, half_range=40., init_size=10000):
+        self.nb_channel = nb_channel
+        self.nb_bin = nb_bin
+        self.half_range = half_range
+        self.init_size = init_size
+        
+        self.init_chunks = []
+        self.nb_init = 0
+        self.counts = None
+    
+    def new_chunk(self, data):
+        if self.counts is None:
+            self.init_chunks.append(np.array(data, dtype='float64'))
+            self.nb_init += data.shape[0]
+            if self.nb_init>=self.init_size:
+                self._init_histogram()
+        else:
+            self._add_to_histogram(data)
+    
+    def _init_histogram(self):
+        init_data = np.concatenate(self.init_chunks, axis=0)
+        self.init_chunks = []
+        med0, mad0 = median_mad(init_data, axis=0)
+        mad0[mad0==0] = 1.
+        self.bin_lower = med0 - self.half_range*mad0
+        self.bin_width = 2*self.half_range*mad0/self.nb_bin
+        self.counts = np.zeros((self.nb_channel, self.nb_bin+2), dtype='int64')
+        self._add_to_histogram(init_data)
+    
+    def _add_to_histogram(self, data):
+        ind = np.floor((data - self.bin_lower)/self.bin_width)
+        ind = np.clip(ind, -1, self.nb_bin).astype('int64') + 1
+        ind += np.arange(self.nb_channel, dtype='int64')*(self.nb_bin+2)
+        count = np.bincount(ind.ravel(), minlength=self.nb_channel*(self.nb_bin+2))
+        self.counts += count.reshape(self.nb_channel, self.nb_bin+2)
+    
+    def get_median_mad(self):
+        """
+        Return median and mad (with the 1.4826 factor) like median_mad.
+        """
+        if self.counts is None:
+            # not enough samples for the histogram: exact computation
+            med, mad = median_mad(np.concatenate(self.init_chunks, axis=0), axis=0)
+            return med, mad
+        
+        med = np.zeros(self.nb_channel)
+        mad = np.zeros(self.nb_channel)
+        for c in range(self.nb_channel):
+            edges = self.bin_lower[c] + np.arange(self.nb_bin+1)*self.bin_width[c]
+            # cumulative count at each edge, underflow is before first edge
+            cum = np.cumsum(self.counts[c, :-1]).astype('float64')
+            total = cum[-1] + self.counts[c, -1]
+            
+            cdf = lambda x: np.interp(x, edges, cum)
+            med[c] = np.interp(total/2., cum, edges)
+            
+            low, high = 0., self.half_range*self.bin_width[c]*self.nb_bin
+            for i in range(64):
+                t = (low+high)/2.
+                if cdf(med[c]+t)-cdf(med[c]-t)<total/2.:
+                    low = t
+                else:
+                    high = t
+            mad[c] = (low+high)/2.*1.4826
+        
+        return med, mad
+
+
 def get_pairs_over_threshold(m, labels, threshold):
     """
     detect pairs over threhold in a similarity matrice
@@ -41,37 +129,76 @@ def get_pairs_over_threshold(m, labels, threshold):
     
 
 
+def bisect_sorted(values, value, side='left', lo=0, hi=None, indexer=None):
+    """
+    Same as np.searchsorted(values[lo:hi], value, side)+lo but with a binary
+    search that read only log2(n) elements. np.searchsorted make a
+    contiguous copy of strided arrays (like a field of a structured memmap),
+    which is O(n).
+    
+    If indexer is given, the sorted values are values[indexer[lo:hi]].
+    """
+    if hi is None:
+        hi = len(values) if indexer is None else len(indexer)
+    while lo<hi:
+        mid = (lo+hi)//2
+        v = values[mid] if indexer is None else values[indexer[mid]]
+        if v<value or (side=='right' and v==value):
+            lo = mid+1
+        else:
+            hi = mid
+    return lo
+
+
 class FifoBuffer:
     """
     Kind of fifo on axis 0 than ensure to have the buffer and partial of previous buffer
     continuous in memory.
     
-    This is not efficient if shape[0]is lot greater than chunksize.
-    But if shape[0]=chunksize+smallsize, it should be OK.
-    
+    The fifo live inside a bigger internal array (capacity_factor*shape[0]).
+    New chunks are written once after the previous one, so the last shape[0]
+    samples are always a contiguous view without copy.
+    Only when the end of the internal array is reached, the tail of the fifo
+    is moved to the beginning. So the number of bytes copied by chunk is
+    near the chunk size and not the whole buffer size.
     
     """
-    def __init__(self, shape, dtype):
-        self.buffer = np.zeros(shape, dtype=dtype)
+    def __init__(self, shape, dtype, capacity_factor=4):
+        assert capacity_factor>=2
+        self.shape = tuple(shape)
+        self.size = self.shape[0]
+        self.capacity = self.size*capacity_factor
+        self.internal_buffer = np.zeros((self.capacity, )+self.shape[1:], dtype=dtype)
+        self.head = self.size
         self.last_index = None
-        
+    
+    @property
+    def buffer(self):
+        return self.internal_buffer[self.head-self.size:self.head]
+    
     def new_chunk(self, data, index):
         if self.last_index is not None:
             assert self.last_index+data.shape[0]==index
         
-        n = self.buffer.shape[0]-data.shape[0]
-        #roll the end
+        n = data.shape[0]
+        assert n<=self.size
+        
+        if self.head+n>self.capacity:
+            # move the end of the fifo at the beginning of internal buffer
+            keep = self.size - n
+            self.internal_buffer[:keep] = self.internal_buffer[self.head-keep:self.head]
+            self.head = keep
         
-        self.buffer[:n] = self.buffer[-n:]
-        self.buffer[n:] = data
+        self.internal_buffer[self.head:self.head+n] = data
+        self.head += n
         self.last_index = index
     
     def get_data(self, start, stop):
-        start = start - self.last_index + self.buffer .shape[0]
-        stop = stop - self.last_index + self.buffer .shape[0]
+        start = start - self.last_index + self.size
+        stop = stop - self.last_index + self.size
         assert start>=0
-        assert stop<=self.buffer.shape[0]
-        return self.buffer[start:stop]
+        assert stop<=self.size
+        return self.internal_buffer[self.head-self.size+start:self.head-self.size+stop]
 
 
 def get_neighborhood(geometry, radius_um):
@@ -90,7 +217,8 @@ def get_neighborhood(geometry, radius_um):
     neighborhood: boolean numpy array (nb_channel, nb_channel)
     
     """
-    d = sklearn.metrics.pairwise.euclidean_distances(geometry)
+    geometry = np.asarray(geometry, dtype='float64')
+    d = np.sqrt(np.sum((geometry[:, None, :] - geometry[None, :, :])**2, axis=2))
     return d<=radius_um
     
 
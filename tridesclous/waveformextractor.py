@@ -1,4 +1,7 @@
 import numpy as np
+import scipy.signal
+
+from .tools import FifoBuffer
 
 
 
@@ -109,3 +112,171 @@ def cut_on_border(left_sigs, right_sigs, indexes, width):
         chunks[i,:,l1:] = right_sigs[:l2,:].transpose()
     return chunks
     
+
+
+def align_waveforms_upsampled(waveforms, n_left, peak_sign, ratio=20, out=None, max_bytes=2**26):
+    """
+    Realign waveforms on the peak with a sub sample precision.
+    
+    waveforms are long snippets of 3*peak_width samples cut at
+    peak_index + n_left - peak_width. They are upsampled by ratio with FFT
+    (scipy.signal.resample along axis 1 on a batch of snippets at once),
+    the extremum is searched around the peak on the channel that have the
+    largest peak and the snippet of peak_width samples is taken back
+    with the sub sample shift.
+    
+    Arguments
+    ---------------
+    waveforms: np.ndarray
+        shape (nb, 3*peak_width, nb_channel)
+    n_left: int
+    peak_sign: '+' or '-'
+    ratio: int
+        Upsampling ratio.
+    out: np.ndarray or None
+        shape (nb, peak_width, nb_channel)
+    max_bytes: int
+        Approximative peak memory used by the upsampling of one batch
+        (FFT buffers included).
+    
+    Returns
+    -----------
+    out : np.ndarray
+        shape (nb, peak_width, nb_channel)
+    """
+    nb, long_width, nb_channel = waveforms.shape
+    peak_width = long_width // 3
+    assert long_width == peak_width * 3
+    if out is None:
+        out = np.empty((nb, peak_width, nb_channel), dtype=waveforms.dtype)
+    
+    # resample works in complex128 (16 bytes) on the input and output spectrum,
+    # plus the float64 upsampled result: about 3 arrays of 16 bytes by
+    # upsampled sample (safety factor 3)
+    bytes_by_waveform = long_width * ratio * nb_channel * 16 * 3
+    batch_size = max(1, max_bytes // bytes_by_waveform)
+    around_start = (peak_width - n_left - 2) * ratio
+    for b0 in range(0, nb, batch_size):
+        b1 = min(b0 + batch_size, nb)
+        wf2 = scipy.signal.resample(waveforms[b0:b1], long_width * ratio, axis=1)
+        
+        around = wf2[:, around_start:around_start + 5 * ratio, :]
+        batch = np.arange(b1 - b0)
+        if peak_sign == '+':
+            ind_chan_max = np.argmax(around[:, ratio, :], axis=1)
+            ind_max = np.argmax(around[batch, :, ind_chan_max], axis=1)
+        elif peak_sign == '-':
+            ind_chan_max = np.argmin(around[:, ratio, :], axis=1)
+            ind_max = np.argmin(around[batch, :, ind_chan_max], axis=1)
+        shift = ind_max - ratio * 2
+        
+        i1 = peak_width * ratio + shift
+        samples = i1[:, None] + np.arange(peak_width)[None, :] * ratio
+        out[b0:b1] = wf2[batch[:, None], samples, :]
+    
+    return out
+
+
+class ReservoirWaveformCapture:
+    """
+    Capture waveforms around peaks and noise snippets directly from the
+    preprocessed chunks of the signal processor loop, so that the processed
+    signals do not need to be read again (or even saved).
+    
+    Peaks are reservoir sampled (algorithm R): after the loop the nb_max
+    waveforms are a uniform random subset of all peaks.
+    A FifoBuffer of chunksize+peak_width samples keeps the border of the
+    previous chunk, peaks (and noise positions) too close to the end of the
+    current chunk are pending until the next one. Peaks too close to the
+    begining or the end of a segment are not captured.
+    """
+    def __init__(self, nb_channel, chunksize, n_left, n_right, nb_max, dtype):
+        self.nb_channel = nb_channel
+        self.chunksize = chunksize
+        self.n_left = n_left
+        self.n_right = n_right
+        self.peak_width = n_right - n_left
+        self.nb_max = nb_max
+        self.dtype = np.dtype(dtype)
+        
+        self.waveforms = np.zeros((nb_max, self.peak_width, nb_channel), dtype=self.dtype)
+        self.peak_nums = np.zeros(nb_max, dtype='int64')
+        self.nb_seen = 0 # number of peaks offered to the reservoir
+        self.nb_peak = 0 # number of peaks (also the not captured ones)
+        
+        self.noise_segments = []
+        self.noise_indexes = []
+        self.noise_snippets = []
+    
+    def new_segment(self, seg_num, noise_indexes):
+        self.fifo = FifoBuffer((self.chunksize+self.peak_width, self.nb_channel), self.dtype)
+        self.pending_indexes = np.zeros(0, dtype='int64')
+        self.pending_nums = np.zeros(0, dtype='int64')
+        self.seg_num = seg_num
+        self.pending_noise = np.sort(np.asarray(noise_indexes, dtype='int64'))
+    
+    def new_chunk(self, pos2, chunk, peak_indexes):
+        self.fifo.new_chunk(chunk, pos2)
+        
+        if peak_indexes is None:
+            peak_indexes = np.zeros(0, dtype='int64')
+        peak_nums = self.nb_peak + np.arange(peak_indexes.size, dtype='int64')
+        self.nb_peak += peak_indexes.size
+        
+        indexes = np.concatenate([self.pending_indexes, peak_indexes])
+        nums = np.concatenate([self.pending_nums, peak_nums])
+        ready, ok = self._ready(pos2, indexes)
+        self.pending_indexes, self.pending_nums = indexes[~ready], nums[~ready]
+        self._add_to_reservoir(pos2, indexes[ok], nums[ok])
+        
+        ready, ok = self._ready(pos2, self.pending_noise)
+        if np.any(ok):
+            self.noise_segments.append(np.full(np.sum(ok), self.seg_num, dtype='int64'))
+            self.noise_indexes.append(self.pending_noise[ok])
+            self.noise_snippets.append(self._cut(pos2, self.pending_noise[ok]))
+        self.pending_noise = self.pending_noise[~ready]
+    
+    def _ready(self, pos2, indexes):
+        # ready: all samples are available, ok: and still in the fifo
+        ready = indexes + self.n_right <= pos2
+        ok = ready & (indexes + self.n_left >= max(0, pos2 - self.fifo.size))
+        return ready, ok
+    
+    def _cut(self, pos2, indexes):
+        local = indexes + self.n_left - (pos2 - self.fifo.size)
+        return self.fifo.buffer[local[:, None] + np.arange(self.peak_width)[None, :], :]
+    
+    def _add_to_reservoir(self, pos2, indexes, nums):
+        n = indexes.size
+        if n == 0:
+            return
+        k = self.nb_seen + np.arange(n, dtype='int64')
+        slots = k.copy()
+        full = k >= self.nb_max
+        slots[full] = np.random.randint(0, k[full]+1)
+        keep = slots < self.nb_max
+        slots, indexes, nums = slots[keep], indexes[keep], nums[keep]
+        # when 2 peaks of the same chunk go in the same slot the last one win (like sequential)
+        _, last = np.unique(slots[::-1], return_index=True)
+        sel = slots.size - 1 - last
+        self.waveforms[slots[sel]] = self._cut(pos2, indexes[sel])
+        self.peak_nums[slots[sel]] = nums[sel]
+        self.nb_seen += n
+    
+    def get_waveforms(self):
+        """
+        Return peak_nums (position in all peaks) and waveforms sorted by peak_nums.
+        """
+        n = min(self.nb_seen, self.nb_max)
+        order = np.argsort(self.peak_nums[:n])
+        return self.peak_nums[:n][order], self.waveforms[:n][order]
+    
+    def get_noise(self):
+        """
+        Return segments, indexes and snippets of captured noise.
+        """
+        if len(self.noise_indexes) == 0:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64'), \
+                    np.zeros((0, self.peak_width, self.nb_channel), dtype=self.dtype)
+        return np.concatenate(self.noise_segments), np.concatenate(self.noise_indexes), \
+                    np.concatenate(self.noise_snippets, axis=0)